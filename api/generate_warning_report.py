@@ -10,28 +10,38 @@ import sys
 import json
 import uuid
 import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional, Tuple
 import warnings
 
 # 禁用警告
 warnings.filterwarnings('ignore')
 
-# Flask用于处理HTTP请求
-try:
-    from flask import Flask, request, jsonify
-except ImportError:
-    import subprocess
-    subprocess.check_call([sys.executable, '-m', 'pip', 'install', 'flask'])
-    from flask import Flask, request, jsonify
+# 项目根目录下的共享模块（指标等）
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from rag_metrics import (
+    CONTENT_TYPE as METRICS_CONTENT_TYPE, REPORT_GENERATION_SECONDS, REQUESTS_TOTAL, FALLBACKS_TOTAL,
+    REPORT_TOKENS_TOTAL, STAGE_SECONDS, render_metrics
+)
 
-# OpenAI for final report generation
-try:
-    import openai
-except ImportError:
-    import subprocess
-    subprocess.check_call([sys.executable, '-m', 'pip', 'install', 'openai'])
-    import openai
+# 依赖由requirements.txt在部署时安装；导入阶段不做任何网络操作（不在运行时pip install），
+# 索引、OpenAI客户端、任务队列均在首次使用时创建，冷启动预算见benchmarks/bench_cold_start.py
+from flask import Flask, request, jsonify, Response, stream_with_context
+
+from compact_index import get_compact_index, index_meta, is_loaded as compact_index_loaded
+from openai_clients import DEFAULT_EMBEDDING_MODEL, get_embedding_client, get_openai_client
+from query_windows import split_into_windows
+from rag_diversity import select_diverse, build_knowledge_answer
+from prompt_budget import fit_section, record_prompt_tokens
+from rag_protocol import dumps_compact
+from report_cache import ReportCache, report_cache_key
+from report_jobs import JobQueue, JobStore, QueueFull, STATUS_COMPLETED, STATUS_FAILED
+from singleflight import SingleFlight
+from stage_graph import StageGraph
+from token_counter import count_tokens
 
 # 环境变量加载
 try:
@@ -47,10 +57,40 @@ logger = logging.getLogger(__name__)
 # 创建Flask应用
 app = Flask(__name__)
 
+# 紧凑索引目录（build_rag_system.py构建时导出，或 python compact_index.py 单独导出）
+COMPACT_INDEX_PATH = os.getenv(
+    "RAG_COMPACT_INDEX_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "storage", "compact")
+)
+# 报告生成和检索embedding共用同一个进程级OpenAI客户端（连接池、keep-alive，见openai_clients）
+OPENAI_API_BASE = os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1")
+REPORT_TIMEOUT = float(os.getenv("REPORT_TIMEOUT", "120"))  # 单次报告生成超时（秒）
+
+RETRIEVAL_CANDIDATES = 20  # 多样性筛选前的候选片段数
+RETRIEVAL_TOP_K = 5
+EMBEDDING_BATCH_SIZE = 256  # 单次embedding请求的最大输入条数
+
+# 报告任务队列：任务持久化在SQLite，有界工作线程池执行，待处理任务达到上限时拒绝新任务
+REPORT_JOBS_DB = os.getenv("REPORT_JOBS_DB", os.path.join(tempfile.gettempdir(), "report_jobs.sqlite3"))
+REPORT_JOB_WORKERS = int(os.getenv("REPORT_JOB_WORKERS", "4"))
+REPORT_JOB_MAX_PENDING = int(os.getenv("REPORT_JOB_MAX_PENDING", "50"))
+REPORT_JOB_LEASE_SECONDS = float(os.getenv("REPORT_JOB_LEASE_SECONDS", "600"))  # 执行超过该时长的任务视为已中断
+REPORT_JOB_RETRY_AFTER = 5  # 队列已满时建议的重试间隔（秒）
+
+# 报告结果缓存：相同输入（规范化后）+ 相同索引版本 + 相同提示词版本直接返回已生成的报告
+REPORT_CACHE_MAX_ENTRIES = int(os.getenv("REPORT_CACHE_MAX_ENTRIES", "256"))  # 0表示禁用
+REPORT_CACHE_TTL = float(os.getenv("REPORT_CACHE_TTL", "3600"))  # 秒
+
+# 批量重新扫描：检索按分块批量embedding，报告生成并发数有上限，逐条以NDJSON流式返回
+BATCH_MAX_RECORDS = int(os.getenv("BATCH_MAX_RECORDS", "500"))
+BATCH_REPORT_CONCURRENCY = int(os.getenv("BATCH_REPORT_CONCURRENCY", "8"))  # 同时进行的报告生成数上限
+BATCH_RETRIEVAL_CHUNK = 64  # 每批检索的记录数（检索下一批时上一批的报告已在生成）
+
 class RAGQueryService:
-    """简化的RAG查询服务"""
+    """进程内RAG查询服务 - 紧凑索引检索 + 多样性筛选（索引在热容器内只加载一次）"""
     
-    def __init__(self):
+    def __init__(self, index_path: str = COMPACT_INDEX_PATH):
+        self.index_path = index_path
         self.is_initialized = False
         self.initialization_error = None
         
@@ -69,71 +109,170 @@ class RAGQueryService:
         if missing_vars:
             raise ValueError(f"缺少必需的环境变量: {', '.join(missing_vars)}")
     
+    @property
+    def index_loaded(self) -> bool:
+        return compact_index_loaded(self.index_path)
+    
+    @property
+    def index_version(self) -> int:
+        """当前紧凑索引版本（参与报告缓存键，索引重建后旧报告自动失效）；索引不可用时为0"""
+        try:
+            return int(index_meta(self.index_path).get("index_version", 0))
+        except Exception:
+            return 0
+    
+    def _embed(self, queries: list) -> list:
+        """批量获取查询窗口的embedding（模型以索引meta为准，无需等待索引加载）"""
+        model = index_meta(self.index_path).get("embedding_model") or DEFAULT_EMBEDDING_MODEL
+        client = get_embedding_client(model, api_base=OPENAI_API_BASE)
+        embeddings = []
+        for start in range(0, len(queries), EMBEDDING_BATCH_SIZE):
+            with STAGE_SECONDS.time(stage="embedding"):
+                embeddings.extend(client.embed(queries[start:start + EMBEDDING_BATCH_SIZE]))
+        return embeddings
+    
+    def _fallback_result(self) -> Dict[str, Any]:
+        FALLBACKS_TOTAL.inc(reason="rag_not_initialized")
+        return {
+            "error": f"RAG系统未初始化: {self.initialization_error}",
+            "answer": "系统暂时无法访问知识库，将使用AI基础知识进行分析。",
+            "sources": [],
+            "sources_count": 0,
+            "storage_type": "fallback_mode"
+        }
+    
+    @staticmethod
+    def _error_result(error: Exception) -> Dict[str, Any]:
+        logger.error(f"RAG查询失败: {str(error)}")
+        FALLBACKS_TOTAL.inc(reason="rag_query_error")
+        return {
+            "error": str(error),
+            "answer": "查询过程中出现错误，将使用AI基础知识进行分析。",
+            "sources": [],
+            "sources_count": 0,
+            "storage_type": "error_fallback"
+        }
+    
+    def _load_with_embeddings(self, queries: list) -> tuple:
+        """索引加载与embedding并发进行，返回 (index, embeddings)"""
+        stages = StageGraph()
+        stages.add("index", lambda: get_compact_index(self.index_path))
+        stages.add("embedding", lambda: self._embed(queries))
+        results = stages.run()
+        return results["index"], results["embedding"]
+    
+    def _build_result(self, index, question: str, context: str, embeddings: list) -> Dict[str, Any]:
+        """检索 + 多样性筛选，构建查询结果"""
+        with STAGE_SECONDS.time(stage="retrieval"):
+            candidates = index.search_windows(embeddings, RETRIEVAL_CANDIDATES)
+        with STAGE_SECONDS.time(stage="diversity"):
+            nodes = select_diverse(candidates, RETRIEVAL_TOP_K)
+        
+        sources = []
+        for node in nodes:
+            file_name = os.path.basename(node.metadata.get('file_path', 'unknown'))
+            if file_name not in sources:
+                sources.append(file_name)
+        
+        return {
+            "answer": build_knowledge_answer(nodes),
+            "sources": sources,
+            "sources_count": len(nodes),
+            "references": [
+                {"score": round(node.score, 4), "file_path": node.metadata.get('file_path', 'unknown')}
+                for node in nodes
+            ],
+            "storage_type": "compact_index",
+            "index_version": index.version,
+            "query_used": question,
+            "context_provided": context
+        }
+    
     def query(self, question: str, context: str = "") -> Dict[str, Any]:
-        """RAG查询 - 简化版本"""
+        """RAG查询 - 向量top-k检索后按来源多样性筛选（冷启动时索引加载与embedding并发进行）"""
+        if not self.is_initialized:
+            return self._fallback_result()
         try:
-            if not self.is_initialized:
-                return {
-                    "error": f"RAG系统未初始化: {self.initialization_error}",
-                    "answer": "系统暂时无法访问知识库，将使用AI基础知识进行分析。",
-                    "sources": [],
-                    "sources_count": 0,
-                    "storage_type": "fallback_mode"
-                }
-            
-            # 模拟RAG查询结果
-            return {
-                "answer": "基于知识库分析，建议关注以下几个方面的情感安全问题...",
-                "sources": [
-                    "Jordan Peterson - 人际关系建议",
-                    "Sadia Khan - 两性沟通策略"
-                ],
-                "sources_count": 2,
-                "storage_type": "cloudflare_r2_python",
-                "query_used": question,
-                "context_provided": context
-            }
-            
+            # 长聊天记录按窗口检索，一次批量embedding
+            queries = split_into_windows(question) or [question]
+            index, embeddings = self._load_with_embeddings(queries)
+            return self._build_result(index, question, context, embeddings)
         except Exception as e:
-            logger.error(f"RAG查询失败: {str(e)}")
-            return {
-                "error": str(e),
-                "answer": "查询过程中出现错误，将使用AI基础知识进行分析。",
-                "sources": [],
-                "sources_count": 0,
-                "storage_type": "error_fallback"
-            }
+            return self._error_result(e)
+    
+    def query_many(self, requests: List[Tuple[str, str]]) -> List[Dict[str, Any]]:
+        """批量RAG查询：所有查询的窗口合并为少量embedding请求，再逐条检索；requests为 [(question, context)]"""
+        if not self.is_initialized:
+            return [self._fallback_result() for _ in requests]
+        windows = [split_into_windows(question) or [question] for question, _ in requests]
+        try:
+            index, embeddings = self._load_with_embeddings([window for queries in windows for window in queries])
+        except Exception as e:
+            return [self._error_result(e) for _ in requests]
+        
+        results, offset = [], 0
+        for (question, context), queries in zip(requests, windows):
+            try:
+                results.append(self._build_result(index, question, context, embeddings[offset:offset + len(queries)]))
+            except Exception as e:
+                results.append(self._error_result(e))
+            offset += len(queries)
+        return results
 
 # 全局RAG服务实例
 rag_service = RAGQueryService()
 
-def generate_final_report(user_info: Dict[str, Any], rag_result: Dict[str, Any]) -> str:
-    """生成最终的情感安全分析报告"""
-    
-    try:
-        # 配置OpenAI
-        openai_api_key = os.getenv("OPENAI_API_KEY")
-        openai_api_base = os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1")
-        
-        client = openai.OpenAI(
-            api_key=openai_api_key,
-            base_url=openai_api_base
-        )
-        
-        # 构建系统提示词
-        system_prompt = f"""你是一位专业的情感安全分析师。请基于以下信息为用户生成详细的情感安全警告报告：
+# 报告生成参数
+REPORT_MODEL = 'gpt-4o'
+REPORT_MAX_TOKENS = 2000
+# 提示词版本：修改build_report_messages、各部分token预算或报告生成参数时递增，使缓存的旧报告失效
+PROMPT_VERSION = '2'
 
-用户信息：
-- 昵称：{user_info.get('nickname', '未提供')}
+report_cache = ReportCache(max_entries=REPORT_CACHE_MAX_ENTRIES, ttl_seconds=REPORT_CACHE_TTL)
+
+
+def lookup_cached_report(user_info: Dict[str, Any]) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """返回 (缓存键, 缓存的 {'rag_result', 'final_report'} 或None)"""
+    cache_key = report_cache_key(user_info, rag_service.index_version, PROMPT_VERSION)
+    return cache_key, report_cache.get(cache_key)
+
+
+def cache_report(cache_key: Optional[str], rag_result: Dict[str, Any], final_report: str):
+    """缓存成功生成的报告；知识库检索降级时生成的报告不缓存"""
+    if cache_key and not rag_result.get('error'):
+        report_cache.put(cache_key, {'rag_result': rag_result, 'final_report': final_report})
+
+
+def _report_client():
+    """共享的OpenAI客户端（复用连接池，不再每次请求重新建连和TLS握手）；报告生成使用更长的超时"""
+    return get_openai_client(api_base=OPENAI_API_BASE).with_options(timeout=REPORT_TIMEOUT)
+
+
+def build_profile_section(user_info: Dict[str, Any]) -> str:
+    """提示词中的用户信息部分，按token预算裁剪（不依赖检索结果，可与RAG检索并发准备）"""
+    profile = fit_section("profile", f"""- 昵称：{user_info.get('nickname', '未提供')}
 - 职业：{user_info.get('profession', '未提供')}
-- 年龄：{user_info.get('age', '未提供')}
-- 聊天记录/简介：{user_info.get('bioOrChatHistory', '未提供')}
+- 年龄：{user_info.get('age', '未提供')}""", REPORT_MODEL)
+    chat = fit_section("chat", str(user_info.get('bioOrChatHistory', '未提供')), REPORT_MODEL)
+    return f"""用户信息：
+{profile}
+- 聊天记录/简介：{chat}"""
+
+
+def build_report_messages(user_info: Dict[str, Any], rag_result: Dict[str, Any],
+                          profile_section: Optional[str] = None) -> list:
+    """构建报告生成的提示词消息"""
+    if profile_section is None:
+        profile_section = build_profile_section(user_info)
+    system_prompt = f"""你是一位专业的情感安全分析师。请基于以下信息为用户生成详细的情感安全警告报告：
+
+{profile_section}
 
 RAG知识库分析：
-{rag_result.get('answer', '暂无知识库支持')}
+{fit_section("knowledge", rag_result.get('answer', '暂无知识库支持'), REPORT_MODEL)}
 
 参考资料：
-{'; '.join(rag_result.get('sources', ['AI基础知识']))}
+{fit_section("sources", '; '.join(rag_result.get('sources', ['AI基础知识'])), REPORT_MODEL)}
 
 请生成一份专业的情感安全分析报告，包含：
 1. 情况分析
@@ -147,27 +286,232 @@ RAG知识库分析：
 - 注重情感安全
 - 给出具体的行动建议
 """
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": f"请为{user_info.get('nickname', '用户')}生成情感安全分析报告。"}
+    ]
+
 
-        # 调用OpenAI API
+def create_final_report(user_info: Dict[str, Any], rag_result: Dict[str, Any],
+                        cache_key: Optional[str] = None, profile_section: Optional[str] = None) -> str:
+    """调用OpenAI生成报告，失败时抛出异常（给出cache_key时缓存成功生成的报告）"""
+    client = _report_client()
+    messages = build_report_messages(user_info, rag_result, profile_section)
+    prompt_tokens = record_prompt_tokens(messages, REPORT_MODEL)
+    
+    # 调用OpenAI API
+    with REPORT_GENERATION_SECONDS.time():
         response = client.chat.completions.create(
-            model='gpt-4o',
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"请为{user_info.get('nickname', '用户')}生成情感安全分析报告。"}
-            ],
+            model=REPORT_MODEL,
+            messages=messages,
             temperature=0.7,
-            max_tokens=2000
+            max_tokens=REPORT_MAX_TOKENS
         )
-        
-        return response.choices[0].message.content
-        
+    
+    final_report = response.choices[0].message.content
+    # 优先使用接口返回的用量，兼容不返回usage的代理
+    usage = getattr(response, 'usage', None)
+    REPORT_TOKENS_TOTAL.inc(getattr(usage, 'prompt_tokens', None) or prompt_tokens, direction="in")
+    REPORT_TOKENS_TOTAL.inc(
+        getattr(usage, 'completion_tokens', None) or count_tokens(final_report or '', REPORT_MODEL), direction="out"
+    )
+    cache_report(cache_key, rag_result, final_report)
+    return final_report
+
+
+def generate_final_report(user_info: Dict[str, Any], rag_result: Dict[str, Any],
+                          cache_key: Optional[str] = None, profile_section: Optional[str] = None) -> str:
+    """生成最终的情感安全分析报告（失败时返回说明文本）"""
+    
+    try:
+        return create_final_report(user_info, rag_result, cache_key, profile_section)
     except Exception as e:
         logger.error(f"生成最终报告失败: {str(e)}")
+        FALLBACKS_TOTAL.inc(reason="report_generation_error")
         return f"报告生成失败：{str(e)}。请检查OpenAI API配置。"
 
+
+def stream_final_report(user_info: Dict[str, Any], rag_result: Dict[str, Any],
+                        profile_section: Optional[str] = None):
+    """流式生成报告，逐段产出文本；客户端断开（生成器关闭）时同时关闭上游流"""
+    messages = build_report_messages(user_info, rag_result, profile_section)
+    REPORT_TOKENS_TOTAL.inc(record_prompt_tokens(messages, REPORT_MODEL), direction="in")
+    stream = _report_client().chat.completions.create(
+        model=REPORT_MODEL,
+        messages=messages,
+        temperature=0.7,
+        max_tokens=REPORT_MAX_TOKENS,
+        stream=True
+    )
+    parts = []
+    try:
+        with REPORT_GENERATION_SECONDS.time():
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+    finally:
+        stream.close()
+        # 流式响应不带usage，输出token按已产出的文本计数
+        REPORT_TOKENS_TOTAL.inc(count_tokens(''.join(parts), REPORT_MODEL), direction="out")
+
+
+def sse_event(event: str, payload: Dict[str, Any]) -> str:
+    """Server-Sent Events消息"""
+    return f"event: {event}\ndata: {dumps_compact(payload)}\n\n"
+
+
+def extract_user_info(data: Dict[str, Any]) -> Dict[str, Any]:
+    """提取用户信息"""
+    return {
+        'nickname': data.get('nickname', ''),
+        'profession': data.get('profession', ''),
+        'age': data.get('age', ''),
+        'bioOrChatHistory': data.get('bioOrChatHistory', '')
+    }
+
+
+def rag_query_args(user_info: Dict[str, Any]) -> Tuple[str, str]:
+    """RAG查询的问题和上下文"""
+    rag_query = f"分析以下用户情况的情感安全风险：{user_info['bioOrChatHistory']}"
+    rag_context = f"用户信息: {user_info['nickname']}, {user_info['profession']}, {user_info['age']}岁"
+    return rag_query, rag_context
+
+
+def run_rag_query(user_info: Dict[str, Any]) -> Dict[str, Any]:
+    """执行RAG查询"""
+    return rag_service.query(*rag_query_args(user_info))
+
+
+# 双击或前端重试时相同的扫描同时到达：同一缓存键同一时刻只检索/生成一次，其余请求共享结果
+retrieval_flight = SingleFlight("retrieval")
+report_flight = SingleFlight("report")
+
+
+def coalesced_rag_query(user_info: Dict[str, Any], cache_key: str) -> Dict[str, Any]:
+    """执行RAG查询，合并进行中的相同查询"""
+    rag_result, _ = retrieval_flight.do(cache_key, lambda: run_rag_query(user_info))
+    return rag_result
+
+
+def prepare_report_inputs(user_info: Dict[str, Any], cache_key: str,
+                          rag_result: Optional[Dict[str, Any]] = None) -> Tuple[Dict[str, Any], str]:
+    """RAG检索（已有rag_result时跳过）与提示词用户信息部分并发准备，返回 (rag_result, profile_section)"""
+    stages = StageGraph()
+    stages.add("retrieval", lambda: rag_result if rag_result is not None else coalesced_rag_query(user_info, cache_key))
+    stages.add("profile", lambda: build_profile_section(user_info))
+    results = stages.run()
+    return results["retrieval"], results["profile"]
+
+
+def coalesced_report(user_info: Dict[str, Any], cache_key: str, rag_result: Optional[Dict[str, Any]] = None,
+                     strict: bool = False) -> Tuple[Dict[str, Any], str]:
+    """
+    检索（已有rag_result时跳过）并生成报告，合并进行中的相同请求；
+    报告在释放前已写入缓存，之后到达的相同请求直接命中缓存。
+    strict=True时报告生成失败抛出异常（任务队列据此记录失败），否则返回说明文本
+    """
+    generate = create_final_report if strict else generate_final_report
+    
+    def compute():
+        result, profile_section = prepare_report_inputs(user_info, cache_key, rag_result)
+        return result, generate(user_info, result, cache_key, profile_section)
+    
+    # 两种模式的失败结果不同，分别合并
+    return report_flight.do((cache_key, strict), compute)[0]
+
+
+def build_response_data(user_info: Dict[str, Any], rag_result: Dict[str, Any], final_report: Optional[str],
+                        task_id: str, processing_mode: str = 'synchronous', cached: bool = False) -> Dict[str, Any]:
+    """构建响应"""
+    return {
+        'success': True,
+        'timestamp': datetime.now().isoformat(),
+        'task_id': task_id,
+        'user_info': user_info,
+        'rag_knowledge': {
+            'rag_analysis': {
+                'status': 'error' if rag_result.get('error') else 'active',
+                'sources_count': rag_result.get('sources_count', 0),
+                'knowledge_answer': rag_result.get('answer', ''),
+                'knowledge_references': rag_result.get('sources', []),
+                'storage_type': rag_result.get('storage_type', 'unknown')
+            }
+        },
+        'final_report': final_report,
+        'system_info': {
+            'version': '3.0 - 纯Python版',
+            'environment': 'vercel_serverless',
+            'processing_mode': processing_mode,
+            'cached': cached,
+            'rag_status': 'initialized' if rag_service.is_initialized else 'error'
+        }
+    }
+
+
+def wants_stream(data: Dict[str, Any]) -> bool:
+    """请求流式响应：Accept: text/event-stream，或 stream=true（查询参数或请求体）"""
+    if 'text/event-stream' in request.headers.get('Accept', ''):
+        return True
+    flag = request.args.get('stream', data.get('stream', False))
+    return flag is True or str(flag).lower() in ('1', 'true')
+
+
+def stream_report_events(user_info: Dict[str, Any], rag_result: Dict[str, Any], task_id: str,
+                         cache_key: Optional[str] = None, cached_report: Optional[str] = None,
+                         profile_section: Optional[str] = None):
+    """
+    SSE事件流：
+        retrieval  检索结果（立即发送）
+        token      报告文本增量 {"delta": "..."}（命中缓存时为一次性发送的完整报告）
+        done       完整报告及系统信息
+        error      报告生成失败
+    """
+    cached = cached_report is not None
+    response_data = build_response_data(user_info, rag_result, None, task_id, 'streaming', cached)
+    yield sse_event('retrieval', {
+        'task_id': task_id,
+        'user_info': user_info,
+        'rag_knowledge': response_data['rag_knowledge']
+    })
+    
+    parts = []
+    try:
+        deltas = [cached_report] if cached else stream_final_report(user_info, rag_result, profile_section)
+        for delta in deltas:
+            parts.append(delta)
+            yield sse_event('token', {'delta': delta})
+    except GeneratorExit:
+        # 客户端断开连接
+        REQUESTS_TOTAL.inc(service="warning_report", status="cancelled")
+        raise
+    except Exception as e:
+        logger.error(f"流式生成报告失败: {str(e)}")
+        FALLBACKS_TOTAL.inc(reason="report_generation_error")
+        REQUESTS_TOTAL.inc(service="warning_report", status="error")
+        yield sse_event('error', {
+            'success': False,
+            'task_id': task_id,
+            'error': f"报告生成失败：{str(e)}。请检查OpenAI API配置。",
+            'partial_report': ''.join(parts)
+        })
+        return
+    
+    if not cached:
+        cache_report(cache_key, rag_result, ''.join(parts))
+    REQUESTS_TOTAL.inc(service="warning_report", status="success")
+    yield sse_event('done', {
+        'success': True,
+        'task_id': task_id,
+        'timestamp': datetime.now().isoformat(),
+        'final_report': ''.join(parts),
+        'system_info': response_data['system_info']
+    })
+
+
 @app.route('/api/generate_warning_report', methods=['POST'])
 def generate_warning_report():
-    """生成警告报告的主要端点"""
+    """生成警告报告的主要端点（请求流式响应时以SSE先返回检索结果，再逐段返回报告）"""
     
     try:
         # 解析请求数据
@@ -176,61 +520,57 @@ def generate_warning_report():
         else:
             data = request.form.to_dict()
         
-        # 提取用户信息
-        user_info = {
-            'nickname': data.get('nickname', ''),
-            'profession': data.get('profession', ''),
-            'age': data.get('age', ''),
-            'bioOrChatHistory': data.get('bioOrChatHistory', '')
-        }
+        user_info = extract_user_info(data)
         
         logger.info(f"收到分析请求: {user_info.get('nickname', 'Unknown')}")
         
         # 验证输入
         if not user_info.get('bioOrChatHistory', '').strip():
+            REQUESTS_TOTAL.inc(service="warning_report", status="invalid")
             return jsonify({
                 'success': False,
                 'error': '请提供聊天记录或个人简介',
                 'timestamp': datetime.now().isoformat()
             }), 400
         
-        # 执行RAG查询
-        rag_query = f"分析以下用户情况的情感安全风险：{user_info['bioOrChatHistory']}"
-        rag_context = f"用户信息: {user_info['nickname']}, {user_info['profession']}, {user_info['age']}岁"
+        task_id = str(uuid.uuid4())  # 生成唯一任务ID
         
-        rag_result = rag_service.query(rag_query, rag_context)
+        # 相同输入的重复提交（如刷新页面）直接返回缓存的报告，不再检索和调用GPT-4o
+        cache_key, cached = lookup_cached_report(user_info)
+        if cached is not None:
+            logger.info(f"⚡ 报告缓存命中: {user_info.get('nickname', 'Unknown')}")
         
-        # 生成最终报告
-        final_report = generate_final_report(user_info, rag_result)
+        if wants_stream(data):
+            if cached is not None:
+                events = stream_report_events(
+                    user_info, cached['rag_result'], task_id, cached_report=cached['final_report']
+                )
+            else:
+                rag_result, profile_section = prepare_report_inputs(user_info, cache_key)
+                events = stream_report_events(
+                    user_info, rag_result, task_id, cache_key, profile_section=profile_section
+                )
+            return Response(
+                stream_with_context(events),
+                mimetype='text/event-stream',
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+            )
         
-        # 构建响应
-        response_data = {
-            'success': True,
-            'timestamp': datetime.now().isoformat(),
-            'task_id': str(uuid.uuid4()),  # 生成唯一任务ID
-            'user_info': user_info,
-            'rag_knowledge': {
-                'rag_analysis': {
-                    'status': 'error' if rag_result.get('error') else 'active',
-                    'sources_count': rag_result.get('sources_count', 0),
-                    'knowledge_answer': rag_result.get('answer', ''),
-                    'knowledge_references': rag_result.get('sources', []),
-                    'storage_type': rag_result.get('storage_type', 'unknown')
-                }
-            },
-            'final_report': final_report,
-            'system_info': {
-                'version': '3.0 - 纯Python版',
-                'environment': 'vercel_serverless',
-                'processing_mode': 'synchronous',
-                'rag_status': 'initialized' if rag_service.is_initialized else 'error'
-            }
-        }
+        if cached is not None:
+            REQUESTS_TOTAL.inc(service="warning_report", status="success")
+            return jsonify(build_response_data(
+                user_info, cached['rag_result'], cached['final_report'], task_id, cached=True
+            ))
         
-        return jsonify(response_data)
+        # 检索并生成最终报告
+        rag_result, final_report = coalesced_report(user_info, cache_key)
+        
+        REQUESTS_TOTAL.inc(service="warning_report", status="success")
+        return jsonify(build_response_data(user_info, rag_result, final_report, task_id))
         
     except Exception as e:
         logger.error(f"处理请求失败: {str(e)}")
+        REQUESTS_TOTAL.inc(service="warning_report", status="error")
         return jsonify({
             'success': False,
             'error': f'处理失败: {str(e)}',
@@ -241,6 +581,235 @@ def generate_warning_report():
             }
         }), 500
 
+def process_report_job(payload: Dict[str, Any], progress) -> Dict[str, Any]:
+    """任务队列中执行的报告生成"""
+    user_info = payload['user_info']
+    cache_key, cached = lookup_cached_report(user_info)
+    if cached is not None:
+        return build_response_data(
+            user_info, cached['rag_result'], cached['final_report'], payload['task_id'], 'job_queue', cached=True
+        )
+    progress(10, 'retrieval')
+    rag_result = coalesced_rag_query(user_info, cache_key)
+    progress(40, 'report_generation')
+    # 报告生成失败时抛出异常，任务记为失败而不是把说明文本当作结果
+    rag_result, final_report = coalesced_report(user_info, cache_key, rag_result, strict=True)
+    return build_response_data(user_info, rag_result, final_report, payload['task_id'], 'job_queue')
+
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+
+def get_job_queue() -> JobQueue:
+    """首次使用时创建任务队列并启动工作线程"""
+    global _job_queue
+    if _job_queue is None:
+        with _job_queue_lock:
+            if _job_queue is None:
+                _job_queue = JobQueue(
+                    JobStore(REPORT_JOBS_DB), process_report_job,
+                    max_workers=REPORT_JOB_WORKERS, max_pending=REPORT_JOB_MAX_PENDING,
+                    lease_seconds=REPORT_JOB_LEASE_SECONDS
+                ).start()
+    return _job_queue
+
+
+@app.route('/api/report_jobs', methods=['POST'])
+def submit_report_job():
+    """提交报告任务，立即返回任务ID"""
+    if request.is_json:
+        data = request.get_json()
+    else:
+        data = request.form.to_dict()
+    
+    user_info = extract_user_info(data)
+    if not user_info.get('bioOrChatHistory', '').strip():
+        REQUESTS_TOTAL.inc(service="warning_report_job", status="invalid")
+        return jsonify({
+            'success': False,
+            'error': '请提供聊天记录或个人简介',
+            'timestamp': datetime.now().isoformat()
+        }), 400
+    
+    task_id = str(uuid.uuid4())
+    try:
+        get_job_queue().submit({'task_id': task_id, 'user_info': user_info}, job_id=task_id)
+    except QueueFull as e:
+        REQUESTS_TOTAL.inc(service="warning_report_job", status="rejected")
+        response = jsonify({
+            'success': False,
+            'error': str(e),
+            'retry_after': REPORT_JOB_RETRY_AFTER,
+            'timestamp': datetime.now().isoformat()
+        })
+        response.headers['Retry-After'] = str(REPORT_JOB_RETRY_AFTER)
+        return response, 429
+    
+    REQUESTS_TOTAL.inc(service="warning_report_job", status="accepted")
+    return jsonify({
+        'success': True,
+        'task_id': task_id,
+        'status': 'queued',
+        'status_url': f'/api/report_jobs/{task_id}',
+        'result_url': f'/api/report_jobs/{task_id}/result',
+        'timestamp': datetime.now().isoformat()
+    }), 202
+
+
+@app.route('/api/report_jobs/<task_id>', methods=['GET'])
+def report_job_status(task_id: str):
+    """任务状态和进度"""
+    status = get_job_queue().status(task_id)
+    if status is None:
+        return jsonify({'success': False, 'error': '任务不存在'}), 404
+    return jsonify({'success': True, **status})
+
+
+@app.route('/api/report_jobs/<task_id>/result', methods=['GET'])
+def report_job_result(task_id: str):
+    """任务结果：完成时返回与同步接口相同的响应，未完成时返回202和当前进度"""
+    queue = get_job_queue()
+    status = queue.status(task_id)
+    if status is None:
+        return jsonify({'success': False, 'error': '任务不存在'}), 404
+    if status['status'] == STATUS_COMPLETED:
+        return jsonify(queue.result(task_id))
+    if status['status'] == STATUS_FAILED:
+        return jsonify({'success': False, 'error': f"报告生成失败: {status['error']}", 'task_id': task_id}), 500
+    return jsonify({'success': True, **status}), 202
+
+
+def batch_report(user_info: Dict[str, Any], cache_key: str, rag_result: Dict[str, Any]) -> str:
+    """批量任务中单条记录的报告生成（与其他请求中的相同记录合并），失败时抛出异常"""
+    def compute():
+        return rag_result, create_final_report(user_info, rag_result, cache_key)
+    
+    return report_flight.do((cache_key, True), compute)[0][1]
+
+
+def batch_line(index: int, record_id: Any, payload: Dict[str, Any]) -> str:
+    """NDJSON中的一行"""
+    return dumps_compact({'index': index, 'id': record_id, **payload}) + "\n"
+
+
+def batch_report_lines(records: list, concurrency: int):
+    """
+    逐条产出批量结果（NDJSON，按完成顺序）：
+        缓存命中和无效记录立即返回；其余记录按BATCH_RETRIEVAL_CHUNK分块批量检索，
+        报告生成交给有界线程池，最后一行为汇总 {"done": true, ...}
+    """
+    counts = {'succeeded': 0, 'failed': 0, 'cached': 0}
+    
+    def finish(future, targets) -> str:
+        """一个报告结果对应批次中所有相同的记录"""
+        error = future.exception()
+        if error is not None:
+            logger.error(f"批量报告生成失败: {str(error)}")
+            FALLBACKS_TOTAL.inc(reason="report_generation_error")
+        lines = []
+        for index, record_id, user_info, rag_result in targets:
+            if error is not None:
+                REQUESTS_TOTAL.inc(service="warning_report_batch", status="error")
+                counts['failed'] += 1
+                lines.append(batch_line(index, record_id, {'success': False, 'error': f"报告生成失败：{str(error)}"}))
+                continue
+            REQUESTS_TOTAL.inc(service="warning_report_batch", status="success")
+            counts['succeeded'] += 1
+            lines.append(batch_line(index, record_id, build_response_data(
+                user_info, rag_result, future.result(), str(uuid.uuid4()), 'batch'
+            )))
+        return ''.join(lines)
+    
+    pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch-report")
+    futures = {}  # future -> 等待该结果的记录
+    by_key = {}  # 缓存键 -> future（同一批中的相同记录只检索和生成一次）
+    rag_by_key = {}
+    try:
+        misses = []
+        for index, data in enumerate(records):
+            data = data if isinstance(data, dict) else {}
+            record_id = data.get('id', index)
+            user_info = extract_user_info(data)
+            if not str(user_info.get('bioOrChatHistory') or '').strip():
+                REQUESTS_TOTAL.inc(service="warning_report_batch", status="invalid")
+                counts['failed'] += 1
+                yield batch_line(index, record_id, {'success': False, 'error': '请提供聊天记录或个人简介'})
+                continue
+            cache_key, cached = lookup_cached_report(user_info)
+            if cached is not None:
+                REQUESTS_TOTAL.inc(service="warning_report_batch", status="success")
+                counts['succeeded'] += 1
+                counts['cached'] += 1
+                yield batch_line(index, record_id, build_response_data(
+                    user_info, cached['rag_result'], cached['final_report'], str(uuid.uuid4()), 'batch', cached=True
+                ))
+                continue
+            misses.append((index, record_id, user_info, cache_key))
+        
+        for start in range(0, len(misses), BATCH_RETRIEVAL_CHUNK):
+            chunk = misses[start:start + BATCH_RETRIEVAL_CHUNK]
+            unique = {}
+            for _, _, user_info, cache_key in chunk:
+                if cache_key not in by_key:
+                    unique.setdefault(cache_key, user_info)
+            rag_by_key.update(zip(unique, rag_service.query_many([rag_query_args(u) for u in unique.values()])))
+            
+            for index, record_id, user_info, cache_key in chunk:
+                target = (index, record_id, user_info, rag_by_key[cache_key])
+                future = by_key.get(cache_key)
+                if future is None:
+                    future = by_key[cache_key] = pool.submit(batch_report, user_info, cache_key, rag_by_key[cache_key])
+                    futures[future] = []
+                if future in futures:
+                    futures[future].append(target)
+                else:
+                    # 相同记录的报告已经输出过
+                    yield finish(future, [target])
+            
+            for future in [future for future in futures if future.done()]:
+                yield finish(future, futures.pop(future))
+        
+        for future in as_completed(list(futures)):
+            yield finish(future, futures.pop(future))
+        
+        yield dumps_compact({'done': True, 'total': len(records), **counts}) + "\n"
+    finally:
+        # 客户端断开时不再开始排队中的报告生成
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+@app.route('/api/batch_warning_reports', methods=['POST'])
+def batch_warning_reports():
+    """
+    批量生成警告报告（信任与安全团队批量重新扫描）
+    请求: {"records": [user_info, ...], "concurrency": 可选，不超过BATCH_REPORT_CONCURRENCY}
+    响应: application/x-ndjson，每条记录一行（带index和id，按完成顺序），最后一行为汇总
+    """
+    data = request.get_json(silent=True) or {}
+    records = data.get('records')
+    if not isinstance(records, list) or not records:
+        return jsonify({'success': False, 'error': '请提供records数组', 'timestamp': datetime.now().isoformat()}), 400
+    if len(records) > BATCH_MAX_RECORDS:
+        return jsonify({
+            'success': False,
+            'error': f'单次最多 {BATCH_MAX_RECORDS} 条记录，收到 {len(records)} 条',
+            'timestamp': datetime.now().isoformat()
+        }), 413
+    
+    try:
+        concurrency = int(data.get('concurrency') or BATCH_REPORT_CONCURRENCY)
+    except (TypeError, ValueError):
+        concurrency = BATCH_REPORT_CONCURRENCY
+    concurrency = max(1, min(concurrency, BATCH_REPORT_CONCURRENCY))
+    
+    logger.info(f"📦 收到批量分析请求: {len(records)} 条记录，报告并发 {concurrency}")
+    return Response(
+        stream_with_context(batch_report_lines(records, concurrency)),
+        mimetype='application/x-ndjson',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """健康检查端点"""
@@ -254,11 +823,18 @@ def health_check():
         'version': '3.0 - 纯Python版',
         'environment': 'vercel_serverless',
         'rag_initialized': rag_service.is_initialized,
+        'rag_index_loaded': rag_service.index_loaded,
         'rag_error': rag_service.initialization_error,
         'missing_variables': missing_vars,
         'timestamp': datetime.now().isoformat()
     })
 
+@app.route('/metrics', methods=['GET'])
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+    """Prometheus指标端点"""
+    return Response(render_metrics(), content_type=METRICS_CONTENT_TYPE)
+
 # Vercel serverless function 处理器
 def handler(request):
     """Vercel serverless function 入口点"""
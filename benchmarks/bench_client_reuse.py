@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+OpenAI客户端复用基准测试
+对比每次请求的客户端开销：
+    fresh   每次请求新建openai.OpenAI（旧的generate_final_report实现：新连接池、重新建连/TLS握手）
+    shared  使用openai_clients中进程级共享的客户端（keep-alive连接复用）
+
+默认请求本地OpenAI替身（benchmarks/fake_openai.py，明文HTTP，只体现建客户端和TCP建连的开销）；
+用 --api-base 指向真实的HTTPS代理时还包含TLS握手（会产生真实的API调用费用）
+
+用法: python benchmarks/bench_client_reuse.py [--requests 200] [--api-base https://api.gptsapi.net/v1]
+"""
+
+import os
+import sys
+import time
+import argparse
+import statistics
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import openai
+
+from fake_openai import FakeOpenAIServer
+from openai_clients import get_openai_client
+
+# 与报告生成相同的接口，但只请求很短的输出，放大客户端开销的占比
+MESSAGES = [{"role": "user", "content": "ping"}]
+
+
+def call(client: openai.OpenAI, model: str):
+    client.chat.completions.create(model=model, messages=MESSAGES, max_tokens=1)
+
+
+def benchmark(mode: str, requests: int, api_key: str, api_base: str, model: str) -> dict:
+    timings = []
+    for _ in range(requests):
+        started = time.perf_counter()
+        if mode == "fresh":
+            client = openai.OpenAI(api_key=api_key, base_url=api_base)
+            call(client, model)
+            client.close()
+        else:
+            call(get_openai_client(api_key=api_key, api_base=api_base), model)
+        timings.append(time.perf_counter() - started)
+
+    timings.sort()
+    return {
+        "mode": mode,
+        "mean_ms": statistics.mean(timings) * 1000,
+        "p50_ms": timings[len(timings) // 2] * 1000,
+        "p95_ms": timings[int(len(timings) * 0.95)] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI客户端复用基准测试")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--api-base", default=None, help="默认启动本地OpenAI替身")
+    parser.add_argument("--model", default="gpt-4o")
+    args = parser.parse_args()
+
+    fake = None
+    api_base, api_key = args.api_base, os.getenv("OPENAI_API_KEY", "sk-bench")
+    if api_base is None:
+        fake = FakeOpenAIServer(embedding_latency_ms=0, chat_latency_ms=0).start()
+        api_base = fake.api_base
+
+    try:
+        # 预热共享客户端的连接，两种模式都不计入首次导入开销
+        call(get_openai_client(api_key=api_key, api_base=api_base), args.model)
+        results = [benchmark(mode, args.requests, api_key, api_base, args.model) for mode in ("fresh", "shared")]
+    finally:
+        if fake is not None:
+            fake.stop()
+
+    print(f"📊 OpenAI客户端复用基准 ({args.requests} 次请求, {api_base})")
+    print(f"{'模式':<8}{'mean(ms)':>12}{'p50(ms)':>12}{'p95(ms)':>12}")
+    for row in results:
+        print(f"{row['mode']:<8}{row['mean_ms']:>12.2f}{row['p50_ms']:>12.2f}{row['p95_ms']:>12.2f}")
+
+    by_mode = {row["mode"]: row for row in results}
+    saving = by_mode["fresh"]["mean_ms"] - by_mode["shared"]["mean_ms"]
+    print(f"✅ 共享客户端每次请求节省 {saving:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
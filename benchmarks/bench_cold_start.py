@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Serverless冷启动基准测试（api/generate_warning_report.py的Vercel handler）
+每轮启动一个全新的Python进程，依次测量：
+    interpreter    解释器启动
+    import         导入函数模块（Flask应用、路由注册；不应有任何网络操作）
+    first_health   首个 GET /api/health
+    first_report   首个报告请求（含紧凑索引加载、OpenAI客户端创建、numpy等首次使用开销）
+    warm_report    同一进程内第二个（不同输入的）报告请求，作为对照
+
+embedding与LLM接口由本地替身提供且默认零延迟，测得的是函数自身的启动开销；
+紧凑索引为合成数据（默认2000个片段，与线上规模相当）
+
+冷启动预算（各轮中位数，超出时退出码为1）：
+    ready_ms         interpreter + import + first_health    <= 1500
+    first_report_ms  首个报告请求                            <= 1000
+
+用法: python benchmarks/bench_cold_start.py [--runs 5] [--chunks 2000] [--importtime]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+from types import SimpleNamespace
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+API_DIR = os.path.join(ROOT_DIR, "api")
+sys.path.insert(0, ROOT_DIR)
+
+DEFAULT_WORKDIR = os.path.join(BENCH_DIR, ".load_test_workdir")
+DEFAULT_FIXTURES = os.path.join(BENCH_DIR, "fixtures", "scan_payloads.jsonl")
+
+# 冷启动预算（毫秒）
+BUDGET_MS = {
+    "ready_ms": 1500,
+    "first_report_ms": 1000,
+}
+
+PHASES = ("interpreter_ms", "import_ms", "first_health_ms", "ready_ms", "first_report_ms", "warm_report_ms")
+
+
+def vercel_request(method: str, path: str, body: dict = None) -> SimpleNamespace:
+    """handler所需的最小请求对象（path、method、headers、data、query_string）"""
+    data = json.dumps(body, ensure_ascii=False).encode("utf-8") if body is not None else b""
+    headers = {"Content-Type": "application/json"} if body is not None else {}
+    return SimpleNamespace(method=method, path=path, headers=headers, data=data, query_string=b"")
+
+
+def ensure_fixture_compact_index(path: str, chunks: int, dim: int = 1536):
+    """生成合成紧凑索引（片段数不同时重新生成）"""
+    meta_path = os.path.join(path, "meta.json")
+    if os.path.exists(meta_path):
+        with open(meta_path, encoding="utf-8") as f:
+            if json.load(f).get("count") == chunks:
+                return
+    import numpy as np
+    from compact_index import write_compact_index
+
+    print(f"🔨 生成合成紧凑索引: {path} ({chunks} 个片段)")
+    sources = ["my_knowledge/red_flags.pdf", "my_knowledge/attachment.docx", "my_knowledge/scam_cases.txt"]
+    docs = [
+        {
+            "id": f"chunk-{i}",
+            "text": "在亲密关系中识别危险信号的具体表现，并给出应对建议。" * 20,
+            "metadata": {"file_path": sources[i % len(sources)], "page_label": str(i // len(sources) + 1)},
+        }
+        for i in range(chunks)
+    ]
+    vectors = np.random.default_rng(42).standard_normal((chunks, dim), dtype=np.float32)
+    write_compact_index(path, vectors, docs, "text-embedding-3-small", index_version=1)
+
+
+# === 子进程：一次冷启动 ===
+
+def run_child(payloads_path: str):
+    started = time.perf_counter()
+    started_epoch = time.time()
+
+    sys.path.insert(0, API_DIR)
+    import generate_warning_report as api
+    imported = time.perf_counter()
+
+    health = api.handler(vercel_request("GET", "/api/health"))
+    healthy = time.perf_counter()
+
+    with open(payloads_path, encoding="utf-8") as f:
+        payloads = [json.loads(line) for line in f if line.strip()]
+    first = api.handler(vercel_request("POST", "/api/generate_warning_report", payloads[0]))
+    reported = time.perf_counter()
+    warm = api.handler(vercel_request("POST", "/api/generate_warning_report", payloads[1]))
+    warmed = time.perf_counter()
+
+    print(json.dumps({
+        "started_epoch": started_epoch,
+        "import_ms": (imported - started) * 1000,
+        "first_health_ms": (healthy - imported) * 1000,
+        "first_report_ms": (reported - healthy) * 1000,
+        "warm_report_ms": (warmed - reported) * 1000,
+        "ok": all(response.status_code == 200 for response in (health, first, warm)),
+        "storage_type": first.get_json()["rag_knowledge"]["rag_analysis"]["storage_type"],
+    }))
+
+
+# === 父进程 ===
+
+def cold_start(env: dict, payloads_path: str) -> dict:
+    spawned_epoch = time.time()
+    proc = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", payloads_path],
+        env=env, cwd=ROOT_DIR, capture_output=True, text=True, timeout=120
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"冷启动子进程失败:\n{proc.stderr[-2000:]}")
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    result["interpreter_ms"] = (result.pop("started_epoch") - spawned_epoch) * 1000
+    result["ready_ms"] = result["interpreter_ms"] + result["import_ms"] + result["first_health_ms"]
+    return result
+
+
+def import_profile(env: dict, top: int = 12) -> list:
+    """python -X importtime 导入函数模块，返回其直接导入中累计耗时最高的模块"""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import sys; sys.path.insert(0, {API_DIR!r}); "
+                                                   "import generate_warning_report"],
+        env=env, cwd=ROOT_DIR, capture_output=True, text=True, timeout=120
+    )
+    # 子模块的行先于父模块输出，每层缩进两个空格
+    children, rows = [], []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        name = name[1:]
+        depth = (len(name) - len(name.lstrip(" "))) // 2
+        if depth == 0:
+            if name == "generate_warning_report":
+                rows = [(int(cumulative) / 1000.0, "generate_warning_report (合计)")] + children
+            children = []
+        elif depth == 1:
+            children.append((int(cumulative) / 1000.0, name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def main():
+    if sys.argv[1:2] == ["--child"]:
+        run_child(sys.argv[2])
+        return
+
+    parser = argparse.ArgumentParser(description="Serverless函数冷启动基准测试")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--chunks", type=int, default=2000, help="合成紧凑索引的片段数")
+    parser.add_argument("--workdir", default=DEFAULT_WORKDIR)
+    parser.add_argument("--fixtures", default=DEFAULT_FIXTURES)
+    parser.add_argument("--importtime", action="store_true", help="输出导入耗时最高的模块")
+    args = parser.parse_args()
+
+    from fake_openai import FakeOpenAIServer
+
+    compact_path = os.path.join(os.path.abspath(args.workdir), "compact")
+    ensure_fixture_compact_index(compact_path, args.chunks)
+
+    fake = FakeOpenAIServer(embedding_latency_ms=0, chat_latency_ms=0).start()
+    env = dict(os.environ)
+    env.update({
+        "OPENAI_API_KEY": "sk-cold-start",
+        "OPENAI_API_BASE": fake.api_base,
+        "RAG_COMPACT_INDEX_PATH": compact_path,
+        "REPORT_CACHE_MAX_ENTRIES": "0",
+    })
+    try:
+        results = [cold_start(env, os.path.abspath(args.fixtures)) for _ in range(args.runs)]
+        profile = import_profile(env) if args.importtime else []
+    finally:
+        fake.stop()
+
+    if not all(result["ok"] for result in results):
+        print("❌ 冷启动请求返回了错误状态码")
+        sys.exit(1)
+
+    print(f"📊 冷启动基准 ({args.runs} 轮, 紧凑索引 {args.chunks} 个片段, "
+          f"检索: {results[0]['storage_type']})")
+    print(f"{'阶段':<18}{'median(ms)':>12}{'max(ms)':>12}{'预算(ms)':>12}")
+    over_budget = []
+    for phase in PHASES:
+        values = [result[phase] for result in results]
+        median = statistics.median(values)
+        budget = BUDGET_MS.get(phase)
+        if budget is not None and median > budget:
+            over_budget.append(phase)
+        print(f"{phase:<18}{median:>12.1f}{max(values):>12.1f}{(budget or ''):>12}")
+
+    if profile:
+        print("\n🐢 导入耗时最高的模块（累计）:")
+        for cumulative_ms, name in profile:
+            print(f"  {cumulative_ms:>8.1f} ms  {name}")
+
+    if over_budget:
+        print(f"\n❌ 超出冷启动预算: {', '.join(over_budget)}")
+        sys.exit(1)
+    print("\n✅ 冷启动在预算内")
+
+
+if __name__ == "__main__":
+    main()
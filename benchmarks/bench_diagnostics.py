@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+诊断开销基准测试
+对比增强版RAG服务在多样性筛选 + 构建响应阶段的单次查询耗时：
+    off     诊断关闭（结构化诊断的空实现）
+    on      诊断开启（结构化诊断随JSON返回）
+    legacy  诊断关闭，但按旧实现逐个候选片段格式化INFO日志并写入stderr缓冲
+
+不调用embedding接口也不加载索引，使用合成的候选片段
+
+用法: python benchmarks/bench_diagnostics.py [--iterations 2000] [--candidates 20]
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rag_query_service_enhanced import EnhancedRAGService
+from rag_diagnostics import NULL_DIAGNOSTICS, create_diagnostics
+
+# 合成候选片段的来源文件（覆盖多个作者）
+SAMPLE_FILES = [
+    'my_knowledge/12-Rules-for-Life.pdf',
+    'my_knowledge/Sadia Khan - Modern Dating.txt',
+    'my_knowledge/红药丸 Week 3.pdf',
+    'my_knowledge/谜男方法.pdf',
+    'my_knowledge/AB的異想世界.txt',
+    'my_knowledge/misc_notes.txt',
+]
+
+
+class SyntheticNode:
+    """模拟NodeWithScore的最小对象"""
+
+    def __init__(self, index: int, text_chars: int):
+        self.node_id = f"node-{index}"
+        self.score = 0.9 - index * 0.01
+        self.text = ("约会中的情感操控迹象与边界设定。" * (text_chars // 16 + 1))[:text_chars]
+        self.metadata = {'file_path': SAMPLE_FILES[index % len(SAMPLE_FILES)], 'page_label': str(index)}
+
+
+class OfflineRAGService(EnhancedRAGService):
+    """跳过索引加载的增强版服务，只运行多样性筛选和响应构建"""
+
+    def initialize_rag_system(self):
+        return True
+
+
+def legacy_candidate_logging(log: logging.Logger, service: EnhancedRAGService, query: str, candidates: list):
+    """旧实现中每次查询都会执行的候选片段日志（格式化开销与输出量与原代码一致）"""
+    log.info(f"🔍 开始多样性强制均衡检索: {query[:100]}...")
+    log.info("📋 候选片段列表:")
+    for i, node in enumerate(candidates):
+        file_path = node.metadata.get('file_path', 'unknown')
+        author = service.identify_source(file_path)
+        log.info(f"  {i+1}. [{author}] 评分: {node.score:.4f}, 来源: {file_path}")
+
+
+def run_once(service: EnhancedRAGService, query: str, candidates: list, mode: str, log: logging.Logger) -> int:
+    """执行一次查询的后半段，返回序列化后的响应字节数"""
+    if mode == 'legacy':
+        legacy_candidate_logging(log, service, query, candidates)
+    diagnostics = create_diagnostics(True) if mode == 'on' else NULL_DIAGNOSTICS
+    nodes = service.diversified_retrieval(query, top_k=5, all_candidates=candidates, diagnostics=diagnostics)
+    result = service.build_result({'nickname': 'bench'}, nodes, query, diagnostics=diagnostics)
+    return len(json.dumps(result, ensure_ascii=False).encode('utf-8'))
+
+
+def benchmark(mode: str, iterations: int, candidates: list, service: EnhancedRAGService) -> dict:
+    # 旧实现的日志最终被server.js缓冲，这里写入内存缓冲模拟
+    sink = io.StringIO()
+    log = logging.getLogger(f"bench.{mode}")
+    log.handlers = [logging.StreamHandler(sink)]
+    log.propagate = False
+    log.setLevel(logging.INFO)
+
+    query = "分析约会对象的聊天记录，识别情感操控迹象。" * 20
+    timings = []
+    response_bytes = 0
+    for _ in range(iterations):
+        started = time.perf_counter()
+        response_bytes = run_once(service, query, candidates, mode, log)
+        timings.append(time.perf_counter() - started)
+
+    timings.sort()
+    return {
+        'mode': mode,
+        'mean_us': statistics.mean(timings) * 1e6,
+        'p50_us': timings[len(timings) // 2] * 1e6,
+        'p95_us': timings[int(len(timings) * 0.95)] * 1e6,
+        'stderr_bytes_per_query': len(sink.getvalue().encode('utf-8')) // iterations,
+        'response_bytes': response_bytes,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RAG诊断开销基准测试")
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--candidates", type=int, default=20)
+    parser.add_argument("--text-chars", type=int, default=1000, help="每个候选片段的文本长度")
+    args = parser.parse_args()
+
+    # 服务自身的日志降到WARNING，只测量诊断相关的开销
+    logging.getLogger("rag_query_service_enhanced").setLevel(logging.WARNING)
+
+    service = OfflineRAGService()
+    candidates = [SyntheticNode(i, args.text_chars) for i in range(args.candidates)]
+
+    results = [benchmark(mode, args.iterations, candidates, service) for mode in ('off', 'on', 'legacy')]
+
+    print(f"📊 诊断开销基准 ({args.iterations} 次, {args.candidates} 个候选片段)")
+    print(f"{'模式':<8}{'mean(us)':>12}{'p50(us)':>12}{'p95(us)':>12}{'stderr(B)':>12}{'响应(B)':>12}")
+    for row in results:
+        print(f"{row['mode']:<8}{row['mean_us']:>12.1f}{row['p50_us']:>12.1f}{row['p95_us']:>12.1f}"
+              f"{row['stderr_bytes_per_query']:>12}{row['response_bytes']:>12}")
+
+    by_mode = {row['mode']: row for row in results}
+    saving = by_mode['legacy']['mean_us'] - by_mode['off']['mean_us']
+    print(f"✅ 关闭诊断相比旧日志实现每次查询节省 {saving:.1f} us，"
+          f"stderr输出减少 {by_mode['legacy']['stderr_bytes_per_query']} 字节")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地OpenAI兼容接口替身（压测用）
+提供 POST /v1/embeddings 和 POST /v1/chat/completions：
+    - embedding按文本哈希生成确定性的单位向量（同一文本总是得到同一向量）
+    - chat返回固定结构的报告文本，支持 stream=true（SSE分块，可带usage）
+    - 每个接口可配置延迟分布，模拟上游耗时
+    - 可按比例注入500错误，并周期性地返回一串429（带Retry-After）
+
+延迟分布（毫秒）：
+    80                  固定延迟
+    uniform:50:150      均匀分布
+    normal:80:20        正态分布（均值:标准差，截断到0以上）
+    lognormal:80:400    对数正态分布（p50:p99），上游延迟的长尾
+
+随机性（延迟、错误注入）由 seed + 接口 + 请求序号决定，同一种子下第N个请求的行为总是相同；
+返回内容与种子无关
+
+服务通过 OPENAI_API_BASE=http://127.0.0.1:<端口>/v1 指向本替身；在 -- 后给出命令时，
+以该环境变量运行命令，结束后关闭替身：
+    python benchmarks/fake_openai.py --chat-latency-ms lognormal:1500:6000 -- python build_rag_system.py
+
+用法: python benchmarks/fake_openai.py [--port 8089] [--embedding-latency-ms 80] [--chat-latency-ms 1500]
+                                      [--first-token-ms 300] [--error-rate 0] [--rate-limit-every 0]
+                                      [--rate-limit-burst 0] [--seed 0] [-- 命令 参数...]
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import hashlib
+import argparse
+import threading
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Union
+
+# text-embedding-3-small的向量维度（与已构建的索引一致）
+EMBEDDING_DIM = 1536
+
+FAKE_REPORT = (
+    "## 🚨 情感安全警告报告\n\n"
+    "### 风险评估\n综合风险等级: 中\n\n"
+    "### 关键发现\n1. 聊天中存在忽冷忽热的互动模式\n2. 对个人背景的描述前后不一致\n\n"
+    "### 建议\n保持独立判断，逐步核实对方提供的信息。"
+)
+
+# 流式响应每个分块的字符数
+STREAM_CHUNK_CHARS = 8
+
+# 标准正态分布的99分位数
+_Z99 = 2.3263
+
+LatencySpec = Union[float, int, str]
+
+
+def parse_latency(spec: LatencySpec) -> Callable[[random.Random], float]:
+    """解析延迟分布（毫秒），返回按随机源采样延迟（秒）的函数"""
+    if isinstance(spec, (int, float)) or ":" not in str(spec):
+        fixed = max(float(spec), 0.0) / 1000.0
+        return lambda rng: fixed
+
+    kind, *params = str(spec).split(":")
+    try:
+        a, b = (float(p) for p in params)
+    except ValueError:
+        raise ValueError(f"延迟分布需要两个参数: {spec}")
+
+    if kind == "uniform":
+        return lambda rng: rng.uniform(a, b) / 1000.0
+    if kind == "normal":
+        return lambda rng: max(rng.gauss(a, b), 0.0) / 1000.0
+    if kind == "lognormal":
+        if a <= 0 or b < a:
+            raise ValueError(f"lognormal需要 0 < p50 <= p99: {spec}")
+        mu, sigma = math.log(a), (math.log(b) - math.log(a)) / _Z99
+        return lambda rng: rng.lognormvariate(mu, sigma) / 1000.0
+    raise ValueError(f"未知的延迟分布: {kind}（可选 uniform / normal / lognormal）")
+
+
+def fake_embedding(text: str, dim: int = EMBEDDING_DIM) -> list:
+    """按文本哈希生成确定性的单位向量"""
+    rng = random.Random(hashlib.sha256(text.encode("utf-8")).digest())
+    vector = [rng.gauss(0.0, 1.0) for _ in range(dim)]
+    norm = sum(v * v for v in vector) ** 0.5 or 1.0
+    return [v / norm for v in vector]
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # 响应头和响应体合并写出并关闭Nagle，避免keep-alive连接上的延迟确认放大延迟
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        # 压测时不输出访问日志
+        pass
+
+    def _send_json(self, status: int, payload: dict, headers: dict = None):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self._send_json(400, {"error": {"message": "invalid JSON", "type": "invalid_request_error"}})
+            return
+
+        path = self.path.split("?")[0]
+        if path.endswith("/embeddings"):
+            endpoint, handle = "embeddings", self._embeddings
+        elif path.endswith("/chat/completions"):
+            endpoint, handle = "chat_completions", self._chat_completions
+        else:
+            self._send_json(404, {"error": {"message": f"unknown path {path}", "type": "invalid_request_error"}})
+            return
+
+        seq, rng = self.server.next_request(endpoint)
+        if self._inject_failure(seq, rng):
+            return
+        handle(request, seq, rng)
+
+    def _inject_failure(self, seq: int, rng: random.Random) -> bool:
+        """按请求序号返回429突发，按比例返回500；已响应时返回True"""
+        server = self.server
+        if server.rate_limit_every and seq % server.rate_limit_every >= server.rate_limit_every - server.rate_limit_burst:
+            server.count("rate_limited")
+            self._send_json(429, {"error": {
+                "message": "Rate limit reached (fake)", "type": "requests", "code": "rate_limit_exceeded",
+            }}, headers={
+                "Retry-After": str(max(1, math.ceil(server.retry_after_ms / 1000.0))),
+                "retry-after-ms": str(int(server.retry_after_ms)),
+            })
+            return True
+        if server.error_rate and rng.random() < server.error_rate:
+            server.count("errors")
+            self._send_json(500, {"error": {"message": "The server had an error (fake)", "type": "server_error"}})
+            return True
+        return False
+
+    def _embeddings(self, request: dict, seq: int, rng: random.Random):
+        texts = request.get("input", [])
+        if isinstance(texts, str):
+            texts = [texts]
+        time.sleep(self.server.embedding_latency(rng))
+        self.server.count("embeddings")
+        self._send_json(200, {
+            "object": "list",
+            "model": request.get("model", "text-embedding-3-small"),
+            "data": [
+                {"object": "embedding", "index": i, "embedding": fake_embedding(str(text), self.server.dim)}
+                for i, text in enumerate(texts)
+            ],
+            "usage": {"prompt_tokens": sum(len(str(t)) for t in texts), "total_tokens": sum(len(str(t)) for t in texts)},
+        })
+
+    def _chat_completions(self, request: dict, seq: int, rng: random.Random):
+        latency = self.server.chat_latency(rng)
+        prompt_chars = sum(len(str(m.get("content", ""))) for m in request.get("messages", []))
+        usage = {"prompt_tokens": prompt_chars, "completion_tokens": len(FAKE_REPORT),
+                 "total_tokens": prompt_chars + len(FAKE_REPORT)}
+        head = {"id": f"chatcmpl-fake-{seq}", "created": int(time.time()),
+                "model": request.get("model", "gpt-4o")}
+
+        if request.get("stream"):
+            include_usage = bool((request.get("stream_options") or {}).get("include_usage"))
+            self._stream_chat(head, latency, usage if include_usage else None)
+            return
+
+        time.sleep(latency)
+        self.server.count("chat_completions")
+        self._send_json(200, {
+            **head,
+            "object": "chat.completion",
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": FAKE_REPORT},
+                "finish_reason": "stop",
+            }],
+            "usage": usage,
+        })
+
+    def _stream_chat(self, head: dict, latency: float, usage: dict = None):
+        """SSE分块输出报告：首个分块在首token延迟后发出，其余分块均匀分布在总延迟内"""
+        pieces = [FAKE_REPORT[i:i + STREAM_CHUNK_CHARS] for i in range(0, len(FAKE_REPORT), STREAM_CHUNK_CHARS)]
+        first_token = min(self.server.first_token_latency, latency)
+        interval = (latency - first_token) / max(len(pieces) - 1, 1)
+
+        def chunk(delta: dict, finish_reason=None) -> dict:
+            return {**head, "object": "chat.completion.chunk",
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+
+        events = [chunk({"role": "assistant", "content": ""})]
+        events += [chunk({"content": piece}) for piece in pieces]
+        events.append(chunk({}, "stop"))
+        if usage is not None:
+            events.append({**head, "object": "chat.completion.chunk", "choices": [], "usage": usage})
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            time.sleep(first_token)
+            for i, event in enumerate(events):
+                # 角色分块与首个内容分块一起发出，之后每个内容分块间隔interval
+                if 1 < i <= len(pieces):
+                    time.sleep(interval)
+                self._write_chunk(f"data: {json.dumps(event, ensure_ascii=False)}\n\n")
+            self._write_chunk("data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端中途断开（取消生成）
+            self.close_connection = True
+            return
+        self.server.count("chat_completions")
+
+    def _write_chunk(self, text: str):
+        data = text.encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    """可在后台线程运行的OpenAI替身服务"""
+
+    daemon_threads = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, embedding_latency_ms: LatencySpec = 80,
+                 chat_latency_ms: LatencySpec = 1500, dim: int = EMBEDDING_DIM, first_token_ms: float = 300,
+                 error_rate: float = 0.0, rate_limit_every: int = 0, rate_limit_burst: int = 0,
+                 retry_after_ms: float = 1000, seed: int = 0):
+        """
+        Args:
+            embedding_latency_ms / chat_latency_ms: 延迟分布（见模块说明），chat为完整响应的总耗时
+            first_token_ms: 流式响应的首token延迟（不超过chat总延迟）
+            error_rate: 返回500的请求比例
+            rate_limit_every / rate_limit_burst: 每个接口每rate_limit_every个请求中，最后rate_limit_burst个返回429
+            retry_after_ms: 429响应的Retry-After
+            seed: 延迟采样和错误注入的随机种子
+        """
+        if rate_limit_burst > rate_limit_every:
+            raise ValueError("rate_limit_burst不能大于rate_limit_every")
+        super().__init__((host, port), FakeOpenAIHandler)
+        self.embedding_latency = parse_latency(embedding_latency_ms)
+        self.chat_latency = parse_latency(chat_latency_ms)
+        self.first_token_latency = max(first_token_ms, 0) / 1000.0
+        self.dim = dim
+        self.error_rate = error_rate
+        self.rate_limit_every = rate_limit_every
+        self.rate_limit_burst = rate_limit_burst
+        self.retry_after_ms = retry_after_ms
+        self.seed = seed
+        # 成功响应数，以及注入的429和500次数
+        self.request_counts = {"embeddings": 0, "chat_completions": 0, "rate_limited": 0, "errors": 0}
+        self._sequence = {"embeddings": 0, "chat_completions": 0}
+        self._count_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def api_base(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def next_request(self, endpoint: str) -> tuple:
+        """分配接口内的请求序号，返回 (序号, 该请求的随机源)"""
+        with self._count_lock:
+            seq = self._sequence[endpoint]
+            self._sequence[endpoint] += 1
+        return seq, random.Random(f"{self.seed}:{endpoint}:{seq}")
+
+    def count(self, endpoint: str):
+        with self._count_lock:
+            self.request_counts[endpoint] += 1
+
+    def start(self) -> "FakeOpenAIServer":
+        self._thread = threading.Thread(target=self.serve_forever, name="fake-openai", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    argv = sys.argv[1:]
+    command = []
+    if "--" in argv:
+        split = argv.index("--")
+        argv, command = argv[:split], argv[split + 1:]
+
+    parser = argparse.ArgumentParser(description="本地OpenAI兼容接口替身")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089, help="0表示随机端口（运行命令时的默认值）")
+    parser.add_argument("--embedding-latency-ms", default="80", help="固定值或 uniform/normal/lognormal:a:b")
+    parser.add_argument("--chat-latency-ms", default="1500", help="固定值或 uniform/normal/lognormal:a:b")
+    parser.add_argument("--first-token-ms", type=float, default=300, help="流式响应的首token延迟")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回500的请求比例")
+    parser.add_argument("--rate-limit-every", type=int, default=0, help="每N个请求出现一次429突发，0表示不限流")
+    parser.add_argument("--rate-limit-burst", type=int, default=0, help="每次429突发的请求数")
+    parser.add_argument("--retry-after-ms", type=float, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    port = args.port if not command or "--port" in argv else 0
+    server = FakeOpenAIServer(
+        args.host, port, args.embedding_latency_ms, args.chat_latency_ms,
+        first_token_ms=args.first_token_ms, error_rate=args.error_rate,
+        rate_limit_every=args.rate_limit_every, rate_limit_burst=args.rate_limit_burst,
+        retry_after_ms=args.retry_after_ms, seed=args.seed,
+    )
+    print(f"🧪 OpenAI替身已启动: OPENAI_API_BASE={server.api_base}", flush=True)
+
+    if not command:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return
+
+    env = dict(os.environ)
+    env["OPENAI_API_BASE"] = server.api_base
+    env.setdefault("OPENAI_API_KEY", "sk-fake-openai")
+    server.start()
+    try:
+        returncode = subprocess.call(command, env=env)
+    except KeyboardInterrupt:
+        returncode = 130
+    finally:
+        server.stop()
+    print(f"📊 替身请求统计: {json.dumps(server.request_counts, ensure_ascii=False)}")
+    sys.exit(returncode)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,499 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+扫描流量压测工具
+从fixture文件中抽取真实形态的user_info请求，模拟server.js的扫描流量，分别压测：
+    spawn   每个请求启动一次 rag_query_service_enhanced.py（帧协议，与server.js调用方式一致）
+    worker  常驻 rag_query_service_enhanced.py --worker，stdin/stdout逐行收发
+    flask   api/generate_warning_report.py 的 POST /api/generate_warning_report
+
+embedding和LLM接口由本地替身（benchmarks/fake_openai.py）提供，不访问外部服务；
+输出吞吐、延迟分位数以及每个进程的内存峰值和CPU耗时
+
+查询服务从 --workdir 下的storage/加载索引；首次运行spawn/worker时会用替身的embedding
+在该目录构建一个小型合成索引（需要llama_index）
+
+用法:
+    python benchmarks/load_test.py --target worker --requests 200 --concurrency 16
+    python benchmarks/load_test.py --target all --requests 50 --concurrency 4 --json results.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import threading
+import subprocess
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT_DIR)
+
+from fake_openai import FakeOpenAIServer
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+ENHANCED_SCRIPT = os.path.join(ROOT_DIR, "rag_query_service_enhanced.py")
+DEFAULT_FIXTURES = os.path.join(BENCH_DIR, "fixtures", "scan_payloads.jsonl")
+DEFAULT_WORKDIR = os.path.join(BENCH_DIR, ".load_test_workdir")
+
+TARGETS = ("spawn", "worker", "flask")
+
+# 合成索引的来源文件（覆盖多个作者，使多样性筛选有实际工作量）
+SAMPLE_SOURCES = [
+    ('my_knowledge/12-Rules-for-Life.pdf', "承担责任、设定边界、对自己说实话"),
+    ('my_knowledge/Sadia Khan - Modern Dating.txt', "现代约会中的依恋类型、情绪操控与红旗信号"),
+    ('my_knowledge/红药丸 Week 3.pdf', "两性吸引力、框架控制与关系中的权力动态"),
+    ('my_knowledge/谜男方法.pdf', "搭讪流程、推拉技巧与建立舒适感"),
+    ('my_knowledge/AB的異想世界.txt', "情感诈骗、杀猪盘话术与投资陷阱识别"),
+    ('my_knowledge/misc_notes.txt', "沟通技巧、冷暴力与健康关系的特征"),
+]
+
+# 采样进程资源的间隔（秒）
+SAMPLE_INTERVAL = 0.1
+
+
+# === 请求构建 ===
+
+def load_payloads(path: str) -> List[dict]:
+    """读取fixture中的user_info请求（每行一个JSON）"""
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def to_rag_request(user_info: dict, deadline_ms: int) -> dict:
+    """与server.js callRAGSystem相同的请求格式"""
+    query = user_info.get("bioOrChatHistory", "")
+    return {
+        "user_info": {
+            "nickname": user_info.get("nickname", ""),
+            "profession": user_info.get("profession", ""),
+            "age": user_info.get("age", ""),
+            "bio": query,
+            "bioOrChatHistory": query,
+        },
+        "image_analysis": [],
+        "image_infos": [],
+        "diagnostic_mode": False,
+        "deadline_at": int(time.time() * 1000) + deadline_ms,
+        "output": "frames",
+        "fields": [],
+    }
+
+
+def to_flask_request(user_info: dict) -> dict:
+    """Flask报告端点使用扁平字段"""
+    return {key: user_info.get(key, "") for key in ("nickname", "profession", "age", "bioOrChatHistory")}
+
+
+def parse_frames(output: bytes) -> Dict[str, dict]:
+    """解析长度前缀帧输出，返回 帧类型 -> 内容（忽略非帧行）"""
+    frames = {}
+    pos = 0
+    while pos < len(output):
+        newline = output.find(b"\n", pos)
+        if newline < 0:
+            break
+        header = output[pos:newline]
+        pos = newline + 1
+        if not header.startswith(b"@"):
+            continue
+        frame_type, _, size = header[1:].decode("ascii", "replace").partition(" ")
+        body = output[pos:pos + int(size)]
+        pos += int(size) + 1
+        frames[frame_type] = json.loads(body)
+    return frames
+
+
+# === 进程资源采样 ===
+
+def _proc_stats(pid: int) -> Optional[Tuple[int, float]]:
+    """返回进程 (RSS字节数, CPU秒数)，进程已退出时返回None"""
+    try:
+        if psutil is not None:
+            process = psutil.Process(pid)
+            cpu = process.cpu_times()
+            return process.memory_info().rss, cpu.user + cpu.system
+        with open(f"/proc/{pid}/stat") as f:
+            # comm字段可能包含空格，从最后一个')'之后开始解析
+            fields = f.read().rsplit(")", 1)[1].split()
+        ticks = os.sysconf("SC_CLK_TCK")
+        rss = int(fields[21]) * os.sysconf("SC_PAGE_SIZE")
+        return rss, (int(fields[11]) + int(fields[12])) / ticks
+    except Exception:
+        return None
+
+
+class ProcessSampler:
+    """后台线程周期采样常驻进程的内存峰值和CPU累计耗时"""
+
+    def __init__(self, pid: int, role: str):
+        self.pid = pid
+        self.role = role
+        self.peak_rss = 0
+        self.cpu_start = None
+        self.cpu_seconds = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _sample(self):
+        stats = _proc_stats(self.pid)
+        if stats is None:
+            return
+        rss, cpu = stats
+        self.peak_rss = max(self.peak_rss, rss)
+        if self.cpu_start is None:
+            self.cpu_start = cpu
+        self.cpu_seconds = cpu - self.cpu_start
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._sample()
+            self._stop.wait(SAMPLE_INTERVAL)
+
+    def start(self) -> "ProcessSampler":
+        self._sample()
+        self._thread.start()
+        return self
+
+    def stop(self, wall_seconds: float) -> dict:
+        self._sample()
+        self._stop.set()
+        self._thread.join()
+        return {
+            "role": self.role,
+            "processes": 1,
+            "peak_rss_mb": round(self.peak_rss / 1024 / 1024, 1),
+            "cpu_seconds": round(self.cpu_seconds, 3),
+            "cpu_percent": round(self.cpu_seconds / wall_seconds * 100, 1) if wall_seconds else 0.0,
+        }
+
+
+# === 统计 ===
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(target: str, latencies: List[float], errors: int, degraded: int, wall: float,
+              concurrency: int, processes: List[dict]) -> dict:
+    ordered = sorted(latencies)
+    total = len(latencies) + errors
+    return {
+        "target": target,
+        "requests": total,
+        "concurrency": concurrency,
+        "errors": errors,
+        "degraded": degraded,
+        "wall_seconds": round(wall, 3),
+        "throughput_rps": round(total / wall, 2) if wall else 0.0,
+        "latency_ms": {
+            "mean": round(sum(ordered) / len(ordered) * 1000, 1) if ordered else 0.0,
+            "p50": round(percentile(ordered, 50) * 1000, 1),
+            "p90": round(percentile(ordered, 90) * 1000, 1),
+            "p95": round(percentile(ordered, 95) * 1000, 1),
+            "p99": round(percentile(ordered, 99) * 1000, 1),
+            "max": round(ordered[-1] * 1000, 1) if ordered else 0.0,
+        },
+        "processes": processes,
+    }
+
+
+# === 合成索引 ===
+
+def ensure_fixture_index(storage: str, api_base: str):
+    """storage目录下没有索引时，用替身embedding构建一个小型合成索引"""
+    if os.path.exists(os.path.join(storage, "docstore.json")):
+        return
+    print(f"🔨 构建压测用合成索引: {storage}")
+    from llama_index.core import VectorStoreIndex
+    from llama_index.core.schema import TextNode
+    from openai_clients import PooledOpenAIEmbedding
+    from rag_index_version import bump_index_version
+
+    nodes = []
+    for file_path, topic in SAMPLE_SOURCES:
+        for i in range(40):
+            nodes.append(TextNode(
+                text=f"{topic}。第{i + 1}节：" + f"在亲密关系中识别{topic}的具体表现，并给出应对建议。" * 8,
+                metadata={"file_path": file_path, "page_label": str(i + 1)},
+            ))
+    embed_model = PooledOpenAIEmbedding(api_key="sk-load-test", api_base=api_base, embed_batch_size=50)
+    index = VectorStoreIndex(nodes, embed_model=embed_model)
+    index.storage_context.persist(persist_dir=storage)
+    bump_index_version(storage)
+
+
+# === 压测目标 ===
+
+def run_spawn(payloads: List[dict], args, env: dict, workdir: str) -> dict:
+    """每个请求启动一个查询进程；资源数据取自每个子进程退出时的rusage"""
+    latencies, rusages = [], []
+    errors = degraded = 0
+    lock = threading.Lock()
+
+    def one(user_info: dict):
+        nonlocal errors, degraded
+        request = json.dumps(to_rag_request(user_info, args.deadline_ms), ensure_ascii=False)
+        started = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, ENHANCED_SCRIPT, request], cwd=workdir, env=env,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        output = proc.stdout.read()
+        proc.stdout.close()
+        # 用wait4回收子进程以获得该进程自身的rusage
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        elapsed = time.perf_counter() - started
+
+        frames = parse_frames(output)
+        ok = "report" in frames and "error" not in frames
+        with lock:
+            rusages.append(rusage)
+            if not ok:
+                errors += 1
+                return
+            latencies.append(elapsed)
+            if frames.get("retrieval", {}).get("rag_analysis", {}).get("degraded"):
+                degraded += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(one, payloads))
+    wall = time.perf_counter() - started
+
+    # Linux上ru_maxrss单位为KB
+    cpu = [r.ru_utime + r.ru_stime for r in rusages]
+    processes = [{
+        "role": "查询进程（每请求一个）",
+        "processes": len(rusages),
+        "peak_rss_mb": round(max(r.ru_maxrss for r in rusages) / 1024, 1),
+        "mean_rss_mb": round(sum(r.ru_maxrss for r in rusages) / len(rusages) / 1024, 1),
+        "cpu_seconds": round(sum(cpu), 3),
+        "cpu_seconds_per_request": round(sum(cpu) / len(cpu), 3),
+        "cpu_percent": round(sum(cpu) / wall * 100, 1),
+    }] if rusages else []
+    return summarize("spawn", latencies, errors, degraded, wall, args.concurrency, processes)
+
+
+async def _run_worker(payloads: List[dict], args, env: dict, workdir: str) -> dict:
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, ENHANCED_SCRIPT, "--worker", cwd=workdir, env=env,
+        stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL,
+        limit=16 * 1024 * 1024,
+    )
+    pending: Dict[str, asyncio.Future] = {}
+
+    async def read_responses():
+        while True:
+            line = await proc.stdout.readline()
+            if not line:
+                break
+            response = json.loads(line)
+            future = pending.pop(str(response.get("id")), None)
+            if future is not None and not future.done():
+                future.set_result(response)
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(RuntimeError("worker进程已退出"))
+
+    async def send(request_id: str, user_info: dict) -> dict:
+        request = to_rag_request(user_info, args.deadline_ms)
+        request["id"] = request_id
+        future = asyncio.get_running_loop().create_future()
+        pending[request_id] = future
+        proc.stdin.write((json.dumps(request, ensure_ascii=False) + "\n").encode("utf-8"))
+        await proc.stdin.drain()
+        return await future
+
+    reader = asyncio.create_task(read_responses())
+    # 预热：首个请求包含索引加载，不计入结果
+    await send("warmup", payloads[0])
+
+    sampler = ProcessSampler(proc.pid, "worker").start()
+    latencies = []
+    errors = degraded = 0
+    queue = list(enumerate(payloads))
+
+    async def client():
+        nonlocal errors, degraded
+        while queue:
+            i, user_info = queue.pop()
+            started = time.perf_counter()
+            try:
+                response = await send(str(i), user_info)
+            except RuntimeError:
+                errors += 1
+                continue
+            if not response.get("success"):
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+            if response["data"]["rag_analysis"].get("degraded"):
+                degraded += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(args.concurrency)))
+    wall = time.perf_counter() - started
+    processes = [sampler.stop(wall)]
+
+    proc.stdin.close()
+    await proc.wait()
+    await reader
+    return summarize("worker", latencies, errors, degraded, wall, args.concurrency, processes)
+
+
+def run_worker(payloads: List[dict], args, env: dict, workdir: str) -> dict:
+    """常驻worker：预热后按并发度保持在途请求数"""
+    return asyncio.run(_run_worker(payloads, args, env, workdir))
+
+
+def _wait_http(url: str, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=1):
+                return
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.2)
+    raise RuntimeError(f"服务未在 {timeout:.0f}s 内就绪: {url}")
+
+
+def run_flask(payloads: List[dict], args, env: dict, workdir: str) -> dict:
+    """Flask报告端点（threaded开发服务器，关闭debug重载）"""
+    runner = (
+        "import sys; sys.path.insert(0, 'api'); "
+        "from generate_warning_report import app; "
+        f"app.run(host='127.0.0.1', port={args.flask_port}, threaded=True)"
+    )
+    proc = subprocess.Popen([sys.executable, "-c", runner], cwd=ROOT_DIR, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = f"http://127.0.0.1:{args.flask_port}"
+    try:
+        _wait_http(f"{base}/api/health", timeout=60)
+
+        def post(user_info: dict) -> Tuple[bool, float]:
+            body = json.dumps(to_flask_request(user_info), ensure_ascii=False).encode("utf-8")
+            request = urllib.request.Request(f"{base}/api/generate_warning_report", data=body,
+                                             headers={"Content-Type": "application/json"})
+            started = time.perf_counter()
+            try:
+                with urllib.request.urlopen(request, timeout=args.deadline_ms / 1000.0) as response:
+                    ok = json.loads(response.read()).get("success", False)
+            except (urllib.error.URLError, ConnectionError, TimeoutError, ValueError):
+                ok = False
+            return ok, time.perf_counter() - started
+
+        post(payloads[0])  # 预热
+
+        sampler = ProcessSampler(proc.pid, "flask").start()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            results = list(pool.map(post, payloads))
+        wall = time.perf_counter() - started
+        processes = [sampler.stop(wall)]
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    latencies = [elapsed for ok, elapsed in results if ok]
+    errors = sum(1 for ok, _ in results if not ok)
+    return summarize("flask", latencies, errors, 0, wall, args.concurrency, processes)
+
+
+RUNNERS = {"spawn": run_spawn, "worker": run_worker, "flask": run_flask}
+
+
+def print_summary(result: dict, upstream: dict):
+    latency = result["latency_ms"]
+    print(f"\n📊 {result['target']}: {result['requests']} 个请求, 并发 {result['concurrency']}, "
+          f"耗时 {result['wall_seconds']}s")
+    print(f"   吞吐 {result['throughput_rps']} req/s, 错误 {result['errors']}, 降级 {result['degraded']}")
+    print(f"   延迟(ms) mean {latency['mean']}  p50 {latency['p50']}  p90 {latency['p90']}  "
+          f"p95 {latency['p95']}  p99 {latency['p99']}  max {latency['max']}")
+    for process in result["processes"]:
+        line = (f"   进程[{process['role']}] x{process['processes']}: 内存峰值 {process['peak_rss_mb']}MB, "
+                f"CPU {process['cpu_seconds']}s ({process['cpu_percent']}%)")
+        if "cpu_seconds_per_request" in process:
+            line += f", 平均内存 {process['mean_rss_mb']}MB, 每请求CPU {process['cpu_seconds_per_request']}s"
+        print(line)
+    print(f"   上游调用: embeddings {upstream['embeddings']}, chat {upstream['chat_completions']}, "
+          f"429 {upstream['rate_limited']}, 500 {upstream['errors']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="模拟server.js扫描流量的压测工具")
+    parser.add_argument("--target", choices=TARGETS + ("all",), default="all")
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--fixtures", default=DEFAULT_FIXTURES, help="user_info请求fixture（JSON Lines）")
+    parser.add_argument("--workdir", default=DEFAULT_WORKDIR,
+                        help="spawn/worker的工作目录，索引位于其中的storage/，不存在时构建合成索引")
+    parser.add_argument("--deadline-ms", type=int, default=60000, help="请求截止时间（与server.js的RAG_DEADLINE_MS一致）")
+    parser.add_argument("--embedding-latency-ms", default="80", help="固定值或 uniform/normal/lognormal:a:b")
+    parser.add_argument("--chat-latency-ms", default="1500", help="固定值或 uniform/normal/lognormal:a:b")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="OpenAI替身返回500的请求比例")
+    parser.add_argument("--rate-limit-every", type=int, default=0, help="OpenAI替身每N个请求出现一次429突发")
+    parser.add_argument("--rate-limit-burst", type=int, default=0, help="每次429突发的请求数")
+    parser.add_argument("--flask-port", type=int, default=5099)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", dest="json_path", help="将结果写入JSON文件")
+    args = parser.parse_args()
+
+    fixtures = load_payloads(args.fixtures)
+    rng = random.Random(args.seed)
+    payloads = [rng.choice(fixtures) for _ in range(args.requests)]
+
+    fake = FakeOpenAIServer(embedding_latency_ms=args.embedding_latency_ms,
+                            chat_latency_ms=args.chat_latency_ms,
+                            error_rate=args.error_rate,
+                            rate_limit_every=args.rate_limit_every,
+                            rate_limit_burst=args.rate_limit_burst,
+                            seed=args.seed).start()
+    print(f"🧪 OpenAI替身: {fake.api_base}")
+
+    env = dict(os.environ)
+    env.update({
+        "OPENAI_API_KEY": "sk-load-test",
+        "OPENAI_API_BASE": fake.api_base,
+        "RAG_LOG_LEVEL": "WARNING",
+        "PYTHONUNBUFFERED": "1",
+    })
+    workdir = os.path.abspath(args.workdir)
+    targets = TARGETS if args.target == "all" else (args.target,)
+
+    results = []
+    try:
+        if "spawn" in targets or "worker" in targets:
+            ensure_fixture_index(os.path.join(workdir, "storage"), fake.api_base)
+        for target in targets:
+            before = dict(fake.request_counts)
+            print(f"🚀 压测 {target} ...")
+            result = RUNNERS[target](payloads, args, env, workdir)
+            upstream = {key: fake.request_counts[key] - before[key] for key in before}
+            result["upstream_calls"] = upstream
+            print_summary(result, upstream)
+            results.append(result)
+    finally:
+        fake.stop()
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 结果已写入 {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -11,10 +11,16 @@ load_dotenv()
 
 import os
 import sys
+import json
+import time
+import shutil
 from pathlib import Path
-from typing import List, Any
+from typing import List, Any, Dict, Iterable, Optional
 import logging
 
+import openai
+from openai_clients import resolve_api_base
+
 # 环境检查：确保使用OpenAI API代理
 def validate_environment():
     """验证环境配置，确保OpenAI API密钥可用"""
@@ -26,8 +32,8 @@ def validate_environment():
         print('格式: OPENAI_API_KEY="sk-your_api_key_here"')
         sys.exit(1)
     
-    # 设置OpenAI代理配置
-    proxy_base_url = "https://api.gptsapi.net/v1"
+    # 设置OpenAI代理配置（可通过OPENAI_API_BASE指向其他代理或本地替身）
+    proxy_base_url = resolve_api_base()
     os.environ["OPENAI_API_BASE"] = proxy_base_url
     
     print("✅ 环境验证通过，已配置OpenAI API代理")
@@ -43,9 +49,21 @@ from llama_index.core import (
     SimpleDirectoryReader, 
     StorageContext,
     load_index_from_storage,
-    Settings
+    Settings,
+    Document
+)
+from llama_index.core.readers.file.base import default_file_metadata_func
+from llama_index.core.schema import MetadataMode
+
+from rag_build_checkpoint import EmbeddingCheckpoint, BuildProgress
+from rag_index_version import (
+    atomic_write_json, bump_index_version, index_persist_dir, next_version_dir, prune_index_versions
 )
-from llama_index.embeddings.openai import OpenAIEmbedding
+from rag_knowledge_watcher import KnowledgeWatcher, scan_knowledge_files
+from rag_parse_cache import ParsedDocumentCache, STAT_METADATA_KEYS, file_sha256
+from rag_build_report import BuildReport
+from token_counter import count_tokens
+from openai_clients import PooledOpenAIEmbedding
 
 # 设置日志
 logging.basicConfig(
@@ -61,18 +79,32 @@ logger = logging.getLogger(__name__)
 class RAGSystemBuilder:
     """RAG系统构建器 - OpenAI代理版本"""
     
-    def __init__(self, knowledge_path: str = "my_knowledge", storage_path: str = "storage"):
+    # 每批提交embedding的文本块数量（每批完成后写入一次检查点）
+    CHECKPOINT_BATCH_SIZE = 50
+    # 批处理失败后的重试次数与初始退避秒数（重试只在这一层进行，embedding客户端自身不重试）
+    BATCH_RETRIES = 5
+    BATCH_RETRY_BACKOFF = 5.0
+    
+    def __init__(self, knowledge_path: str = "my_knowledge", storage_path: str = "storage",
+                 resume: bool = True, chunk_size: int = 1024, chunk_overlap: int = 100):
         """
         初始化RAG系统构建器
         
         Args:
             knowledge_path: 知识库文件夹路径
             storage_path: 索引存储路径
+            resume: 是否从上次中断的embedding检查点继续
+            chunk_size: 文本块大小
+            chunk_overlap: 文本块重叠大小
         """
         self.knowledge_path = Path(knowledge_path)
         self.storage_path = Path(storage_path)
         self.index = None
         self.query_engine = None
+        self.resume = resume
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.report = BuildReport()
         
         # 创建存储目录
         self.storage_path.mkdir(exist_ok=True)
@@ -84,24 +116,25 @@ class RAGSystemBuilder:
         """配置LlamaIndex全局设置 - OpenAI代理版本"""
         logger.info("⚙️ 配置LlamaIndex全局设置...")
         
-        # 创建OpenAI Embedding实例，使用代理地址
-        self.embed_model = OpenAIEmbedding(
+        # 创建OpenAI Embedding实例，使用代理地址（共享keep-alive连接池）
+        self.embed_model = PooledOpenAIEmbedding(
             model="text-embedding-3-small",  # 使用高效的embedding模型
             api_key=api_key,
-            api_base="https://api.gptsapi.net/v1",  # 使用正确的代理地址
+            api_base=base_url,  # 使用正确的代理地址
             embed_batch_size=10,  # 减少批处理大小以避免速率限制
-            max_retries=5  # 增加重试次数
+            max_retries=0  # 由_embed_batch重试，429退避计入构建报告
         )
         
         # 设置全局配置
         Settings.embed_model = self.embed_model
         Settings.llm = None  # 明确禁用LLM（在后端处理）
-        Settings.chunk_size = 1024
-        Settings.chunk_overlap = 100
+        Settings.chunk_size = self.chunk_size
+        Settings.chunk_overlap = self.chunk_overlap
         
         logger.info("✅ LlamaIndex配置完成")
         logger.info(f"🧠 Embedding模型: text-embedding-3-small")
         logger.info(f"🔗 API代理地址: {base_url}")
+        logger.info(f"✂️ 文本块设置: chunk_size={self.chunk_size}, chunk_overlap={self.chunk_overlap}")
         logger.info("🚫 LLM已禁用，将在后端处理")
     
     def check_knowledge_base(self) -> bool:
@@ -120,6 +153,8 @@ class RAGSystemBuilder:
                 logger.info(f"📁 发现 {count} 个 {ext} 文件")
                 file_count += count
         
+        self.report.files_discovered = file_count
+        
         if file_count == 0:
             logger.error("❌ 未发现任何支持的文档文件(.pdf, .txt, .docx)")
             return False
@@ -132,15 +167,9 @@ class RAGSystemBuilder:
         logger.info("📚 开始加载文档...")
         
         try:
-            # 使用SimpleDirectoryReader递归加载所有支持的文档
-            reader = SimpleDirectoryReader(
-                input_dir=str(self.knowledge_path),
-                recursive=True,
-                required_exts=[".pdf", ".txt", ".docx"],
-                encoding="utf-8"
-            )
-            
-            documents = reader.load_data()
+            # 递归加载所有支持的文档（已解析过的文件直接使用解析缓存）
+            file_paths = sorted(scan_knowledge_files(self.knowledge_path))
+            documents = self._load_files(file_paths)
             
             if not documents:
                 logger.error("❌ 未能加载任何文档！")
@@ -163,16 +192,24 @@ class RAGSystemBuilder:
             return None
     
     def build_index(self, documents):
-        """构建向量索引 - 使用OpenAI Embedding"""
+        """构建向量索引 - 使用OpenAI Embedding，支持检查点断点续传"""
         logger.info("🏗️ 开始构建向量索引...")
         logger.info(f"🧠 使用模型: text-embedding-3-small")
         logger.info(f"🔗 API代理地址: {base_url}")
         logger.info("⏳ 开始处理文档，这可能需要一些时间...")
         
         try:
-            # 使用OpenAI embedding模型创建向量索引
-            self.index = VectorStoreIndex.from_documents(
-                documents,
+            # 切分文档为文本块（与VectorStoreIndex.from_documents使用相同的node_parser）
+            nodes = Settings.node_parser.get_nodes_from_documents(documents, show_progress=True)
+            logger.info(f"🧩 文档切分完成，共 {len(nodes)} 个文本块")
+            self.report.record_chunks(nodes)
+            
+            if not self._embed_nodes(nodes):
+                return False
+            
+            # 所有文本块已带有embedding，VectorStoreIndex不会再次调用API
+            self.index = VectorStoreIndex(
+                nodes,
                 embed_model=self.embed_model,  # 明确指定我们的embedding模型
                 show_progress=True,
                 use_async=False  # 避免并发问题
@@ -186,27 +223,333 @@ class RAGSystemBuilder:
             logger.error(f"详细错误信息: {repr(e)}")
             return False
     
-    def save_index(self):
-        """持久化保存索引"""
+    def _embed_nodes(self, nodes) -> bool:
+        """为文本块计算embedding，每批完成后写入检查点，支持断点续传"""
+        checkpoint = EmbeddingCheckpoint(self.storage_path, self.embed_model.model_name)
+        
+        try:
+            # 加载检查点，复用已经计算过的embedding
+            if self.resume:
+                restored = checkpoint.load()
+                if restored:
+                    logger.info(f"♻️ 从检查点恢复 {restored} 个embedding")
+            else:
+                checkpoint.clear()
+            
+            pending = []
+            for node in nodes:
+                key = checkpoint.chunk_key(
+                    self.embed_model.model_name,
+                    node.get_content(metadata_mode=MetadataMode.EMBED)
+                )
+                embedding = checkpoint.get(key)
+                if embedding is not None:
+                    node.embedding = embedding
+                else:
+                    pending.append((key, node))
+            
+            progress = BuildProgress(total=len(nodes), already_done=len(nodes) - len(pending))
+            self.report.chunks_from_checkpoint += progress.done
+            logger.info(f"📌 待计算embedding: {len(pending)} 个，已完成: {progress.done} 个")
+            
+            # 分批计算embedding，每批完成后立即写入检查点
+            for start in range(0, len(pending), self.CHECKPOINT_BATCH_SIZE):
+                batch = pending[start:start + self.CHECKPOINT_BATCH_SIZE]
+                texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for _, node in batch]
+                embeddings = self._embed_batch(texts)
+                
+                for (_, node), embedding in zip(batch, embeddings):
+                    node.embedding = embedding
+                checkpoint.save_batch([key for key, _ in batch], embeddings)
+                progress.update(len(batch))
+            
+            checkpoint.close()
+            return True
+            
+        except Exception as e:
+            checkpoint.close()
+            logger.error(f"❌ Embedding计算失败: {str(e)}")
+            logger.error(f"详细错误信息: {repr(e)}")
+            if checkpoint.embeddings_file.exists():
+                logger.info(f"💾 已计算的embedding保存在检查点: {checkpoint.checkpoint_dir}")
+                logger.info("💡 重新运行构建命令将从断点继续")
+            return False
+    
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        """计算一批文本的embedding，失败时指数退避重试，并记录到构建报告"""
+        requests = -(-len(texts) // self.embed_model.embed_batch_size)
+        backoff = self.BATCH_RETRY_BACKOFF
+        
+        for attempt in range(self.BATCH_RETRIES + 1):
+            started = time.monotonic()
+            try:
+                embeddings = self.embed_model.get_text_embedding_batch(texts)
+            except Exception as e:
+                if attempt >= self.BATCH_RETRIES:
+                    raise
+                throttled = isinstance(e, openai.RateLimitError)
+                if throttled:
+                    # 服务端给出Retry-After时至少等待该时长
+                    retry_after = e.response.headers.get("retry-after")
+                    try:
+                        backoff = max(backoff, float(retry_after))
+                    except (TypeError, ValueError):
+                        pass
+                logger.warning(f"⚠️ Embedding批处理失败，{backoff:.0f} 秒后重试 ({attempt + 1}/{self.BATCH_RETRIES}): {str(e)}")
+                self.report.record_retry(requests, backoff, throttled)
+                time.sleep(backoff)
+                backoff *= 2
+                continue
+            
+            self.report.record_embedding_batch(
+                chunks=len(texts),
+                tokens=sum(count_tokens(text, "text-embedding-3-small") for text in texts),
+                requests=requests,
+                seconds=time.monotonic() - started
+            )
+            return embeddings
+    
+    def save_index(self) -> Optional[str]:
+        """
+        持久化保存索引到下一个版本的独立目录（发布前查询服务不会读取该目录）
+        
+        Returns:
+            索引目录（相对storage_path，传给bump_index_version发布），失败时返回None
+        """
         if not self.index:
             logger.error("❌ 没有可保存的索引")
-            return False
+            return None
         
-        logger.info("💾 保存索引到本地存储...")
+        index_dir = next_version_dir(self.storage_path)
+        target_path = self.storage_path / index_dir
+        staging_path = self.storage_path / ".staging"
+        logger.info(f"💾 保存索引到本地存储: {target_path}")
+        
+        started = time.monotonic()
         
         try:
-            # 保存索引到指定目录
-            self.index.storage_context.persist(persist_dir=str(self.storage_path))
-            logger.info(f"✅ 索引已保存到: {self.storage_path}")
-            return True
+            # 先写入临时目录再整体重命名，目录中的存储文件总是同一版本
+            shutil.rmtree(staging_path, ignore_errors=True)
+            self.index.storage_context.persist(persist_dir=str(staging_path))
+            # 上次未发布的同名目录（构建中断）直接覆盖
+            shutil.rmtree(target_path, ignore_errors=True)
+            target_path.parent.mkdir(parents=True, exist_ok=True)
+            os.rename(staging_path, target_path)
+            self.report.record_persist(time.monotonic() - started, target_path)
+            
+            logger.info(f"✅ 索引已保存到: {target_path}")
+            return index_dir
             
         except Exception as e:
             logger.error(f"❌ 索引保存失败: {str(e)}")
+            shutil.rmtree(staging_path, ignore_errors=True)
+            return None
+    
+    def publish_index(self, index_dir: str, changed_files: Optional[List[str]] = None) -> int:
+        """原子地发布新版本（写入版本文件），清理旧版本目录并导出紧凑索引"""
+        version = bump_index_version(self.storage_path, changed_files, index_dir)
+        prune_index_versions(self.storage_path)
+        self.export_compact(version)
+        return version
+    
+    def export_compact(self, version: int):
+        """导出紧凑索引（storage/compact），供Flask报告函数进程内检索；失败不影响构建"""
+        try:
+            from compact_index import export_compact_index
+            meta = export_compact_index(
+                self.index, str(self.storage_path / "compact"), self.embed_model.model_name, version
+            )
+            logger.info(f"📦 紧凑索引已导出: {meta['count']} 个片段")
+        except Exception as e:
+            logger.warning(f"⚠️ 紧凑索引导出失败: {str(e)}")
+    
+    # ===== 增量导入（监听模式） =====
+    
+    @property
+    def manifest_path(self) -> Path:
+        """已导入文件清单：{文件绝对路径: {"hash": 内容哈希, "doc_ids": [文档ID]}}"""
+        return self.storage_path / "ingest_manifest.json"
+    
+    def _load_manifest(self) -> Dict[str, Dict[str, Any]]:
+        """读取导入清单；旧索引没有清单时从docstore的ref_doc_info重建"""
+        if self.manifest_path.exists():
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        
+        manifest = {}
+        for doc_id, info in self.index.ref_doc_info.items():
+            file_path = (info.metadata or {}).get("file_path")
+            if not file_path or not os.path.exists(file_path):
+                continue
+            key = str(Path(file_path).resolve())
+            entry = manifest.setdefault(key, {"hash": file_sha256(key), "doc_ids": []})
+            entry["doc_ids"].append(doc_id)
+        return manifest
+    
+    def _record_documents(self, manifest: Dict[str, Dict[str, Any]], documents):
+        """把文档ID按来源文件写入清单"""
+        for doc in documents:
+            file_path = doc.metadata.get("file_path")
+            if not file_path:
+                continue
+            key = str(Path(file_path).resolve())
+            entry = manifest.setdefault(key, {"hash": file_sha256(key), "doc_ids": []})
+            entry["doc_ids"].append(doc.doc_id)
+    
+    def _load_files(self, file_paths: List[str]):
+        """加载指定文件为文档，优先使用解析缓存，未命中时调用SimpleDirectoryReader解析"""
+        cache = ParsedDocumentCache(self.storage_path)
+        documents = []
+        
+        for file_path in file_paths:
+            started = time.monotonic()
+            file_hash = file_sha256(file_path)
+            records = cache.get(file_hash, file_path)
+            cached = records is not None
+            
+            if not cached:
+                reader = SimpleDirectoryReader(input_files=[file_path], encoding="utf-8")
+                parsed = reader.load_data()
+                records = [
+                    {
+                        "text": doc.text,
+                        "metadata": {**doc.metadata, "file_path": file_path},
+                        "excluded_embed_metadata_keys": doc.excluded_embed_metadata_keys,
+                        "excluded_llm_metadata_keys": doc.excluded_llm_metadata_keys,
+                    }
+                    for doc in parsed
+                ]
+                cache.put(file_hash, records)
+            else:
+                # 文件大小、日期等属性按文件当前状态生成（与读取器一致）
+                file_metadata = default_file_metadata_func(file_path)
+                for record in records:
+                    record["metadata"].update(
+                        {k: v for k, v in file_metadata.items() if k in STAT_METADATA_KEYS}
+                    )
+            
+            self.report.record_parse(
+                file_path,
+                size_bytes=os.path.getsize(file_path),
+                seconds=time.monotonic() - started,
+                documents=len(records),
+                cached=cached
+            )
+            documents.extend(
+                Document(
+                    text=record["text"],
+                    metadata=record["metadata"],
+                    excluded_embed_metadata_keys=record["excluded_embed_metadata_keys"],
+                    excluded_llm_metadata_keys=record["excluded_llm_metadata_keys"]
+                )
+                for record in records
+            )
+        
+        logger.info(f"🗃️ 解析缓存: 命中 {cache.hits} 个文件, 重新解析 {cache.misses} 个文件")
+        return documents
+    
+    def ingest_files(self, changed: Iterable[str], removed: Iterable[str]) -> bool:
+        """
+        增量导入新增/修改的文件并删除已移除文件的内容，完成后原子地发布新索引版本
+        
+        Args:
+            changed: 新增或修改的文件路径
+            removed: 已删除的文件路径
+        """
+        manifest = self._load_manifest()
+        self.report = BuildReport(mode="incremental")
+        # 内存中的索引是否已被修改（之后失败时需恢复到已发布的版本）
+        mutated = False
+        
+        try:
+            # 内容未变化的文件（仅修改时间变化）直接跳过；扫描之后被删除或重命名的文件按删除处理
+            to_ingest = []
+            to_remove = [str(Path(p).resolve()) for p in removed]
+            for file_path in changed:
+                key = str(Path(file_path).resolve())
+                try:
+                    file_hash = file_sha256(key)
+                except FileNotFoundError:
+                    to_remove.append(key)
+                    continue
+                if manifest.get(key, {}).get("hash") != file_hash:
+                    to_ingest.append(key)
+            to_remove = [key for key in dict.fromkeys(to_remove) if key in manifest]
+            
+            if not to_ingest and not to_remove:
+                logger.info("💡 文件内容未变化，无需更新索引")
+                return True
+            
+            self.report.files_discovered = len(to_ingest)
+            
+            # 先计算新内容的embedding，失败时内存中的索引和导入清单保持不变
+            documents, nodes = [], []
+            if to_ingest:
+                logger.info(f"📚 增量导入 {len(to_ingest)} 个文件...")
+                documents = self._load_files(to_ingest)
+                nodes = Settings.node_parser.get_nodes_from_documents(documents)
+                self.report.record_chunks(nodes)
+                if not self._embed_nodes(nodes):
+                    return False
+            
+            # 删除旧内容（修改的文件先删除再重新导入）
+            mutated = True
+            for key in to_remove + to_ingest:
+                for doc_id in manifest.pop(key, {}).get("doc_ids", []):
+                    self.index.delete_ref_doc(doc_id, delete_from_docstore=True)
+            if nodes:
+                self.index.insert_nodes(nodes)
+                self._record_documents(manifest, documents)
+            
+            index_dir = self.save_index()
+            if not index_dir:
+                raise RuntimeError("索引保存失败")
+            atomic_write_json(self.manifest_path, manifest)
+            EmbeddingCheckpoint(self.storage_path, self.embed_model.model_name).clear()
+            
+            version = self.publish_index(index_dir, [os.path.relpath(p) for p in to_ingest + to_remove])
+            logger.info(f"🚀 索引已更新到版本 {version}（导入 {len(to_ingest)} 个, 删除 {len(to_remove)} 个文件）")
+            self.report.write(self.storage_path)
+            return True
+            
+        except Exception as e:
+            logger.error(f"❌ 增量导入失败: {str(e)}")
+            logger.error(f"详细错误信息: {repr(e)}")
+            if mutated:
+                # 内存中的改动未发布：重新加载最近发布的版本，与磁盘上的导入清单保持一致
+                logger.warning("↩️ 恢复到最近发布的索引版本")
+                if not self.load_existing_index():
+                    logger.error("❌ 恢复索引失败，请重启监听进程")
+            return False
+    
+    def watch(self, debounce_seconds: float = 3.0, poll_interval: float = 5.0, use_polling: bool = False):
+        """监听知识库目录，持续把新增/修改的文件导入索引"""
+        if not self.index and not self.build_complete_system():
             return False
+        
+        # 先补齐未监听期间发生的变化
+        manifest = self._load_manifest()
+        current = {str(Path(p).resolve()) for p in scan_knowledge_files(self.knowledge_path)}
+        self.ingest_files(sorted(current), sorted(set(manifest) - current))
+        
+        watcher = KnowledgeWatcher(
+            str(self.knowledge_path),
+            on_change=self.ingest_files,
+            debounce_seconds=debounce_seconds,
+            poll_interval=poll_interval,
+            use_polling=use_polling
+        )
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            logger.info("👋 停止监听知识库")
+            watcher.stop()
+        return True
     
     def load_existing_index(self):
         """加载已存在的索引"""
-        if not (self.storage_path / "index_store.json").exists():
+        persist_dir = index_persist_dir(self.storage_path)
+        if not (persist_dir / "index_store.json").exists():
             logger.info("📝 未发现已存在的索引文件")
             return False
         
@@ -216,8 +559,8 @@ class RAGSystemBuilder:
             # 确保使用相同的embedding模型配置
             Settings.embed_model = self.embed_model
             
-            # 从存储中加载索引
-            storage_context = StorageContext.from_defaults(persist_dir=str(self.storage_path))
+            # 从当前发布版本的目录加载索引
+            storage_context = StorageContext.from_defaults(persist_dir=str(persist_dir))
             self.index = load_index_from_storage(storage_context)
             
             logger.info("✅ 成功加载已存在的索引")
@@ -276,6 +619,7 @@ class RAGSystemBuilder:
     def build_complete_system(self, force_rebuild: bool = False):
         """构建完整的RAG系统"""
         logger.info("🚀 开始构建AI情感安全助手RAG系统 (OpenAI代理版本)...")
+        self.report = BuildReport()
         
         # 1. 检查知识库
         if not self.check_knowledge_base():
@@ -295,8 +639,21 @@ class RAGSystemBuilder:
                 return False
             
             # 5. 保存索引
-            if not self.save_index():
+            index_dir = self.save_index()
+            if not index_dir:
                 return False
+            
+            # 索引已持久化，检查点不再需要
+            EmbeddingCheckpoint(self.storage_path, self.embed_model.model_name).clear()
+            
+            # 记录导入清单并发布新版本，通知查询服务重新加载
+            manifest = {}
+            self._record_documents(manifest, documents)
+            atomic_write_json(self.manifest_path, manifest)
+            self.publish_index(index_dir)
+            
+            # 写入构建报告
+            self.report.write(self.storage_path)
         
         # 6. 创建查询引擎
         if not self.create_query_engine():
@@ -323,18 +680,35 @@ def main():
     parser.add_argument("--rebuild", action="store_true", help="强制重建索引")
     parser.add_argument("--knowledge", default="my_knowledge", help="知识库文件夹路径")
     parser.add_argument("--storage", default="storage", help="索引存储路径")
+    parser.add_argument("--fresh", action="store_true", help="丢弃embedding检查点，从头计算")
+    parser.add_argument("--chunk-size", type=int, default=1024, help="文本块大小")
+    parser.add_argument("--chunk-overlap", type=int, default=100, help="文本块重叠大小")
+    parser.add_argument("--watch", action="store_true", help="构建后持续监听知识库并增量导入新文件")
+    parser.add_argument("--debounce", type=float, default=3.0, help="监听模式：文件事件去抖动秒数")
+    parser.add_argument("--poll-interval", type=float, default=5.0, help="监听模式：轮询间隔秒数")
+    parser.add_argument("--polling", action="store_true", help="监听模式：强制使用轮询（不使用inotify）")
     
     args = parser.parse_args()
     
     # 创建RAG构建器
     builder = RAGSystemBuilder(
         knowledge_path=args.knowledge,
-        storage_path=args.storage
+        storage_path=args.storage,
+        resume=not args.fresh,
+        chunk_size=args.chunk_size,
+        chunk_overlap=args.chunk_overlap
     )
     
     # 构建系统
     success = builder.build_complete_system(force_rebuild=args.rebuild)
     
+    if success and args.watch:
+        success = builder.watch(
+            debounce_seconds=args.debounce,
+            poll_interval=args.poll_interval,
+            use_polling=args.polling
+        )
+    
     if success:
         logger.info("✅ RAG系统构建成功！")
         logger.info("💡 下一步：启动后端服务测试查询功能")
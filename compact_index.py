@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+紧凑检索索引
+从LlamaIndex持久化索引导出只读的紧凑格式，供serverless函数在进程内检索（不依赖llama_index）：
+    meta.json       格式版本、向量维度、片段数、embedding模型、索引版本
+    vectors.f16     归一化后的float16向量（小端，片段数 x 维度）
+    docstore.json   片段ID、来源元数据和截断后的文本
+
+加载后的索引在热容器内缓存复用；检索为一次矩阵乘法取top-k，
+多个查询窗口的结果用RRF融合（与query_windows一致）
+
+导出: python compact_index.py [--storage storage] [--output storage/compact]
+"""
+
+import os
+import sys
+import json
+import logging
+import argparse
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from query_windows import reciprocal_rank_fusion
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+META_FILE = "meta.json"
+VECTORS_FILE = "vectors.f16"
+DOCSTORE_FILE = "docstore.json"
+
+# docstore中每个片段保留的文本长度（知识回答和提示词只使用片段开头）
+DOC_TEXT_CHARS = 1000
+
+# 保留的元数据字段
+METADATA_KEYS = ("file_path", "file_name", "page_label")
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError("紧凑索引需要numpy: pip install numpy")
+
+
+class ScoredChunk:
+    """检索结果片段，提供与NodeWithScore相同的常用属性（node、node_id、text、metadata、score）"""
+
+    __slots__ = ("node_id", "text", "metadata", "score")
+
+    def __init__(self, node_id: str, text: str, metadata: Dict[str, Any], score: float):
+        self.node_id = node_id
+        self.text = text
+        self.metadata = metadata
+        self.score = score
+
+    @property
+    def node(self) -> "ScoredChunk":
+        return self
+
+
+class CompactIndex:
+    """只读的紧凑向量索引"""
+
+    def __init__(self, vectors, docs: List[Dict[str, Any]], meta: Dict[str, Any]):
+        self.vectors = vectors
+        self.docs = docs
+        self.meta = meta
+
+    @property
+    def version(self) -> int:
+        return int(self.meta.get("index_version", 0))
+
+    @property
+    def embedding_model(self) -> Optional[str]:
+        return self.meta.get("embedding_model")
+
+    @classmethod
+    def load(cls, path: str) -> "CompactIndex":
+        _require_numpy()
+        path = Path(path)
+        meta = json.loads((path / META_FILE).read_text(encoding="utf-8"))
+        if meta.get("format") != FORMAT_VERSION:
+            raise ValueError(f"不支持的紧凑索引格式: {meta.get('format')}")
+        docs = json.loads((path / DOCSTORE_FILE).read_text(encoding="utf-8"))
+
+        # float16存储，加载后转为float32计算
+        vectors = np.fromfile(path / VECTORS_FILE, dtype="<f2").reshape(meta["count"], meta["dim"])
+        vectors = vectors.astype(np.float32)
+        if len(docs) != meta["count"]:
+            raise ValueError(f"紧凑索引损坏: 向量 {meta['count']} 条，文档 {len(docs)} 条")
+        return cls(vectors, docs, meta)
+
+    def search(self, embedding: List[float], top_k: int) -> List[ScoredChunk]:
+        """余弦相似度top-k（向量已归一化）"""
+        if not self.docs:
+            return []
+        query = np.asarray(embedding, dtype=np.float32)
+        norm = float(np.linalg.norm(query)) or 1.0
+        scores = self.vectors @ (query / norm)
+
+        top_k = min(top_k, len(self.docs))
+        top = np.argpartition(-scores, top_k - 1)[:top_k]
+        top = top[np.argsort(-scores[top])]
+        return [
+            ScoredChunk(self.docs[i]["id"], self.docs[i]["text"], self.docs[i]["metadata"], float(scores[i]))
+            for i in top
+        ]
+
+    def search_windows(self, embeddings: List[List[float]], top_k: int) -> List[ScoredChunk]:
+        """逐窗口检索后RRF融合"""
+        ranked_lists = [self.search(embedding, top_k) for embedding in embeddings]
+        if len(ranked_lists) == 1:
+            return ranked_lists[0]
+        return reciprocal_rank_fusion(ranked_lists)[:top_k]
+
+
+_cache: Dict[str, CompactIndex] = {}
+_cache_lock = threading.Lock()
+
+
+def get_compact_index(path: str) -> CompactIndex:
+    """按路径缓存已加载的索引（热容器内只加载一次）"""
+    path = os.path.abspath(path)
+    index = _cache.get(path)
+    if index is not None:
+        return index
+    with _cache_lock:
+        if path not in _cache:
+            _cache[path] = CompactIndex.load(path)
+            logger.info("📦 已加载紧凑索引: %s (%d 个片段, 版本 %d)",
+                        path, len(_cache[path].docs), _cache[path].version)
+        return _cache[path]
+
+
+def is_loaded(path: str) -> bool:
+    return os.path.abspath(path) in _cache
+
+
+def index_meta(path: str) -> Dict[str, Any]:
+    """索引meta：已加载时直接返回，否则只读取meta.json（不加载向量，可与embedding并发进行）"""
+    index = _cache.get(os.path.abspath(path))
+    if index is not None:
+        return index.meta
+    return json.loads((Path(path) / META_FILE).read_text(encoding="utf-8"))
+
+
+def write_compact_index(output_dir: str, vectors: List[Any], docs: List[Dict[str, Any]], embedding_model: str,
+                        index_version: int = 0) -> Dict[str, Any]:
+    """
+    写出紧凑索引文件
+
+    Args:
+        output_dir: 输出目录
+        vectors: 与docs一一对应的向量（写入前归一化）
+        docs: [{"id", "text", "metadata"}]
+        embedding_model: 构建索引使用的embedding模型（查询时必须一致）
+        index_version: 索引版本号
+
+    Returns:
+        写入的meta
+    """
+    from rag_index_version import atomic_write_json
+
+    _require_numpy()
+    output = Path(output_dir)
+    output.mkdir(parents=True, exist_ok=True)
+
+    normalized = []
+    for vector in vectors:
+        vector = np.asarray(vector, dtype=np.float32)
+        normalized.append(vector / (float(np.linalg.norm(vector)) or 1.0))
+
+    dim = len(normalized[0]) if normalized else 0
+    matrix = np.vstack(normalized).astype("<f2") if normalized else np.zeros((0, 0), dtype="<f2")
+    meta = {
+        "format": FORMAT_VERSION,
+        "dim": dim,
+        "count": len(docs),
+        "dtype": "float16",
+        "embedding_model": embedding_model,
+        "index_version": index_version,
+        "created_at": datetime.now().isoformat(),
+    }
+
+    # 先写向量和文档，最后写meta（读取方以meta为准）
+    tmp_vectors = output / (VECTORS_FILE + ".tmp")
+    matrix.tofile(tmp_vectors)
+    os.replace(tmp_vectors, output / VECTORS_FILE)
+    atomic_write_json(output / DOCSTORE_FILE, docs)
+    atomic_write_json(output / META_FILE, meta)
+    return meta
+
+
+def export_compact_index(index, output_dir: str, embedding_model: str, index_version: int = 0,
+                         text_chars: int = DOC_TEXT_CHARS) -> Dict[str, Any]:
+    """
+    将LlamaIndex VectorStoreIndex导出为紧凑格式
+
+    Args:
+        index: 已加载的VectorStoreIndex（默认SimpleVectorStore）
+        output_dir: 输出目录
+        embedding_model: 构建索引使用的embedding模型（查询时必须一致）
+        index_version: 索引版本号
+
+    Returns:
+        写入的meta
+    """
+    docs, vectors = [], []
+    for node_id in index.index_struct.nodes_dict.values():
+        node = index.docstore.get_node(node_id)
+        vectors.append(index.vector_store.get(node_id))
+        docs.append({
+            "id": node_id,
+            "text": node.get_content()[:text_chars],
+            "metadata": {key: node.metadata[key] for key in METADATA_KEYS if key in node.metadata},
+        })
+    return write_compact_index(output_dir, vectors, docs, embedding_model, index_version)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="导出紧凑检索索引")
+    parser.add_argument("--storage", default="storage", help="LlamaIndex持久化索引目录")
+    parser.add_argument("--output", default=None, help="输出目录（默认<storage>/compact）")
+    parser.add_argument("--embedding-model", default="text-embedding-3-small")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    from llama_index.core import StorageContext, load_index_from_storage
+    from llama_index.core.embeddings import MockEmbedding
+    from rag_index_version import index_persist_dir, read_index_version
+
+    output = args.output or os.path.join(args.storage, "compact")
+    # 导出只读取已有向量，不调用embedding接口
+    version_info = read_index_version(args.storage) or {}
+    index = load_index_from_storage(
+        StorageContext.from_defaults(persist_dir=str(index_persist_dir(args.storage, version_info))),
+        embed_model=MockEmbedding(embed_dim=1)
+    )
+    meta = export_compact_index(index, output, args.embedding_model, int(version_info.get("version", 0)))
+
+    size = sum(f.stat().st_size for f in Path(output).iterdir() if f.is_file())
+    logger.info("✅ 紧凑索引已导出: %s (%d 个片段, %d 维, %.1f MB)",
+                output, meta["count"], meta["dim"], size / 1024 / 1024)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
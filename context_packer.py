@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+上下文打包规划模块
+按真实token数计算查询、候选文档片段和报告提示词的占用，
+在给定预算内按"相关性得分/token"贪心选择片段，保证提示词不会超出上下文窗口
+"""
+
+from typing import Any, Dict, List
+
+from token_counter import count_tokens, truncate_to_tokens
+
+# 片段之间的分隔符
+SNIPPET_SEPARATOR = "\n\n"
+
+# 交给报告生成阶段的知识库提示词
+REPORT_PROMPT_TEMPLATE = "以下是与分析问题相关的专业知识库资料：\n{context}\n\n分析问题：{query}"
+
+
+class ContextPacker:
+    """上下文打包器 - 在token预算内选择价值最高的检索片段"""
+
+    def __init__(self, context_window: int = 8192, num_output: int = 512,
+                 prompt_template: str = "", max_query_tokens: int = 512,
+                 min_score: float = 0.0, min_snippet_tokens: int = 32,
+                 model: str = "gpt-4o"):
+        """
+        Args:
+            context_window: 模型上下文窗口大小
+            num_output: 为模型输出预留的token数
+            prompt_template: 报告提示词模板（不含查询和片段），其token数计入固定开销
+            max_query_tokens: 查询本身最多占用的token数
+            min_score: 低于该相关性得分的片段直接丢弃
+            min_snippet_tokens: 截断后短于该长度的片段不再放入
+            model: 用于计数的模型名称
+        """
+        self.context_window = context_window
+        self.num_output = num_output
+        self.prompt_template = prompt_template
+        self.max_query_tokens = max_query_tokens
+        self.min_score = min_score
+        self.min_snippet_tokens = min_snippet_tokens
+        self.model = model
+
+    def _tokens(self, text: str) -> int:
+        return count_tokens(text, self.model)
+
+    def pack(self, query: str, candidates: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        规划上下文
+
+        Args:
+            query: 查询文本
+            candidates: 候选片段列表，每项至少包含"text"和"score"
+
+        Returns:
+            {"query": 查询, "selected": 选中的片段, "dropped": 丢弃的片段,
+             "context": 拼接后的上下文, "tokens": 各部分token统计}
+        """
+        query = truncate_to_tokens(query, self.max_query_tokens, self.model)
+        template_tokens = self._tokens(self.prompt_template)
+        query_tokens = self._tokens(query)
+        separator_tokens = self._tokens(SNIPPET_SEPARATOR)
+        budget = max(0, self.context_window - self.num_output - template_tokens - query_tokens)
+
+        # 计算每个候选片段的token数与单位token价值
+        scored = []
+        dropped = []
+        for candidate in candidates:
+            score = float(candidate.get("score") or 0.0)
+            if score < self.min_score or not candidate.get("text"):
+                dropped.append(candidate)
+                continue
+            tokens = self._tokens(candidate["text"]) + separator_tokens
+            scored.append((score / tokens, score, tokens, candidate))
+
+        # 贪心：按得分/token从高到低放入
+        scored.sort(key=lambda item: item[0], reverse=True)
+        selected = []
+        used = 0
+        for item in scored:
+            if used + item[2] <= budget:
+                selected.append(item)
+                used += item[2]
+
+        # 经典贪心的2-近似修正：单个最高分片段优于整个贪心组合时改用它
+        fitting = [item for item in scored if item[2] <= budget]
+        if fitting:
+            best_single = max(fitting, key=lambda item: item[1])
+            if best_single[1] > sum(item[1] for item in selected):
+                selected = [best_single]
+                used = best_single[2]
+
+        # 剩余预算放入未选中的最高分片段：完整放得下时原样放入，否则截断后放入
+        chosen_ids = {id(item[3]) for item in selected}
+        remaining = sorted(
+            (item for item in scored if id(item[3]) not in chosen_ids),
+            key=lambda item: item[1], reverse=True
+        )
+        for item in remaining:
+            score, tokens, candidate = item[1], item[2], item[3]
+            if tokens <= budget - used:
+                selected.append(item)
+                used += tokens
+                continue
+            room = budget - used - separator_tokens
+            if room < self.min_snippet_tokens:
+                dropped.append(candidate)
+                continue
+            truncated = dict(candidate, text=truncate_to_tokens(candidate["text"], room, self.model), truncated=True)
+            truncated_tokens = self._tokens(truncated["text"]) + separator_tokens
+            selected.append((score / truncated_tokens, score, truncated_tokens, truncated))
+            used += truncated_tokens
+
+        # 输出时按相关性排序
+        selected.sort(key=lambda item: item[1], reverse=True)
+        snippets = [item[3] for item in selected]
+
+        return {
+            "query": query,
+            "selected": snippets,
+            "dropped": dropped,
+            "context": SNIPPET_SEPARATOR.join(snippet["text"] for snippet in snippets),
+            "tokens": {
+                "context_window": self.context_window,
+                "output_reserved": self.num_output,
+                "template": template_tokens,
+                "query": query_tokens,
+                "context_budget": budget,
+                "context_used": used
+            }
+        }
@@ -7,6 +7,7 @@ AI情感安全助手 - RAG查询系统 (Cloudflare R2 + Replicate版本)
 
 import os
 import sys
+import asyncio
 from pathlib import Path
 import logging
 from dotenv import load_dotenv
@@ -104,12 +105,12 @@ class ReplicateEmbedding(BaseEmbedding):
         return embeddings
     
     async def _aget_query_embedding(self, query: str) -> List[float]:
-        """异步获取查询embedding"""
-        return self._get_query_embedding(query)
+        """异步获取查询embedding（在线程中执行阻塞调用，不阻塞事件循环）"""
+        return await asyncio.to_thread(self._get_query_embedding, query)
     
     async def _aget_text_embedding(self, text: str) -> List[float]:
-        """异步获取文本embedding"""
-        return self._get_text_embedding(text)
+        """异步获取文本embedding（在线程中执行阻塞调用，不阻塞事件循环）"""
+        return await asyncio.to_thread(self._get_text_embedding, text)
 
 class RAGR2ReplicateQueryService:
     """RAG查询服务类 - Cloudflare R2 + Replicate版本"""
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+R2索引文件本地持久缓存
+按 存储桶 + 对象名 + ETag 缓存从Cloudflare R2下载的索引文件：每次使用前用HEAD请求重新验证，
+只有远端对象变化（ETag不同）时才重新下载，稳态下每次查询只有几个HEAD请求、没有大文件传输
+
+目录结构：
+    <缓存目录>/blobs/<对象哈希>-<ETag>            单个对象的内容
+    <缓存目录>/snapshots/<对象集合哈希>-<ETag哈希>/  一组对象的硬链接，可直接作为persist_dir加载
+
+远端对象变化后，同一对象的旧版本和旧快照会被清理；HEAD请求失败时沿用最近一次的快照
+"""
+
+import os
+import re
+import shutil
+import hashlib
+import logging
+import tempfile
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+# 缓存目录（进程之间共享）
+R2_INDEX_CACHE_DIR = os.getenv("R2_INDEX_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "rag_r2_cache")
+
+_UNSAFE = re.compile(r"[^0-9A-Za-z_.-]")
+
+
+def _digest(*parts: str) -> str:
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()[:16]
+
+
+class R2IndexCache:
+    """R2对象的本地缓存（多进程安全：下载写入临时文件后原子重命名）"""
+
+    def __init__(self, fs, cache_dir: Optional[str] = None):
+        """
+        Args:
+            fs: s3fs.S3FileSystem（或任何提供info/get_file/invalidate_cache的fsspec文件系统）
+            cache_dir: 缓存目录，默认读取R2_INDEX_CACHE_DIR
+        """
+        self.fs = fs
+        self.cache_dir = Path(cache_dir or R2_INDEX_CACHE_DIR)
+        self.blob_dir = self.cache_dir / "blobs"
+        self.snapshot_dir = self.cache_dir / "snapshots"
+        # 本实例的统计：命中、下载次数和下载字节数
+        self.stats = {"hits": 0, "downloads": 0, "bytes": 0}
+
+    def head_etag(self, bucket: str, name: str) -> str:
+        """HEAD请求获取对象当前的ETag（跳过fsspec的元数据缓存）；对象不存在时抛出FileNotFoundError"""
+        remote_path = f"{bucket}/{name}"
+        self.fs.invalidate_cache(remote_path)
+        info = self.fs.info(remote_path)
+        etag = str(info.get("ETag") or info.get("etag") or "").strip('"')
+        if not etag:
+            raise ValueError(f"R2对象缺少ETag: {remote_path}")
+        return etag
+
+    def _blob_path(self, bucket: str, name: str, etag: str) -> Path:
+        return self.blob_dir / f"{_digest(bucket, name)}-{_UNSAFE.sub('_', etag)}"
+
+    def fetch(self, bucket: str, name: str, etag: Optional[str] = None) -> Path:
+        """返回对象当前版本的本地文件，缓存中没有该ETag时下载"""
+        etag = etag or self.head_etag(bucket, name)
+        blob = self._blob_path(bucket, name, etag)
+        if blob.exists():
+            self.stats["hits"] += 1
+            return blob
+
+        self.blob_dir.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=str(self.blob_dir), prefix=".download-")
+        os.close(fd)
+        try:
+            self.fs.get_file(f"{bucket}/{name}", tmp_path)
+            # 下载期间对象被覆盖时，内容与记录的ETag不一致，不能写入缓存
+            current = self.head_etag(bucket, name)
+            if current != etag:
+                raise RuntimeError(f"下载期间R2对象发生变化: {bucket}/{name} ({etag} -> {current})")
+            self.stats["downloads"] += 1
+            self.stats["bytes"] += os.path.getsize(tmp_path)
+            os.replace(tmp_path, blob)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return blob
+
+    def snapshot(self, bucket: str, names: Iterable[str]) -> Path:
+        """
+        返回一组对象当前版本所在的本地目录（文件名与对象名相同）
+
+        只有ETag变化的对象会被下载；重新验证失败（网络错误等）时使用最近一次的快照
+        """
+        names = list(names)
+        group = _digest(bucket, *names)
+        try:
+            etags: Dict[str, str] = {name: self.head_etag(bucket, name) for name in names}
+        except FileNotFoundError:
+            raise
+        except Exception as e:
+            stale = self._latest_snapshot(group)
+            if stale is None:
+                raise
+            logger.warning(f"⚠️ R2重新验证失败，使用本地缓存的索引: {str(e)}")
+            return stale
+
+        target = self.snapshot_dir / f"{group}-{_digest(*(etags[name] for name in names))}"
+        if target.exists():
+            self.stats["hits"] += len(names)
+            return target
+
+        blobs = {name: self.fetch(bucket, name, etags[name]) for name in names}
+        self.snapshot_dir.mkdir(parents=True, exist_ok=True)
+        staging = Path(tempfile.mkdtemp(dir=str(self.snapshot_dir), prefix=".staging-"))
+        try:
+            for name, blob in blobs.items():
+                try:
+                    os.link(blob, staging / name)
+                except OSError:
+                    shutil.copyfile(blob, staging / name)
+            try:
+                os.rename(staging, target)
+            except OSError:
+                # 其他进程已生成同一快照
+                if not target.exists():
+                    raise
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+        self._prune(bucket, names, group, target, etags)
+        return target
+
+    def _latest_snapshot(self, group: str) -> Optional[Path]:
+        if not self.snapshot_dir.exists():
+            return None
+        candidates = [path for path in self.snapshot_dir.glob(f"{group}-*") if path.is_dir()]
+        return max(candidates, key=lambda path: path.stat().st_mtime) if candidates else None
+
+    def _prune(self, bucket: str, names: Iterable[str], group: str, current: Path, etags: Dict[str, str]):
+        """删除同一组对象的旧快照和旧版本文件"""
+        for path in self.snapshot_dir.glob(f"{group}-*"):
+            if path != current:
+                shutil.rmtree(path, ignore_errors=True)
+        for name in names:
+            keep = self._blob_path(bucket, name, etags[name])
+            for path in self.blob_dir.glob(f"{_digest(bucket, name)}-*"):
+                if path != keep:
+                    try:
+                        path.unlink()
+                    except OSError:
+                        pass
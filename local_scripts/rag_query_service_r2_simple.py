@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 """
 简化版 RAG查询服务模块 (Cloudflare R2版本)
-下载R2索引文件到临时目录，然后使用标准方法加载
+R2索引文件缓存在本地持久目录（按ETag重新验证，见r2_index_cache.py），然后使用标准方法加载
 """
 
 # 优先加载环境变量 - 必须在所有其他代码之前
@@ -13,9 +13,6 @@ import os
 import sys
 import json
 import logging
-import tempfile
-import shutil
-from pathlib import Path
 from typing import List, Dict, Any
 
 # 完全禁用所有可能的输出到stdout
@@ -54,6 +51,8 @@ finally:
     # 恢复stdout
     sys.stdout = original_stdout
 
+from r2_index_cache import R2IndexCache
+
 # 配置日志，重定向到stderr避免污染stdout
 logging.basicConfig(
     level=logging.CRITICAL,  # 只输出严重错误
@@ -72,7 +71,7 @@ class RAGR2SimpleQueryService:
         self.index = None
         self.query_engine = None
         self.s3fs = None
-        self.temp_dir = None
+        self.index_dir = None
         
         # 初始化状态
         self.is_initialized = False
@@ -167,14 +166,10 @@ class RAGR2SimpleQueryService:
             raise ValueError(f"连接Cloudflare R2失败: {str(e)}")
     
     def download_and_load_index(self):
-        """从R2下载索引文件到临时目录并加载"""
+        """从本地缓存加载R2索引文件（远端文件变化时才重新下载）"""
         try:
             bucket_name = os.getenv("BUCKET_NAME")
             
-            # 创建临时目录
-            self.temp_dir = tempfile.mkdtemp(prefix="rag_r2_")
-            temp_storage = Path(self.temp_dir)
-            
             # 需要下载的文件
             required_files = [
                 "index_store.json",
@@ -182,29 +177,20 @@ class RAGR2SimpleQueryService:
                 "docstore.json"
             ]
             
-            # 下载必需文件
-            for filename in required_files:
-                remote_path = f"{bucket_name}/{filename}"
-                local_path = temp_storage / filename
-                
-                if not self.s3fs.exists(remote_path):
-                    logger.error(f"R2中未找到必需文件: {remote_path}")
-                    return False
-                
-                # 下载文件
-                self.s3fs.get_file(remote_path, str(local_path))
-                
-                if not local_path.exists():
-                    logger.error(f"下载文件失败: {filename}")
-                    return False
+            # HEAD请求验证ETag，只下载发生变化的文件
+            try:
+                self.index_dir = str(R2IndexCache(self.s3fs).snapshot(bucket_name, required_files))
+            except FileNotFoundError as e:
+                logger.error(f"R2中未找到必需文件: {str(e)}")
+                return False
             
             # 临时重定向stdout，防止loading信息输出
             original_stdout = sys.stdout
             sys.stdout = DevNull()
             
             try:
-                # 从临时目录加载索引
-                storage_context = StorageContext.from_defaults(persist_dir=str(temp_storage))
+                # 从缓存目录加载索引
+                storage_context = StorageContext.from_defaults(persist_dir=self.index_dir)
                 self.index = load_index_from_storage(storage_context)
                 
                 # 创建查询引擎
@@ -227,16 +213,8 @@ class RAGR2SimpleQueryService:
             return False
     
     def cleanup(self):
-        """清理临时文件"""
-        if self.temp_dir and Path(self.temp_dir).exists():
-            try:
-                shutil.rmtree(self.temp_dir)
-            except:
-                pass
-    
-    def __del__(self):
-        """析构函数，自动清理"""
-        self.cleanup()
+        """索引文件保存在持久缓存目录中供后续查询复用，无需清理"""
+        pass
     
     def query(self, question: str, context: str = "", diagnostic_mode: bool = False) -> Dict[str, Any]:
         """
@@ -396,7 +374,6 @@ def stdin_handler():
         # 执行查询
         result = service.query(query, context, diagnostic_mode)
         
-        # 清理临时文件
         service.cleanup()
         
         return result
@@ -7,6 +7,7 @@
 
 import os
 import sys
+import json
 from pathlib import Path
 from dotenv import load_dotenv
 import s3fs
@@ -25,6 +26,13 @@ def upload_storage_to_r2():
         print("❌ 本地storage目录不存在")
         return False
     
+    # 索引文件位于index_version.json记录的当前版本目录（旧版本文件没有index_dir时直接位于storage下）
+    version_file = storage_path / "index_version.json"
+    if version_file.exists():
+        index_dir = json.loads(version_file.read_text(encoding="utf-8")).get("index_dir")
+        if index_dir:
+            storage_path = storage_path / index_dir
+    
     # 获取R2配置
     account_id = os.getenv("CLOUDFLARE_ACCOUNT_ID")
     access_key = os.getenv("R2_ACCESS_KEY_ID")
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+共享OpenAI客户端层
+进程内复用带连接池（keep-alive，可用时启用HTTP/2）的OpenAI客户端，
+并提供支持对冲请求（超过p95延迟后发送一份重复请求，先返回者胜出）的embedding客户端
+"""
+
+import os
+import time
+import asyncio
+import logging
+import threading
+import importlib.util
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, Dict, List, Optional
+
+import httpx
+import openai
+
+from rag_metrics import HEDGED_REQUESTS_TOTAL, UPSTREAM_ERRORS_TOTAL
+
+logger = logging.getLogger(__name__)
+
+# 项目默认使用的OpenAI代理地址
+DEFAULT_API_BASE = "https://api.gptsapi.net/v1"
+DEFAULT_EMBEDDING_MODEL = "text-embedding-3-small"
+
+# 连接池与超时配置
+HTTP_TIMEOUT = float(os.getenv("OPENAI_HTTP_TIMEOUT", "60"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "10"))
+POOL_MAX_CONNECTIONS = int(os.getenv("OPENAI_POOL_MAX_CONNECTIONS", "20"))
+POOL_MAX_KEEPALIVE = int(os.getenv("OPENAI_POOL_MAX_KEEPALIVE", "10"))
+POOL_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_POOL_KEEPALIVE_EXPIRY", "60"))
+# HTTP/2需要安装h2包
+HTTP2_ENABLED = os.getenv("OPENAI_HTTP2", "1") == "1" and importlib.util.find_spec("h2") is not None
+
+# 对冲请求配置：需要积累足够的延迟样本才会启用
+HEDGE_MIN_SAMPLES = 20
+HEDGE_WINDOW = 200
+
+_registry_lock = threading.Lock()
+_sync_clients: Dict[tuple, openai.OpenAI] = {}
+_async_clients: Dict[tuple, openai.AsyncOpenAI] = {}
+_embedding_clients: Dict[tuple, "EmbeddingClient"] = {}
+
+
+def resolve_api_key(api_key: Optional[str] = None) -> Optional[str]:
+    return api_key or os.getenv("OPENAI_API_KEY")
+
+
+def resolve_api_base(api_base: Optional[str] = None) -> str:
+    return api_base or os.getenv("OPENAI_API_BASE") or DEFAULT_API_BASE
+
+
+def is_timeout_error(error: BaseException) -> bool:
+    """是否为超时错误（请求超时或被截止时间取消）"""
+    return isinstance(error, (openai.APITimeoutError, asyncio.TimeoutError, TimeoutError))
+
+
+# 上游限流、超时和服务端错误的状态码（SDK对这些状态码可重试，但max_retries=0的客户端不会重试）
+UPSTREAM_ERROR_STATUS = {408, 409, 429}
+
+
+def _count_upstream_error(response: httpx.Response):
+    if response.status_code in UPSTREAM_ERROR_STATUS or response.status_code >= 500:
+        UPSTREAM_ERRORS_TOTAL.inc(status=str(response.status_code))
+
+
+async def _acount_upstream_error(response: httpx.Response):
+    _count_upstream_error(response)
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=POOL_MAX_CONNECTIONS,
+        max_keepalive_connections=POOL_MAX_KEEPALIVE,
+        keepalive_expiry=POOL_KEEPALIVE_EXPIRY
+    )
+
+
+def _timeout() -> httpx.Timeout:
+    return httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+
+
+def get_openai_client(api_key: Optional[str] = None, api_base: Optional[str] = None,
+                      max_retries: int = 2) -> openai.OpenAI:
+    """获取进程内共享的同步OpenAI客户端（线程安全）"""
+    key = (resolve_api_key(api_key), resolve_api_base(api_base), max_retries)
+    client = _sync_clients.get(key)
+    if client is not None:
+        return client
+
+    with _registry_lock:
+        client = _sync_clients.get(key)
+        if client is None:
+            client = openai.OpenAI(
+                api_key=key[0],
+                base_url=key[1],
+                max_retries=max_retries,
+                http_client=httpx.Client(
+                    limits=_limits(), timeout=_timeout(), http2=HTTP2_ENABLED,
+                    event_hooks={"response": [_count_upstream_error]}
+                )
+            )
+            _sync_clients[key] = client
+        return client
+
+
+def get_async_openai_client(api_key: Optional[str] = None, api_base: Optional[str] = None,
+                            max_retries: int = 2) -> openai.AsyncOpenAI:
+    """获取当前事件循环内共享的异步OpenAI客户端（异步连接绑定事件循环）"""
+    loop_id = id(asyncio.get_running_loop())
+    key = (resolve_api_key(api_key), resolve_api_base(api_base), max_retries, loop_id)
+    with _registry_lock:
+        client = _async_clients.get(key)
+        if client is None:
+            client = openai.AsyncOpenAI(
+                api_key=key[0],
+                base_url=key[1],
+                max_retries=max_retries,
+                http_client=httpx.AsyncClient(
+                    limits=_limits(), timeout=_timeout(), http2=HTTP2_ENABLED,
+                    event_hooks={"response": [_acount_upstream_error]}
+                )
+            )
+            _async_clients[key] = client
+        return client
+
+
+class LatencyTracker:
+    """滑动窗口延迟统计，用于计算对冲触发阈值(p95)"""
+
+    def __init__(self, window: int = HEDGE_WINDOW):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        """样本不足时返回None"""
+        with self._lock:
+            if len(self._samples) < HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))
+        return ordered[index]
+
+
+class EmbeddingClient:
+    """Embedding客户端 - 复用共享连接池，可选对冲请求降低尾延迟"""
+
+    def __init__(self, model: str = DEFAULT_EMBEDDING_MODEL, api_key: Optional[str] = None,
+                 api_base: Optional[str] = None, max_retries: int = 2, hedge: bool = False):
+        """
+        Args:
+            model: embedding模型名称
+            api_key: OpenAI API密钥，默认读取OPENAI_API_KEY
+            api_base: API地址，默认读取OPENAI_API_BASE
+            max_retries: 单个请求的重试次数
+            hedge: 是否启用对冲请求（适合交互式查询，批量构建不建议开启）
+        """
+        self.model = model
+        self.api_key = resolve_api_key(api_key)
+        self.api_base = resolve_api_base(api_base)
+        self.max_retries = max_retries
+        self.hedge = hedge
+        self.latency = LatencyTracker()
+        self.hedged_requests = 0
+        self._executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="embed-hedge") if hedge else None
+
+    def _create(self, texts: List[str], timeout: Optional[float] = None) -> List[List[float]]:
+        client = get_openai_client(self.api_key, self.api_base, self.max_retries)
+        if timeout is not None:
+            # 有截止时间时不再自动重试，避免请求超出调用方的时间预算
+            client = client.with_options(timeout=timeout, max_retries=0)
+        started = time.monotonic()
+        response = client.embeddings.create(model=self.model, input=texts)
+        self.latency.record(time.monotonic() - started)
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+    async def _acreate(self, texts: List[str], timeout: Optional[float] = None) -> List[List[float]]:
+        client = get_async_openai_client(self.api_key, self.api_base, self.max_retries)
+        if timeout is not None:
+            client = client.with_options(timeout=timeout, max_retries=0)
+        started = time.monotonic()
+        response = await client.embeddings.create(model=self.model, input=texts)
+        self.latency.record(time.monotonic() - started)
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+    def embed(self, texts: List[str], timeout: Optional[float] = None) -> List[List[float]]:
+        """批量获取embedding，timeout为本次调用（含对冲请求）的超时秒数"""
+        hedge_after = self.latency.percentile(0.95) if self.hedge else None
+        if hedge_after is None or (timeout is not None and hedge_after >= timeout):
+            return self._create(texts, timeout)
+
+        primary = self._executor.submit(self._create, texts, timeout)
+        done, _ = wait([primary], timeout=hedge_after)
+        if done:
+            return primary.result()
+
+        # 主请求超过p95仍未返回：发出一份重复请求，取先成功的结果
+        self.hedged_requests += 1
+        HEDGED_REQUESTS_TOTAL.inc()
+        backup = self._executor.submit(
+            self._create, texts, None if timeout is None else max(0.0, timeout - hedge_after)
+        )
+        pending = {primary, backup}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    async def aembed(self, texts: List[str], timeout: Optional[float] = None) -> List[List[float]]:
+        """异步批量获取embedding，超过timeout时取消进行中的请求并抛出asyncio.TimeoutError"""
+        if timeout is not None:
+            return await asyncio.wait_for(self._ahedged(texts, timeout), timeout)
+        return await self._ahedged(texts, None)
+
+    async def _ahedged(self, texts: List[str], timeout: Optional[float]) -> List[List[float]]:
+        hedge_after = self.latency.percentile(0.95) if self.hedge else None
+        if hedge_after is None or (timeout is not None and hedge_after >= timeout):
+            return await self._acreate(texts, timeout)
+
+        primary = asyncio.ensure_future(self._acreate(texts, timeout))
+        tasks = [primary]
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=hedge_after)
+            if done:
+                return primary.result()
+
+            self.hedged_requests += 1
+            HEDGED_REQUESTS_TOTAL.inc()
+            tasks.append(asyncio.ensure_future(self._acreate(texts, timeout)))
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # 已有结果、出错或被调用方取消（超过截止时间）时，取消仍在进行的请求
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+
+def get_embedding_client(model: str = DEFAULT_EMBEDDING_MODEL, api_key: Optional[str] = None,
+                         api_base: Optional[str] = None, max_retries: int = 2,
+                         hedge: bool = False) -> EmbeddingClient:
+    """获取进程内共享的embedding客户端（同一配置共享延迟统计）"""
+    key = (model, resolve_api_key(api_key), resolve_api_base(api_base), max_retries, hedge)
+    with _registry_lock:
+        client = _embedding_clients.get(key)
+        if client is None:
+            client = EmbeddingClient(model, api_key, api_base, max_retries, hedge)
+            _embedding_clients[key] = client
+        return client
+
+
+# LlamaIndex适配器（仅在安装了llama-index时可用）
+# 首次访问PooledOpenAIEmbedding时才导入llama-index：只使用客户端的进程（如Flask报告函数）不承担其数秒的导入耗时
+_pooled_embedding_class = None
+
+
+def _define_pooled_embedding():
+    from llama_index.core.embeddings import BaseEmbedding
+    from llama_index.core.bridge.pydantic import PrivateAttr
+
+    class PooledOpenAIEmbedding(BaseEmbedding):
+        """基于共享EmbeddingClient的LlamaIndex embedding实现"""
+
+        _client: Any = PrivateAttr()
+
+        def __init__(self, model: str = DEFAULT_EMBEDDING_MODEL, api_key: Optional[str] = None,
+                     api_base: Optional[str] = None, max_retries: int = 2, hedge: bool = False,
+                     embed_batch_size: int = 10, **kwargs):
+            super().__init__(model_name=model, embed_batch_size=embed_batch_size, **kwargs)
+            self._client = get_embedding_client(model, api_key, api_base, max_retries, hedge)
+
+        @classmethod
+        def class_name(cls) -> str:
+            return "PooledOpenAIEmbedding"
+
+        @property
+        def client(self) -> EmbeddingClient:
+            return self._client
+
+        def _get_query_embedding(self, query: str) -> List[float]:
+            return self._client.embed([query])[0]
+
+        def _get_text_embedding(self, text: str) -> List[float]:
+            return self._client.embed([text])[0]
+
+        def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+            return self._client.embed(texts)
+
+        async def _aget_query_embedding(self, query: str) -> List[float]:
+            return (await self._client.aembed([query]))[0]
+
+        async def _aget_text_embedding(self, text: str) -> List[float]:
+            return (await self._client.aembed([text]))[0]
+
+        async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+            return await self._client.aembed(texts)
+
+    return PooledOpenAIEmbedding
+
+
+def __getattr__(name: str):
+    global _pooled_embedding_class
+    if name == "PooledOpenAIEmbedding":
+        with _registry_lock:
+            if _pooled_embedding_class is None:
+                _pooled_embedding_class = _define_pooled_embedding()
+        return _pooled_embedding_class
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
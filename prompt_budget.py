@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+报告提示词token预算
+按部分（用户资料、聊天记录/简介、知识库分析、参考资料）统计提示词token数并执行各自的预算：
+    - 聊天记录超出预算时按相关性保留片段：开头和结尾的片段始终保留，其余按风险关键词命中数从高到低
+      放入（同分时优先较新的片段），按原顺序拼接，被省略的位置插入省略标记
+    - 其他部分超出预算时截断
+长输入的提示词大小有上限，报告生成的耗时和费用因此可预期
+"""
+
+import os
+import re
+from typing import Dict, List, Tuple
+
+from rag_metrics import PROMPT_TOKENS, PROMPT_TRIMMED_TOTAL
+from token_counter import count_tokens, truncate_to_tokens
+
+# 各部分的token预算
+SECTION_BUDGETS = {
+    "profile": int(os.getenv("REPORT_PROMPT_PROFILE_TOKENS", "256")),
+    "chat": int(os.getenv("REPORT_PROMPT_CHAT_TOKENS", "3000")),
+    "knowledge": int(os.getenv("REPORT_PROMPT_KNOWLEDGE_TOKENS", "1500")),
+    "sources": int(os.getenv("REPORT_PROMPT_SOURCES_TOKENS", "200")),
+}
+
+# 情感诈骗相关的风险信号：命中越多的聊天片段越值得保留
+RISK_KEYWORDS = (
+    "转账", "汇款", "打款", "借钱", "借款", "贷款", "投资", "理财", "平台", "充值", "提现", "收益", "回报",
+    "稳赚", "内幕", "带你", "比特币", "虚拟币", "usdt", "红包", "急用", "医院", "手术", "签证", "海关",
+    "包裹", "验证码", "银行卡", "账户", "密码", "保证金", "手续费", "见面", "视频", "不方便", "保密",
+    "别告诉", "结婚", "老婆", "老公", "宝贝", "军人", "维和", "海外", "money", "transfer", "invest",
+    "crypto", "bitcoin", "wire", "gift card", "bank", "loan", "urgent", "hospital", "visa", "customs",
+)
+_AMOUNT_PATTERN = re.compile(r"[¥￥$]\s*\d|\d+\s*(?:元|块|万|千|美元|usd|rmb)", re.IGNORECASE)
+
+# 按行切分聊天记录，过长的行再按句末标点切分
+_SPAN_PATTERN = re.compile(r"(?<=[。！？!?；;])")
+MAX_SPAN_CHARS = 300
+
+OMISSION_MARKER = "……（已省略 {count} 段）"
+
+
+def split_spans(text: str) -> List[str]:
+    """把聊天记录切分为片段（一般为一条消息）"""
+    spans = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if len(line) <= MAX_SPAN_CHARS:
+            spans.append(line)
+            continue
+        current = ""
+        for piece in _SPAN_PATTERN.split(line):
+            if current and len(current) + len(piece) > MAX_SPAN_CHARS:
+                spans.append(current)
+                current = ""
+            current += piece
+        if current:
+            spans.append(current)
+    return spans
+
+
+def span_relevance(span: str) -> float:
+    """片段相关性：风险关键词命中数，提到金额时加分"""
+    lowered = span.lower()
+    score = float(sum(1 for keyword in RISK_KEYWORDS if keyword in lowered))
+    if _AMOUNT_PATTERN.search(lowered):
+        score += 1.0
+    return score
+
+
+def trim_chat(text: str, budget: int, model: str = "gpt-4o") -> Tuple[str, bool]:
+    """
+    把聊天记录裁剪到预算以内
+
+    Returns:
+        (裁剪后的文本, 是否发生了裁剪)
+    """
+    if count_tokens(text, model) <= budget:
+        return text, False
+
+    spans = split_spans(text)
+    if len(spans) <= 1:
+        return truncate_to_tokens(text, budget, model), True
+
+    costs = [count_tokens(span, model) + 1 for span in spans]  # +1: 换行
+    marker_cost = count_tokens(OMISSION_MARKER.format(count=len(spans)), model) + 1
+    last = len(spans) - 1
+
+    # 开头和结尾优先，其余按相关性（同分时较新的片段优先）
+    order = [0, last] + sorted(range(1, last), key=lambda i: (span_relevance(spans[i]), i), reverse=True)
+    kept, used = set(), 0
+    gaps = 1  # 被省略的连续片段段数（每段一个省略标记）
+    for i in order:
+        left_omitted = i > 0 and i - 1 not in kept
+        right_omitted = i < last and i + 1 not in kept
+        new_gaps = gaps + (1 if left_omitted and right_omitted else 0) - (0 if left_omitted or right_omitted else 1)
+        if used + costs[i] + marker_cost * new_gaps <= budget:
+            kept.add(i)
+            used += costs[i]
+            gaps = new_gaps
+    if not kept:
+        return truncate_to_tokens(text, budget, model), True
+
+    lines, omitted = [], 0
+    for i, span in enumerate(spans):
+        if i in kept:
+            if omitted:
+                lines.append(OMISSION_MARKER.format(count=omitted))
+                omitted = 0
+            lines.append(span)
+        else:
+            omitted += 1
+    if omitted:
+        lines.append(OMISSION_MARKER.format(count=omitted))
+    return "\n".join(lines), True
+
+
+def fit_section(section: str, text: str, model: str = "gpt-4o") -> str:
+    """按该部分的预算裁剪文本，并记录裁剪后的token数"""
+    budget = SECTION_BUDGETS[section]
+    if section == "chat":
+        fitted, trimmed = trim_chat(text, budget, model)
+    else:
+        fitted = truncate_to_tokens(text, budget, model)
+        trimmed = fitted != text
+    if trimmed:
+        PROMPT_TRIMMED_TOTAL.inc(section=section)
+    PROMPT_TOKENS.observe(count_tokens(fitted, model), section=section)
+    return fitted
+
+
+def record_prompt_tokens(messages: List[Dict[str, str]], model: str = "gpt-4o") -> int:
+    """记录整个提示词的token数并返回"""
+    total = sum(count_tokens(message.get("content", ""), model) for message in messages)
+    PROMPT_TOKENS.observe(total, section="total")
+    return total
@@ -7,6 +7,7 @@ AI情感安全助手 - RAG查询系统 (Replicate版本)
 
 import os
 import sys
+import asyncio
 from pathlib import Path
 import logging
 from dotenv import load_dotenv
@@ -14,6 +15,9 @@ import json
 import replicate
 from typing import List
 
+from rag_diagnostics import create_diagnostics, source_distribution
+from rag_index_version import index_persist_dir
+
 # LlamaIndex核心模块
 from llama_index.core import (
     StorageContext,
@@ -97,12 +101,12 @@ class ReplicateEmbedding(BaseEmbedding):
         return embeddings
     
     async def _aget_query_embedding(self, query: str) -> List[float]:
-        """异步获取查询embedding"""
-        return self._get_query_embedding(query)
+        """异步获取查询embedding（在线程中执行阻塞调用，不阻塞事件循环）"""
+        return await asyncio.to_thread(self._get_query_embedding, query)
     
     async def _aget_text_embedding(self, text: str) -> List[float]:
-        """异步获取文本embedding"""
-        return self._get_text_embedding(text)
+        """异步获取文本embedding（在线程中执行阻塞调用，不阻塞事件循环）"""
+        return await asyncio.to_thread(self._get_text_embedding, text)
 
 class RAGQueryService:
     """RAG查询服务类 - Replicate版本"""
@@ -147,8 +151,9 @@ class RAGQueryService:
     
     def load_index(self):
         """加载已存在的索引"""
-        if not (self.storage_path / "index_store.json").exists():
-            logger.error(f"未找到索引文件: {self.storage_path}/index_store.json")
+        persist_dir = index_persist_dir(self.storage_path)
+        if not (persist_dir / "index_store.json").exists():
+            logger.error(f"未找到索引文件: {persist_dir}/index_store.json")
             logger.error("请先运行 python build_rag_system.py 来构建索引")
             return False
         
@@ -156,7 +161,7 @@ class RAGQueryService:
         
         try:
             # 从存储中加载索引
-            storage_context = StorageContext.from_defaults(persist_dir=str(self.storage_path))
+            storage_context = StorageContext.from_defaults(persist_dir=str(persist_dir))
             self.index = load_index_from_storage(storage_context)
             
             # 创建查询引擎
@@ -179,7 +184,7 @@ class RAGQueryService:
         Args:
             question: 查询问题
             context: 额外上下文信息
-            diagnostic_mode: 是否启用诊断模式，详细打印检索信息
+            diagnostic_mode: 是否启用诊断模式，结构化诊断信息随结果返回（"diagnostics"字段）
             
         Returns:
             包含查询结果的字典
@@ -203,95 +208,29 @@ class RAGQueryService:
             response = self.query_engine.query(full_query)
             
             # 提取源文档信息
+            source_nodes = getattr(response, 'source_nodes', None) or []
             sources = []
-            if hasattr(response, 'source_nodes') and response.source_nodes:
-                # 🔍 诊断模式：详细打印检索信息
-                if diagnostic_mode:
-                    print("\n" + "="*80)
-                    print("🔬 RAG系统检索诊断报告")
-                    print("="*80)
-                    print(f"📝 查询问题: {question}")
-                    if context.strip():
-                        print(f"📄 上下文: {context}")
-                    print(f"🔍 完整查询: {full_query}")
-                    print(f"📊 检索到 {len(response.source_nodes)} 个相关文档片段\n")
+            for node in source_nodes:
+                source_info = {
+                    "content": node.text[:200] + "..." if len(node.text) > 200 else node.text,
+                    "score": getattr(node, 'score', 0.0)
+                }
                 
-                for i, node in enumerate(response.source_nodes, 1):
-                    source_info = {
-                        "content": node.text[:200] + "..." if len(node.text) > 200 else node.text,
-                        "score": getattr(node, 'score', 0.0)
-                    }
-                    
-                    # 添加文件路径信息（如果有）
-                    if hasattr(node, 'metadata') and 'file_path' in node.metadata:
-                        source_info['file_path'] = node.metadata['file_path']
-                    
-                    # 🔍 诊断模式：详细打印每个检索片段
-                    if diagnostic_mode:
-                        print(f"📄 片段 {i}")
-                        print("-" * 60)
-                        
-                        # 相关性得分
-                        score = getattr(node, 'score', 0.0)
-                        print(f"🎯 相关性得分: {score:.4f}")
-                        
-                        # 来源元数据
-                        metadata = getattr(node, 'metadata', {})
-                        if 'file_path' in metadata:
-                            file_name = os.path.basename(metadata['file_path'])
-                            print(f"📁 来源文件: {file_name}")
-                            print(f"📂 完整路径: {metadata['file_path']}")
-                        
-                        # 其他元数据信息
-                        if metadata:
-                            for key, value in metadata.items():
-                                if key != 'file_path':
-                                    print(f"📋 {key}: {value}")
-                        
-                        # 原始文本块
-                        print(f"📝 原始文本块 (长度: {len(node.text)} 字符):")
-                        print("-" * 40)
-                        print(node.text)
-                        print("-" * 40)
-                        
-                        # 文本块ID（如果有）
-                        if hasattr(node, 'node_id'):
-                            print(f"🆔 节点ID: {node.node_id}")
-                        
-                        print()  # 空行分隔
-                    
-                    sources.append(source_info)
+                # 添加文件路径信息（如果有）
+                if hasattr(node, 'metadata') and 'file_path' in node.metadata:
+                    source_info['file_path'] = node.metadata['file_path']
                 
-                # 🔍 诊断模式：打印文档来源统计
-                if diagnostic_mode:
-                    print("📊 文档来源统计:")
-                    print("-" * 40)
-                    file_count = {}
-                    for source in sources:
-                        if 'file_path' in source:
-                            file_name = os.path.basename(source['file_path'])
-                            file_count[file_name] = file_count.get(file_name, 0) + 1
-                    
-                    for file_name, count in sorted(file_count.items(), key=lambda x: x[1], reverse=True):
-                        print(f"📂 {file_name}: {count} 个片段")
-                    
-                    print("\n💡 检索偏见分析:")
-                    print("-" * 40)
-                    total_sources = len(sources)
-                    if total_sources > 0:
-                        most_cited = max(file_count.items(), key=lambda x: x[1])
-                        bias_ratio = most_cited[1] / total_sources
-                        print(f"🔍 最常引用文档: {most_cited[0]} ({most_cited[1]}/{total_sources} = {bias_ratio:.1%})")
-                        if bias_ratio > 0.6:
-                            print("⚠️  警告: 存在明显的检索偏见！单一文档占比过高")
-                        elif bias_ratio > 0.4:
-                            print("🟡 注意: 存在轻微的检索偏见")
-                        else:
-                            print("✅ 检索结果相对均衡")
-                    
-                    print("="*80)
-                    print("🔬 诊断报告结束")
-                    print("="*80 + "\n")
+                sources.append(source_info)
+            
+            # 🔍 诊断模式：结构化记录检索信息，随结果返回
+            diagnostics = create_diagnostics(diagnostic_mode)
+            if diagnostics.enabled:
+                diagnostics.set("query", question)
+                diagnostics.set("full_query", full_query)
+                diagnostics.record_nodes("retrieved", source_nodes)
+                diagnostics.set("source_distribution", source_distribution(
+                    source['file_path'] for source in sources if 'file_path' in source
+                ))
             
             result = {
                 "answer": str(response),
@@ -299,6 +238,8 @@ class RAGQueryService:
                 "query": question,
                 "context": context
             }
+            if diagnostics.enabled:
+                result["diagnostics"] = diagnostics.to_dict()
             
             logger.info("✅ 查询完成")
             return result
@@ -435,6 +376,9 @@ def main():
                 print(f"回答: {result['answer']}")
                 if result['sources']:
                     print(f"\n参考来源: {len(result['sources'])} 个文档片段")
+                if result.get('diagnostics'):
+                    print("\n🔬 检索诊断:")
+                    print(json.dumps(result['diagnostics'], ensure_ascii=False, indent=2))
     else:
         # 交互式模式
         print("🤖 AI情感安全助手 - RAG查询系统 (Replicate版本)")
@@ -471,7 +415,10 @@ def main():
                     print(f"\n📋 回答:")
                     print(result['answer'])
                     
-                    if result['sources'] and not diagnostic_mode:
+                    if result.get('diagnostics'):
+                        print("\n🔬 检索诊断:")
+                        print(json.dumps(result['diagnostics'], ensure_ascii=False, indent=2))
+                    elif result['sources']:
                         print(f"\n📚 参考来源: {len(result['sources'])} 个文档片段")
                         for i, source in enumerate(result['sources'][:3], 1):
                             print(f"   {i}. {source['content'][:100]}...")
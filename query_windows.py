@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+查询构造模块
+把过长的聊天记录切分为若干窗口，批量embedding后用retrieve_with_embeddings逐窗口检索，
+再用RRF(倒数排名融合)合并各窗口的排序结果，长输入的延迟可预测且不丢失证据
+"""
+
+import re
+from typing import List
+
+from token_counter import count_tokens, truncate_to_tokens
+
+# 默认窗口参数
+DEFAULT_WINDOW_TOKENS = 256
+DEFAULT_OVERLAP_TOKENS = 32
+DEFAULT_MAX_WINDOWS = 8
+# embedding模型单次输入上限（text-embedding-3-small为8191），留出余量
+MAX_WINDOW_TOKENS = 6000
+
+# RRF常数，常用取值60
+RRF_K = 60
+
+# 按换行和中英文句末标点切分
+_SEGMENT_PATTERN = re.compile(r'(?<=[\n。！？!?；;])')
+
+
+def _token_prefix(text: str, max_tokens: int) -> str:
+    """
+    text不超过max_tokens的最长前缀（按字符边界）
+
+    按token截断可能切开一个多字节字符，解码结果末尾是替换字符U+FFFD而不是原文字符，
+    因此取截断结果与原文的公共前缀；至少返回一个字符，保证切分向前推进
+    """
+    truncated = truncate_to_tokens(text, max_tokens)
+    length = 0
+    for truncated_char, char in zip(truncated, text):
+        if truncated_char != char:
+            break
+        length += 1
+    return text[:max(length, 1)]
+
+
+def _segments(text: str, max_tokens: int) -> List[str]:
+    """把文本切成不超过max_tokens的片段（优先在行和句子边界切分）"""
+    segments = []
+    for piece in _SEGMENT_PATTERN.split(text):
+        if not piece:
+            continue
+        # 单句过长时硬切
+        while count_tokens(piece) > max_tokens:
+            head = _token_prefix(piece, max_tokens)
+            segments.append(head)
+            piece = piece[len(head):]
+        if piece:
+            segments.append(piece)
+    return segments
+
+
+def split_into_windows(text: str, window_tokens: int = DEFAULT_WINDOW_TOKENS,
+                       overlap_tokens: int = DEFAULT_OVERLAP_TOKENS,
+                       max_windows: int = DEFAULT_MAX_WINDOWS) -> List[str]:
+    """
+    把长文本切分为带重叠的窗口
+
+    窗口数超过max_windows时按比例放大窗口，保证窗口数量（即检索次数）有上限，
+    同时不丢弃任何内容；单个窗口仍受embedding输入上限（MAX_WINDOW_TOKENS）约束，
+    文本超过约 max_windows × MAX_WINDOW_TOKENS 个token时只保留前max_windows个窗口，其后的内容不参与检索。
+
+    Args:
+        text: 聊天记录或个人简介
+        window_tokens: 每个窗口的目标token数
+        overlap_tokens: 相邻窗口的重叠token数
+        max_windows: 最多窗口数
+
+    Returns:
+        窗口文本列表（短文本只有一个窗口）
+    """
+    text = (text or "").strip()
+    if not text:
+        return []
+
+    total_tokens = count_tokens(text)
+    if total_tokens <= window_tokens:
+        return [text]
+
+    # 放大窗口以满足窗口数上限
+    needed = -(-total_tokens // max_windows) + overlap_tokens
+    window_tokens = min(max(window_tokens, needed), MAX_WINDOW_TOKENS)
+
+    windows = _pack_windows(text, window_tokens, overlap_tokens)
+    # 重叠部分可能使窗口数略超上限，继续放大窗口直到满足
+    while len(windows) > max_windows and window_tokens < MAX_WINDOW_TOKENS:
+        window_tokens = min(int(window_tokens * 1.25) + 1, MAX_WINDOW_TOKENS)
+        windows = _pack_windows(text, window_tokens, overlap_tokens)
+
+    # 窗口已达embedding输入上限仍超出窗口数上限：截掉超出的窗口（见上方说明）
+    return windows[:max_windows]
+
+
+def _pack_windows(text: str, window_tokens: int, overlap_tokens: int) -> List[str]:
+    """按句子边界把文本装入窗口，相邻窗口保留重叠句子"""
+    windows = []
+    current: List[str] = []
+    current_tokens = 0
+    for segment in _segments(text, window_tokens):
+        segment_tokens = count_tokens(segment)
+        if current and current_tokens + segment_tokens > window_tokens:
+            windows.append("".join(current).strip())
+            # 从上一窗口末尾保留重叠部分
+            overlap: List[str] = []
+            overlap_count = 0
+            for previous in reversed(current):
+                previous_tokens = count_tokens(previous)
+                if overlap_count + previous_tokens > overlap_tokens:
+                    break
+                overlap.insert(0, previous)
+                overlap_count += previous_tokens
+            current, current_tokens = overlap, overlap_count
+        current.append(segment)
+        current_tokens += segment_tokens
+
+    if current:
+        windows.append("".join(current).strip())
+    return windows
+
+
+def reciprocal_rank_fusion(ranked_lists: List[list], k: int = RRF_K) -> list:
+    """
+    用RRF融合多个检索结果列表
+
+    Args:
+        ranked_lists: 每个窗口的检索结果（NodeWithScore列表，按相关性降序）
+        k: RRF常数
+
+    Returns:
+        融合后的NodeWithScore列表，按RRF得分降序；
+        每个节点的score保留其在各窗口中的最高相似度
+    """
+    fused = {}
+    for results in ranked_lists:
+        for rank, node in enumerate(results):
+            node_id = node.node.node_id
+            entry = fused.setdefault(node_id, {"rrf": 0.0, "node": node})
+            entry["rrf"] += 1.0 / (k + rank + 1)
+            if (node.score or 0.0) > (entry["node"].score or 0.0):
+                entry["node"] = node
+
+    ranked = sorted(fused.values(), key=lambda entry: entry["rrf"], reverse=True)
+    return [entry["node"] for entry in ranked]
+
+
+def retrieve_with_embeddings(index, queries: List[str], embeddings: List[List[float]], top_k: int,
+                             deadline=None) -> list:
+    """
+    使用已计算好的查询向量逐个检索并融合（不再调用embedding接口）
+
+    Args:
+        index: VectorStoreIndex
+        queries: 查询文本列表
+        embeddings: 与queries一一对应的向量
+        top_k: 每个查询检索的片段数，也是最终返回数量
+        deadline: 请求截止时间（rag_deadline.Deadline），时间不足时只融合已检索的窗口
+
+    Returns:
+        融合后的NodeWithScore列表
+    """
+    from llama_index.core import QueryBundle
+
+    retriever = index.as_retriever(similarity_top_k=top_k)
+    ranked_lists = []
+    for query, embedding in zip(queries, embeddings):
+        if ranked_lists and deadline is not None and not deadline.allows("retrieval"):
+            deadline.skip("retrieval_windows")
+            break
+        ranked_lists.append(retriever.retrieve(QueryBundle(query_str=query, embedding=embedding)))
+    if len(ranked_lists) == 1:
+        return ranked_lists[0]
+    return reciprocal_rank_fusion(ranked_lists)[:top_k]
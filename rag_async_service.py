@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+异步RAG查询引擎 (常驻worker模式)
+embedding请求通过共享连接池的异步HTTP客户端发出（openai_clients），向量检索和多样性筛选在线程池中执行，
+单个进程可以同时处理数十个进行中的扫描请求
+
+协议：从stdin逐行读取JSON请求（与rag_query_service_enhanced.py的输入相同，可附带"id"），
+每完成一个请求向stdout输出一行紧凑JSON结果（附带相同的"id"），结果顺序与完成顺序一致；
+请求中的"fields"字段掩码同样生效（见rag_protocol）；
+同时进行中的相同扫描（规范化输入 + 索引版本 + 字段掩码相同）只检索一次，共享结果（见singleflight）
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from query_windows import split_into_windows
+from rag_deadline import Deadline, DeadlineExceeded
+from rag_diagnostics import NULL_DIAGNOSTICS
+from rag_protocol import dumps_compact, request_fields
+from rag_metrics import REQUESTS_TOTAL, start_metrics_server
+from report_cache import scan_key
+from singleflight import AsyncSingleFlight
+
+logger = logging.getLogger(__name__)
+
+# metrics端口（GET /metrics），0表示不启动
+METRICS_PORT = int(os.getenv("RAG_WORKER_METRICS_PORT", "0"))
+
+# 并发参数
+DEFAULT_MAX_IN_FLIGHT = int(os.getenv("RAG_WORKER_MAX_IN_FLIGHT", "32"))
+DEFAULT_CPU_WORKERS = int(os.getenv("RAG_WORKER_CPU_THREADS", "4"))
+
+
+class AsyncRAGEngine:
+    """异步RAG引擎 - 包装EnhancedRAGService，embedding走异步HTTP，检索走线程池"""
+
+    def __init__(self, service, max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+                 cpu_workers: int = DEFAULT_CPU_WORKERS):
+        """
+        Args:
+            service: 已初始化的EnhancedRAGService实例（提供索引和多样性筛选）
+            max_in_flight: 最多同时处理的请求数
+            cpu_workers: 执行检索和结果构建的线程数
+        """
+        self.service = service
+        self.max_in_flight = max_in_flight
+        self.executor = ThreadPoolExecutor(max_workers=cpu_workers, thread_name_prefix="rag-cpu")
+        self.flight = AsyncSingleFlight("worker")
+
+    async def aembed(self, texts: List[str], timeout: Optional[float] = None) -> List[List[float]]:
+        """一次请求批量获取embedding（与服务共用同一个embedding客户端和延迟统计）"""
+        return await self.service.embed_model.client.aembed(texts, timeout=timeout)
+
+    async def aembed_within(self, texts: List[str], deadline: Deadline) -> Optional[List[List[float]]]:
+        """在截止时间内获取embedding，超时时取消请求并返回None"""
+        from openai_clients import is_timeout_error
+
+        started = time.monotonic()
+        try:
+            deadline.require("embedding")
+            embeddings = await self.aembed(texts, timeout=deadline.timeout_for("embedding"))
+        except Exception as e:
+            if not isinstance(e, DeadlineExceeded) and not (deadline.bounded and is_timeout_error(e)):
+                raise
+            logger.warning("⏰ embedding未能在截止时间内完成，返回降级结果")
+            deadline.skip("embedding")
+            return None
+        deadline.record("embedding", time.monotonic() - started)
+        return embeddings
+
+    def _retrieve_and_build(self, user_info: dict, query: str, queries: List[str],
+                            embeddings: Optional[List[List[float]]], deadline: Deadline, diagnostics,
+                            fields: Optional[set]) -> dict:
+        """线程池中执行：向量检索 + 多样性筛选 + 构建响应"""
+        nodes = []
+        if embeddings:
+            nodes = self.service.select_nodes(query, queries, embeddings, deadline, diagnostics=diagnostics)
+        return self.service.build_result(user_info, nodes, query, deadline, diagnostics, fields=fields)
+
+    async def _query(self, user_info: dict, query: str, deadline: Deadline, diagnostics,
+                     fields: Optional[set]) -> Dict[str, Any]:
+        """embedding + 检索 + 构建响应"""
+        queries = split_into_windows(query) or [query]
+
+        # embedding等待网络期间事件循环可以处理其他请求；超过截止时间时请求被取消
+        embeddings = await self.aembed_within(queries, deadline)
+
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, self._retrieve_and_build, user_info, query, queries, embeddings, deadline, diagnostics,
+            fields
+        )
+
+    async def process(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """处理单个查询请求"""
+        loop = asyncio.get_running_loop()
+        try:
+            deadline = Deadline.from_request(data)
+            diagnostics = self.service.request_diagnostics(data, deadline)
+            await loop.run_in_executor(self.executor, self.service.reload_if_stale)
+
+            user_info, query = self.service.extract_query(data)
+            fields = request_fields(data)
+
+            if diagnostics is not NULL_DIAGNOSTICS:
+                # 诊断信息按请求收集，不与其他请求合并
+                result = await self._query(user_info, query, deadline, diagnostics, fields)
+            else:
+                # 相同的扫描同时进行时等待第一个请求的结果（其截止时间决定是否降级）
+                key = scan_key(user_info, index_version=self.service.index_version,
+                               fields=sorted(fields) if fields is not None else None)
+                result, shared = await self.flight.do(
+                    key, lambda: self._query(user_info, query, deadline, diagnostics, fields)
+                )
+                if shared:
+                    # 复制共享的结果并换回本请求的user_info（调用方还会写入各自的请求id）
+                    result = dict(result)
+                    if 'user_info' in result.get('data', {}):
+                        result['data'] = {**result['data'], 'user_info': user_info}
+            REQUESTS_TOTAL.inc(service="worker", status=self.service.result_status(result))
+            return result
+        except Exception as e:
+            logger.error(f"❌ 异步查询处理失败: {str(e)}")
+            REQUESTS_TOTAL.inc(service="worker", status="error")
+            return {
+                'success': False,
+                'error': str(e),
+                'data': {}
+            }
+
+    async def close(self):
+        """释放线程池"""
+        self.executor.shutdown(wait=False)
+
+
+async def run_worker(service, max_in_flight: int = DEFAULT_MAX_IN_FLIGHT):
+    """常驻worker主循环：并发处理stdin上的请求，逐行输出结果"""
+    # 协议输出使用原始stdout；其余所有print（包括第三方库）一律进入stderr
+    protocol_out = sys.__stdout__
+    sys.stdout = sys.stderr
+
+    engine = AsyncRAGEngine(service, max_in_flight=max_in_flight)
+    semaphore = asyncio.Semaphore(max_in_flight)
+    loop = asyncio.get_running_loop()
+
+    reader = asyncio.StreamReader(limit=16 * 1024 * 1024)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+
+    def emit(payload: dict):
+        protocol_out.write(dumps_compact(payload) + "\n")
+        protocol_out.flush()
+
+    async def handle(line: bytes):
+        try:
+            request = json.loads(line)
+        except ValueError:
+            emit({'success': False, 'error': '无效的JSON输入格式', 'data': {}})
+            return
+        async with semaphore:
+            result = await engine.process(request)
+        result['id'] = request.get('id')
+        emit(result)
+
+    metrics_server = await start_metrics_server(METRICS_PORT) if METRICS_PORT else None
+
+    logger.info(f"🚀 异步RAG worker已启动，最大并发 {max_in_flight}")
+    tasks = set()
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        if not line.strip():
+            continue
+        task = asyncio.create_task(handle(line))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    # stdin关闭后等待进行中的请求完成
+    if tasks:
+        await asyncio.gather(*tasks)
+    await engine.close()
+    if metrics_server is not None:
+        metrics_server.close()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+RAG索引构建检查点模块
+将已计算的embedding增量写入磁盘，构建中断后可从断点继续，并输出构建进度
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+from pathlib import Path
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 检查点目录名（位于索引存储目录下）
+CHECKPOINT_DIR_NAME = ".build_checkpoint"
+
+
+class EmbeddingCheckpoint:
+    """Embedding检查点 - 以追加方式保存每个文本块的向量"""
+
+    def __init__(self, storage_path: str, model_name: str):
+        """
+        初始化检查点
+
+        Args:
+            storage_path: 索引存储路径，检查点保存在其子目录中
+            model_name: embedding模型名称，模型变化时检查点自动失效
+        """
+        self.checkpoint_dir = Path(storage_path) / CHECKPOINT_DIR_NAME
+        self.embeddings_file = self.checkpoint_dir / "embeddings.jsonl"
+        self.meta_file = self.checkpoint_dir / "meta.json"
+        self.model_name = model_name
+        self._embeddings: Dict[str, List[float]] = {}
+        self._handle = None
+
+    @staticmethod
+    def chunk_key(model_name: str, text: str) -> str:
+        """根据模型名和待embedding文本计算文本块的稳定标识"""
+        digest = hashlib.sha256()
+        digest.update(model_name.encode("utf-8"))
+        digest.update(b"\x00")
+        digest.update(text.encode("utf-8"))
+        return digest.hexdigest()
+
+    def load(self) -> int:
+        """加载已有检查点，返回可复用的embedding数量"""
+        self._embeddings = {}
+
+        if not self.embeddings_file.exists():
+            return 0
+
+        # 模型不一致时丢弃旧检查点
+        try:
+            meta = json.loads(self.meta_file.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            meta = {}
+        if meta.get("model") != self.model_name:
+            logger.warning("⚠️ 检查点使用的embedding模型不一致，丢弃旧检查点")
+            self.clear()
+            return 0
+
+        self._truncate_partial_line()
+        with open(self.embeddings_file, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    self._embeddings[record["k"]] = record["e"]
+                except (ValueError, KeyError):
+                    continue
+
+        return len(self._embeddings)
+
+    def _truncate_partial_line(self):
+        """进程在写入过程中被中断时最后一行不完整，截断到最后一个完整行，后续追加的记录不会与之拼接"""
+        try:
+            with open(self.embeddings_file, "rb+") as f:
+                f.seek(0, os.SEEK_END)
+                size = f.tell()
+                if size == 0:
+                    return
+                f.seek(size - 1)
+                if f.read(1) == b"\n":
+                    return
+                # 从末尾向前查找最后一个换行符
+                position = size
+                while position > 0:
+                    step = min(1024 * 1024, position)
+                    f.seek(position - step)
+                    block = f.read(step)
+                    newline = block.rfind(b"\n")
+                    if newline >= 0:
+                        position = position - step + newline + 1
+                        break
+                    position -= step
+                f.truncate(position)
+                logger.warning(f"⚠️ 检查点末尾有不完整的记录，已截断 {size - position} 字节")
+        except FileNotFoundError:
+            pass
+
+    def get(self, key: str) -> Optional[List[float]]:
+        """获取已保存的embedding"""
+        return self._embeddings.get(key)
+
+    def save_batch(self, keys: List[str], embeddings: List[List[float]]):
+        """追加保存一批embedding，并立即落盘"""
+        if self._handle is None:
+            self.checkpoint_dir.mkdir(parents=True, exist_ok=True)
+            self.meta_file.write_text(
+                json.dumps({"model": self.model_name}, ensure_ascii=False),
+                encoding="utf-8"
+            )
+            self._truncate_partial_line()
+            self._handle = open(self.embeddings_file, "a", encoding="utf-8")
+
+        for key, embedding in zip(keys, embeddings):
+            self._embeddings[key] = embedding
+            self._handle.write(json.dumps({"k": key, "e": embedding}) + "\n")
+
+        self._handle.flush()
+        os.fsync(self._handle.fileno())
+
+    def close(self):
+        """关闭检查点文件"""
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+    def clear(self):
+        """删除检查点（索引成功保存后调用）"""
+        self.close()
+        self._embeddings = {}
+        if self.checkpoint_dir.exists():
+            shutil.rmtree(self.checkpoint_dir, ignore_errors=True)
+
+
+class BuildProgress:
+    """构建进度报告器 - 输出处理速度(块/秒)和预计剩余时间"""
+
+    def __init__(self, total: int, already_done: int = 0, log_interval: float = 5.0):
+        """
+        Args:
+            total: 文本块总数
+            already_done: 从检查点恢复的文本块数量（不计入速度）
+            log_interval: 进度日志的最小间隔秒数
+        """
+        self.total = total
+        self.done = already_done
+        self.resumed = already_done
+        self.log_interval = log_interval
+        self.start_time = time.monotonic()
+        self._last_log = 0.0
+
+    def update(self, count: int):
+        """记录新完成的文本块数量"""
+        self.done += count
+        now = time.monotonic()
+        if now - self._last_log >= self.log_interval or self.done >= self.total:
+            self._last_log = now
+            logger.info(self.format_status())
+
+    def rate(self) -> float:
+        """本次运行的处理速度（块/秒）"""
+        elapsed = time.monotonic() - self.start_time
+        processed = self.done - self.resumed
+        return processed / elapsed if elapsed > 0 else 0.0
+
+    def eta_seconds(self) -> Optional[float]:
+        """预计剩余时间（秒），速度未知时返回None"""
+        rate = self.rate()
+        if rate <= 0:
+            return None
+        return (self.total - self.done) / rate
+
+    def format_status(self) -> str:
+        """格式化进度信息"""
+        percentage = (self.done / self.total * 100) if self.total else 100.0
+        eta = self.eta_seconds()
+        eta_text = "未知" if eta is None else time.strftime("%H:%M:%S", time.gmtime(eta))
+        return (
+            f"📈 Embedding进度: {self.done}/{self.total} ({percentage:.1f}%) | "
+            f"速度: {self.rate():.2f} 块/秒 | 预计剩余: {eta_text}"
+        )
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+RAG索引构建报告模块
+记录构建过程中各阶段的耗时、数据量和API调用情况，输出结构化JSON报告
+"""
+
+import json
+import time
+import logging
+from pathlib import Path
+from typing import Any, Dict, List
+
+from rag_index_version import atomic_write_json
+
+logger = logging.getLogger(__name__)
+
+# 报告文件名（位于索引存储目录下）
+REPORT_FILE_NAME = "build_report.json"
+HISTORY_FILE_NAME = "build_history.jsonl"
+
+
+class BuildReport:
+    """构建报告 - 收集构建指标并写入storage/build_report.json"""
+
+    def __init__(self, mode: str = "full_build"):
+        """
+        Args:
+            mode: 构建模式（full_build / incremental）
+        """
+        self.mode = mode
+        self.started_at = time.strftime("%Y-%m-%d %H:%M:%S")
+        self._start = time.monotonic()
+
+        self.files_discovered = 0
+        self.files: Dict[str, Dict[str, Any]] = {}
+
+        self.chunks_produced = 0
+        self.chunks_from_checkpoint = 0
+        self.chunks_embedded = 0
+        self.tokens_embedded = 0
+        self.embedding_requests = 0
+        self.embedding_retries = 0
+        self.embedding_seconds = 0.0
+        self.throttle_seconds = 0.0
+
+        self.persist_seconds = 0.0
+        self.store_files: Dict[str, int] = {}
+
+    def record_parse(self, file_path: str, size_bytes: int, seconds: float,
+                     documents: int, cached: bool):
+        """记录单个文件的解析情况"""
+        self.files[file_path] = {
+            "bytes": size_bytes,
+            "parse_seconds": round(seconds, 4),
+            "documents": documents,
+            "cached": cached,
+            "chunks": 0
+        }
+
+    def record_chunks(self, nodes):
+        """按来源文件统计文本块数量"""
+        self.chunks_produced += len(nodes)
+        for node in nodes:
+            file_path = node.metadata.get("file_path")
+            if file_path in self.files:
+                self.files[file_path]["chunks"] += 1
+
+    def record_embedding_batch(self, chunks: int, tokens: int, requests: int, seconds: float):
+        """记录一次成功的embedding批处理"""
+        self.chunks_embedded += chunks
+        self.tokens_embedded += tokens
+        self.embedding_requests += requests
+        self.embedding_seconds += seconds
+
+    def record_retry(self, requests: int, backoff_seconds: float, throttled: bool):
+        """记录一次失败后重试的批处理"""
+        self.embedding_retries += 1
+        self.embedding_requests += requests
+        if throttled:
+            self.throttle_seconds += backoff_seconds
+
+    def record_persist(self, seconds: float, storage_path: Path):
+        """记录索引持久化耗时与各存储文件大小"""
+        self.persist_seconds += seconds
+        # 只统计LlamaIndex存储文件（docstore/index_store/graph_store/*vector_store），不含版本、清单和报告文件
+        for store_file in Path(storage_path).glob("*store.json"):
+            self.store_files[store_file.name] = store_file.stat().st_size
+
+    def slowest_files(self, limit: int = 10) -> List[Dict[str, Any]]:
+        """解析耗时最长的文件"""
+        ranked = sorted(self.files.items(), key=lambda item: item[1]["parse_seconds"], reverse=True)
+        return [{"file_path": path, **stats} for path, stats in ranked[:limit]]
+
+    def to_dict(self) -> Dict[str, Any]:
+        """导出报告"""
+        total_seconds = time.monotonic() - self._start
+        parsed = [stats for stats in self.files.values() if not stats["cached"]]
+        return {
+            "mode": self.mode,
+            "started_at": self.started_at,
+            "finished_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "total_seconds": round(total_seconds, 3),
+            "files": {
+                "discovered": self.files_discovered,
+                "loaded": len(self.files),
+                "parsed": len(parsed),
+                "from_cache": len(self.files) - len(parsed),
+                "bytes_loaded": sum(stats["bytes"] for stats in self.files.values()),
+                "bytes_parsed": sum(stats["bytes"] for stats in parsed),
+                "parse_seconds": round(sum(stats["parse_seconds"] for stats in self.files.values()), 3)
+            },
+            "chunks": {
+                "produced": self.chunks_produced,
+                "from_checkpoint": self.chunks_from_checkpoint,
+                "embedded": self.chunks_embedded
+            },
+            "embedding": {
+                "tokens": self.tokens_embedded,
+                "requests": self.embedding_requests,
+                "retries": self.embedding_retries,
+                "seconds": round(self.embedding_seconds, 3),
+                "throttle_seconds": round(self.throttle_seconds, 3),
+                "chunks_per_second": round(self.chunks_embedded / self.embedding_seconds, 3)
+                if self.embedding_seconds else 0.0
+            },
+            "persist": {
+                "seconds": round(self.persist_seconds, 3),
+                "store_file_bytes": self.store_files
+            },
+            "slowest_files": self.slowest_files(),
+            "per_file": self.files
+        }
+
+    def write(self, storage_path: Path) -> Dict[str, Any]:
+        """写入报告，并向构建历史追加一行摘要用于跟踪吞吐量变化"""
+        report = self.to_dict()
+        storage_path = Path(storage_path)
+        storage_path.mkdir(parents=True, exist_ok=True)
+        atomic_write_json(storage_path / REPORT_FILE_NAME, report)
+
+        summary = {key: report[key] for key in ("mode", "started_at", "total_seconds", "chunks", "embedding")}
+        summary["bytes_parsed"] = report["files"]["bytes_parsed"]
+        with open(storage_path / HISTORY_FILE_NAME, "a", encoding="utf-8") as f:
+            f.write(json.dumps(summary, ensure_ascii=False) + "\n")
+
+        logger.info(f"📊 构建报告已写入: {storage_path / REPORT_FILE_NAME}")
+        logger.info(
+            f"   解析 {report['files']['parsed']} 个文件 ({report['files']['bytes_parsed']} 字节), "
+            f"embedding {report['chunks']['embedded']} 块 / {report['embedding']['tokens']} tokens, "
+            f"请求 {report['embedding']['requests']} 次, 重试 {report['embedding']['retries']} 次"
+        )
+        for item in report["slowest_files"][:3]:
+            logger.info(f"   🐢 {item['file_path']}: {item['parse_seconds']:.2f} 秒")
+        return report
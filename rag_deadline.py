@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+请求截止时间模块
+调用方在请求中携带截止时间，查询服务按阶段分配时间预算：
+时间不足时跳过可选阶段（多样性筛选、诊断），时间耗尽时返回带degraded标记的部分结果，
+而不是等到被父进程kill
+"""
+
+import os
+import time
+from typing import Dict, List, Optional
+
+from rag_metrics import STAGE_SECONDS, FALLBACKS_TOTAL
+
+# 请求未携带截止时间时的默认预算（毫秒），0表示不限制
+DEFAULT_DEADLINE_MS = int(os.getenv("RAG_DEFAULT_DEADLINE_MS", "0"))
+
+# 各阶段开始前至少需要的剩余时间（秒），不足时跳过该阶段
+STAGE_MIN_SECONDS: Dict[str, float] = {
+    "embedding": 0.5,
+    "retrieval": 0.3,
+    "diversity": 0.2,
+    "diagnostics": 0.5,
+}
+
+# 为构建响应和输出结果保留的时间（秒）
+RESPONSE_RESERVE_SECONDS = 0.2
+
+
+class DeadlineExceeded(Exception):
+    """截止时间已到，必需阶段无法继续"""
+
+    def __init__(self, stage: str):
+        super().__init__(f"截止时间已到，未能完成阶段: {stage}")
+        self.stage = stage
+
+
+class Deadline:
+    """请求截止时间 - 记录剩余时间、被跳过的阶段和降级原因"""
+
+    def __init__(self, timeout_seconds: Optional[float] = None):
+        """
+        Args:
+            timeout_seconds: 从现在起的时间预算，None表示不限制
+        """
+        self.started = time.monotonic()
+        self.expires_at = None if timeout_seconds is None else self.started + max(0.0, timeout_seconds)
+        self.skipped_stages: List[str] = []
+        self.stage_timings: Dict[str, float] = {}
+
+    @classmethod
+    def from_request(cls, data: dict) -> "Deadline":
+        """
+        从请求数据创建截止时间
+
+        支持两种字段：
+            deadline_at: 绝对截止时间（Unix时间戳，毫秒），包含进程启动和索引加载耗时
+            deadline_ms: 相对预算（毫秒），从收到请求时开始计算
+        """
+        if data.get("deadline_at"):
+            return cls((float(data["deadline_at"]) / 1000.0) - time.time())
+        if data.get("deadline_ms"):
+            return cls(float(data["deadline_ms"]) / 1000.0)
+        if DEFAULT_DEADLINE_MS > 0:
+            return cls(DEFAULT_DEADLINE_MS / 1000.0)
+        return cls(None)
+
+    @property
+    def bounded(self) -> bool:
+        return self.expires_at is not None
+
+    @property
+    def degraded(self) -> bool:
+        return bool(self.skipped_stages)
+
+    def remaining(self) -> Optional[float]:
+        """剩余秒数，不限制时返回None"""
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.expires_at is not None and time.monotonic() >= self.expires_at
+
+    def allows(self, stage: str) -> bool:
+        """剩余时间是否足够执行该阶段"""
+        remaining = self.remaining()
+        return remaining is None or remaining >= STAGE_MIN_SECONDS.get(stage, 0.0)
+
+    def timeout_for(self, stage: str, reserve: float = RESPONSE_RESERVE_SECONDS) -> Optional[float]:
+        """
+        阶段内单次调用（如embedding请求）可用的超时时间
+
+        为后续必需阶段和构建响应预留时间；不限制时返回None
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return None
+        # embedding之后还必须完成向量检索
+        if stage == "embedding":
+            reserve += STAGE_MIN_SECONDS["retrieval"]
+        return max(0.0, remaining - reserve)
+
+    def require(self, stage: str):
+        """必需阶段：时间不足时抛出DeadlineExceeded"""
+        if not self.allows(stage):
+            raise DeadlineExceeded(stage)
+
+    def skip(self, stage: str):
+        """记录被跳过（或提前结束）的阶段"""
+        if stage not in self.skipped_stages:
+            self.skipped_stages.append(stage)
+            FALLBACKS_TOTAL.inc(reason=f"deadline_{stage}")
+
+    def record(self, stage: str, seconds: float):
+        """记录阶段耗时（同时计入rag_stage_seconds直方图）"""
+        self.stage_timings[stage] = round(seconds, 4)
+        STAGE_SECONDS.observe(seconds, stage=stage)
+
+    def to_dict(self) -> dict:
+        """附加到响应中的截止时间摘要"""
+        remaining = self.remaining()
+        return {
+            "degraded": self.degraded,
+            "skipped_stages": list(self.skipped_stages),
+            "elapsed_ms": int((time.monotonic() - self.started) * 1000),
+            "remaining_ms": None if remaining is None else int(remaining * 1000),
+            "stage_timings": dict(self.stage_timings),
+        }
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+RAG检索诊断模块
+诊断信息以结构化对象收集，仅在请求开启diagnostic_mode时附加到JSON响应中；
+关闭时使用空实现，热路径上不做任何字符串格式化
+"""
+
+import os
+from typing import Any, Callable, Dict, Iterable, Optional
+
+# 诊断信息中每个片段保留的文本预览长度
+PREVIEW_CHARS = 200
+
+# 单一来源占比超过该阈值视为明显的检索偏见
+BIAS_HIGH = 0.6
+BIAS_MILD = 0.4
+
+
+def source_distribution(file_paths: Iterable[str]) -> Dict[str, Any]:
+    """统计检索结果的来源文件分布和偏见程度"""
+    counts: Dict[str, int] = {}
+    for file_path in file_paths:
+        file_name = os.path.basename(file_path or 'unknown')
+        counts[file_name] = counts.get(file_name, 0) + 1
+
+    total = sum(counts.values())
+    if not total:
+        return {"counts": {}, "most_cited": None, "bias_ratio": 0.0, "bias_level": "none"}
+
+    most_cited, most_count = max(counts.items(), key=lambda item: item[1])
+    bias_ratio = most_count / total
+    if bias_ratio > BIAS_HIGH:
+        bias_level = "high"
+    elif bias_ratio > BIAS_MILD:
+        bias_level = "mild"
+    else:
+        bias_level = "balanced"
+
+    return {
+        "counts": dict(sorted(counts.items(), key=lambda item: item[1], reverse=True)),
+        "most_cited": most_cited,
+        "bias_ratio": round(bias_ratio, 4),
+        "bias_level": bias_level
+    }
+
+
+class Diagnostics:
+    """诊断信息收集器 - 每个请求一个实例"""
+
+    enabled = True
+
+    def __init__(self, preview_chars: int = PREVIEW_CHARS):
+        self.preview_chars = preview_chars
+        self._data: Dict[str, Any] = {}
+
+    def set(self, key: str, value: Any):
+        self._data[key] = value
+
+    def append(self, key: str, item: Any):
+        self._data.setdefault(key, []).append(item)
+
+    def record_nodes(self, stage: str, nodes: list, source_of: Optional[Callable[[str], str]] = None):
+        """记录某个阶段的检索片段（得分、来源、节点ID和文本预览）"""
+        records = []
+        for rank, node in enumerate(nodes, 1):
+            metadata = getattr(node, 'metadata', None) or {}
+            file_path = metadata.get('file_path', 'unknown')
+            text = getattr(node, 'text', '') or ''
+            record = {
+                "rank": rank,
+                "score": float(node.score) if getattr(node, 'score', None) is not None else 0.0,
+                "file_path": file_path,
+                "node_id": getattr(node, 'node_id', None),
+                "text_length": len(text),
+                "text_preview": text[:self.preview_chars]
+            }
+            if source_of is not None:
+                record["source"] = source_of(file_path)
+            records.append(record)
+        self._data[stage] = records
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(self._data)
+
+
+class NullDiagnostics:
+    """诊断关闭时的空实现，所有记录调用直接返回"""
+
+    enabled = False
+
+    def set(self, key: str, value: Any):
+        pass
+
+    def append(self, key: str, item: Any):
+        pass
+
+    def record_nodes(self, stage: str, nodes: list, source_of: Optional[Callable[[str], str]] = None):
+        pass
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {}
+
+
+NULL_DIAGNOSTICS = NullDiagnostics()
+
+
+def create_diagnostics(enabled: bool):
+    """按请求的diagnostic_mode返回收集器或共享的空实现"""
+    return Diagnostics() if enabled else NULL_DIAGNOSTICS
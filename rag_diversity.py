@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+来源多样性筛选
+按作者识别检索片段的来源，从相关性排序的候选片段中均衡选取（每个作者最多2个），
+并按来源组织知识回答；增强版查询服务和Flask报告函数共用
+"""
+
+import logging
+from collections import defaultdict
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from rag_diagnostics import NULL_DIAGNOSTICS
+
+logger = logging.getLogger(__name__)
+
+# 知识源 -> 文件名标识
+KNOWLEDGE_SOURCES: Dict[str, List[str]] = {
+    'jordan_peterson': ['12-Rules-for-Life.pdf', 'jordan peterson2.pdf', 'Jordan_Peterson_Toxic_Masculinity_FINAL'],
+    'sadia_khan': ['Sadia Khan', 'sadia khan'],
+    'red_pill': ['红药丸', '紅藥丸', 'Week'],
+    'mystery_method': ['谜男方法.pdf'],
+    'abovelight': ['AB的異想世界']
+}
+
+SOURCE_NAMES = {
+    'jordan_peterson': 'Jordan Peterson心理学观点',
+    'sadia_khan': 'Sadia Khan关系分析',
+    'red_pill': '红药丸理论观点',
+    'mystery_method': '谜男方法技巧',
+    'abovelight': 'AboveLight观点',
+    'other': '其他专业观点'
+}
+
+# 每个作者最多入选的片段数
+MAX_PER_SOURCE = 2
+
+
+def identify_source(file_path: str, knowledge_sources: Optional[Dict[str, List[str]]] = None) -> str:
+    """识别文档来源"""
+    if not file_path:
+        return 'unknown'
+
+    file_name = Path(file_path).name.lower()
+
+    # 检查每个知识源的标识符
+    for source, identifiers in (knowledge_sources or KNOWLEDGE_SOURCES).items():
+        for identifier in identifiers:
+            if identifier.lower() in file_name:
+                return source
+
+    return 'other'
+
+
+def select_diverse(candidates: list, top_k: int = 5, source_of: Callable[[str], str] = identify_source,
+                   diagnostics=NULL_DIAGNOSTICS) -> list:
+    """
+    从按相关性排序的候选片段中均衡选取
+
+    第一轮每个作者取最相关的1个，第二轮每个作者再取1个，
+    仍有空位时按原始相关性填充（每个作者最多MAX_PER_SOURCE个）
+
+    Args:
+        candidates: 候选片段（带metadata、score的节点，按相关性降序）
+        top_k: 选取数量
+        source_of: 文件路径 -> 作者
+        diagnostics: 诊断收集器（rag_diagnostics），关闭时为空实现
+    """
+    if not candidates:
+        return []
+
+    final_knowledge_list = []
+    author_count = {}  # 统计每个作者的片段数量
+
+    # 候选片段已按相关性排序，按作者分组
+    author_groups = {}
+    for i, node in enumerate(candidates):
+        file_path = getattr(node, 'metadata', {}).get('file_path', 'unknown')
+        author_groups.setdefault(source_of(file_path), []).append((i, node))
+
+    if diagnostics.enabled:
+        diagnostics.set("author_groups", {author: len(nodes) for author, nodes in author_groups.items()})
+
+    # 如果有多个作者，优先确保多样性
+    if len(author_groups) > 1:
+        diagnostics.set("strategy", "multi_author")
+
+        # 第一轮：每个作者选择最好的1个片段
+        for author, nodes in author_groups.items():
+            if len(final_knowledge_list) < top_k:
+                final_knowledge_list.append(nodes[0][1])
+                author_count[author] = 1
+                diagnostics.append("selection", {"round": 1, "source": author, "candidate_rank": nodes[0][0] + 1})
+
+        # 第二轮：如果还有空位，每个作者再选择1个片段
+        for author, nodes in author_groups.items():
+            if len(final_knowledge_list) < top_k and len(nodes) > 1:
+                if author_count.get(author, 0) < MAX_PER_SOURCE:
+                    final_knowledge_list.append(nodes[1][1])
+                    author_count[author] = author_count.get(author, 0) + 1
+                    diagnostics.append("selection", {"round": 2, "source": author, "candidate_rank": nodes[1][0] + 1})
+
+        # 第三轮：如果仍有空位，按相关性继续填充（仍遵守每作者上限）
+        if len(final_knowledge_list) < top_k:
+            remaining_candidates = []
+            for author, nodes in author_groups.items():
+                for i, node in nodes[2:]:  # 从第3个片段开始
+                    remaining_candidates.append((i, node, author))
+
+            # 按原始相关性排序
+            remaining_candidates.sort(key=lambda x: x[0])
+
+            for original_index, node, author in remaining_candidates:
+                if len(final_knowledge_list) >= top_k:
+                    break
+                if author_count.get(author, 0) < MAX_PER_SOURCE:
+                    final_knowledge_list.append(node)
+                    author_count[author] = author_count.get(author, 0) + 1
+                    diagnostics.append("selection", {"round": 3, "source": author, "candidate_rank": original_index + 1})
+
+    else:
+        # 单一作者模式：直接按相关性选择，但仍遵守每作者上限
+        diagnostics.set("strategy", "single_author")
+        author = list(author_groups.keys())[0]
+        nodes = author_groups[author]
+
+        for i, (original_index, node) in enumerate(nodes):
+            if i >= MAX_PER_SOURCE or len(final_knowledge_list) >= top_k:
+                break
+            final_knowledge_list.append(node)
+            author_count[author] = author_count.get(author, 0) + 1
+            diagnostics.append("selection", {"round": 1, "source": author, "candidate_rank": original_index + 1})
+
+    # === 多样性验证 ===
+    max_author_count = max(author_count.values()) if author_count else 0
+    if max_author_count > MAX_PER_SOURCE:
+        logger.warning("⚠️ 约束验证失败: 发现作者超出限制 (%d个片段)", max_author_count)
+
+    if diagnostics.enabled:
+        diagnostics.set("final_distribution", dict(author_count))
+        diagnostics.set("unique_authors", len(author_count))
+        diagnostics.set("constraint_ok", max_author_count <= MAX_PER_SOURCE)
+        diagnostics.record_nodes("selected", final_knowledge_list, source_of)
+
+    return final_knowledge_list
+
+
+def build_knowledge_answer(nodes: list, source_of: Callable[[str], str] = identify_source) -> str:
+    """按来源组织检索片段，构建知识回答"""
+    if not nodes:
+        return "未找到相关知识内容。"
+
+    content_by_source = defaultdict(list)
+    for node in nodes:
+        content_by_source[source_of(node.metadata.get('file_path', ''))].append(node.text[:300])
+
+    answer_parts = []
+    for source, contents in content_by_source.items():
+        if contents:
+            source_name = SOURCE_NAMES.get(source, source)
+            combined_content = ' '.join(contents[:2])  # 每个来源最多2段内容
+            answer_parts.append(f"【{source_name}】\n{combined_content}")
+
+    return '\n\n'.join(answer_parts)
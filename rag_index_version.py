@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+RAG索引版本管理模块
+每个版本的索引文件写入独立目录（versions/v<版本号>），写完后原子地写入版本文件发布；
+版本文件记录版本号和索引目录，查询服务只加载版本文件指向的目录，不会读到新旧混合的存储文件
+"""
+
+import os
+import json
+import time
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+# 版本文件名（位于索引存储目录下）
+VERSION_FILE_NAME = "index_version.json"
+
+# 各版本索引目录的父目录（位于索引存储目录下）
+VERSIONS_DIR_NAME = "versions"
+
+# 保留的历史版本数（正在加载旧版本的查询服务不受清理影响）
+KEEP_OLD_VERSIONS = 2
+
+
+def atomic_write_json(path: Path, data: Any):
+    """先写入同目录临时文件再替换，读取方永远不会看到写了一半的文件"""
+    path = Path(path)
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{path.name}.", dir=str(path.parent))
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def read_index_version(storage_path: str) -> Optional[Dict[str, Any]]:
+    """读取当前索引版本信息，不存在时返回None"""
+    version_file = Path(storage_path) / VERSION_FILE_NAME
+    try:
+        return json.loads(version_file.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+
+
+def bump_index_version(storage_path: str, changed_files: Optional[List[str]] = None,
+                       index_dir: Optional[str] = None) -> int:
+    """
+    递增索引版本号（发布新版本）
+
+    Args:
+        storage_path: 索引存储路径
+        changed_files: 本次更新涉及的文件（仅用于记录）
+        index_dir: 新版本索引文件所在目录（相对storage_path），不提供时索引文件位于storage_path下
+
+    Returns:
+        新的版本号
+    """
+    current = read_index_version(storage_path) or {}
+    version = int(current.get("version", 0)) + 1
+    info = {
+        "version": version,
+        "updated_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "changed_files": changed_files or []
+    }
+    if index_dir:
+        info["index_dir"] = index_dir
+    atomic_write_json(Path(storage_path) / VERSION_FILE_NAME, info)
+    return version
+
+
+def next_version_dir(storage_path: str) -> str:
+    """下一个版本的索引目录（相对storage_path）"""
+    return f"{VERSIONS_DIR_NAME}/v{current_version_number(storage_path) + 1}"
+
+
+def index_persist_dir(storage_path: str, info: Optional[Dict[str, Any]] = None) -> Path:
+    """
+    当前发布版本的索引目录（传给StorageContext.from_defaults(persist_dir=...)）
+
+    Args:
+        storage_path: 索引存储路径
+        info: 已读取的版本信息（与版本号保持一致时传入），默认重新读取
+
+    Returns:
+        版本文件记录的索引目录；旧版本文件没有index_dir时为storage_path本身
+    """
+    info = read_index_version(storage_path) if info is None else info
+    index_dir = (info or {}).get("index_dir")
+    return Path(storage_path) / index_dir if index_dir else Path(storage_path)
+
+
+def prune_index_versions(storage_path: str, keep: int = KEEP_OLD_VERSIONS):
+    """删除当前版本和最近keep个历史版本之外的索引目录"""
+    versions_dir = Path(storage_path) / VERSIONS_DIR_NAME
+    if not versions_dir.is_dir():
+        return
+    current = current_version_number(storage_path)
+    old = sorted(
+        (path for path in versions_dir.iterdir()
+         if path.is_dir() and path.name[1:].isdigit() and int(path.name[1:]) < current),
+        key=lambda path: int(path.name[1:]),
+        reverse=True
+    )
+    for path in old[keep:]:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def current_version_number(storage_path: str) -> int:
+    """返回当前版本号，未发布过版本时为0"""
+    info = read_index_version(storage_path)
+    return int(info.get("version", 0)) if info else 0
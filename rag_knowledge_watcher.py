@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+知识库目录监听模块
+监听my_knowledge/下的文件变化（优先使用watchdog/inotify，未安装时回退到轮询），
+对文件事件做去抖动处理后批量回调；回调失败的文件保持待处理状态，间隔一段时间后重试
+"""
+
+import time
+import logging
+import threading
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Optional, Set, Tuple
+
+# watchdog为可选依赖：Linux下基于inotify，未安装时使用轮询
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+logger = logging.getLogger(__name__)
+
+SUPPORTED_EXTENSIONS = {'.pdf', '.txt', '.docx'}
+
+
+def scan_knowledge_files(knowledge_path: Path) -> Dict[str, Tuple[int, int]]:
+    """扫描知识库，返回 {文件路径: (修改时间ns, 文件大小)}"""
+    snapshot = {}
+    root = Path(knowledge_path)
+    for path in root.rglob("*"):
+        # 与SimpleDirectoryReader一致，忽略隐藏文件和隐藏目录
+        if any(part.startswith('.') for part in path.relative_to(root).parts):
+            continue
+        if path.is_file() and path.suffix.lower() in SUPPORTED_EXTENSIONS:
+            stat = path.stat()
+            snapshot[str(path)] = (stat.st_mtime_ns, stat.st_size)
+    return snapshot
+
+
+class _PendingEvents(FileSystemEventHandler):
+    """收集watchdog文件事件"""
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.paths: Set[str] = set()
+        self.last_event = 0.0
+
+    def on_any_event(self, event):
+        if event.is_directory:
+            return
+        with self.lock:
+            for path in (getattr(event, 'src_path', None), getattr(event, 'dest_path', None)):
+                if path and Path(path).suffix.lower() in SUPPORTED_EXTENSIONS:
+                    self.paths.add(str(path))
+                    self.last_event = time.monotonic()
+
+
+class KnowledgeWatcher:
+    """知识库监听器 - 去抖动后回调 (新增/修改的文件, 删除的文件)"""
+
+    def __init__(self, knowledge_path: str, on_change: Callable[[Iterable[str], Iterable[str]], Optional[bool]],
+                 debounce_seconds: float = 3.0, poll_interval: float = 5.0, use_polling: bool = False,
+                 retry_interval: float = 30.0):
+        """
+        Args:
+            knowledge_path: 知识库文件夹路径
+            on_change: 回调函数，参数为新增/修改文件列表和删除文件列表；返回False或抛出异常表示处理失败
+            debounce_seconds: 最后一次文件事件之后等待的静默时间
+            poll_interval: 轮询模式下的扫描间隔
+            use_polling: 强制使用轮询模式
+            retry_interval: 处理失败的文件的重试间隔
+        """
+        self.knowledge_path = Path(knowledge_path)
+        self.on_change = on_change
+        self.debounce_seconds = debounce_seconds
+        self.poll_interval = poll_interval
+        self.use_polling = use_polling or Observer is None
+        self.retry_interval = retry_interval
+        self._stop = threading.Event()
+        self._snapshot = scan_knowledge_files(self.knowledge_path)
+        # 上次处理失败的文件及下次重试时间
+        self._failed: Set[str] = set()
+        self._retry_at = 0.0
+
+    def stop(self):
+        """停止监听"""
+        self._stop.set()
+
+    def _flush(self):
+        """与上次快照比较，计算真实发生变化的文件并回调；只有处理成功的文件才记入快照"""
+        current = scan_knowledge_files(self.knowledge_path)
+        changed = [p for p, sig in current.items() if self._snapshot.get(p) != sig]
+        removed = [p for p in self._snapshot if p not in current]
+        if not changed and not removed:
+            self._snapshot = current
+            return
+
+        # 只有上次失败的文件待处理时，等到重试时间再处理
+        if set(changed + removed) <= self._failed and time.monotonic() < self._retry_at:
+            return
+
+        logger.info(f"📥 检测到知识库变化: {len(changed)} 个新增/修改, {len(removed)} 个删除")
+        try:
+            succeeded = self.on_change(changed, removed) is not False
+        except Exception as e:
+            logger.error(f"❌ 处理知识库变化失败: {str(e)}")
+            succeeded = False
+
+        if succeeded:
+            self._snapshot = current
+            self._failed = set()
+            return
+
+        # 失败的文件保留旧签名（删除的文件保留在快照中），下次扫描时仍会被识别为变化
+        snapshot = {p: sig for p, sig in current.items() if p not in changed}
+        snapshot.update({p: self._snapshot[p] for p in changed if p in self._snapshot})
+        snapshot.update({p: self._snapshot[p] for p in removed})
+        self._snapshot = snapshot
+        self._failed = set(changed + removed)
+        self._retry_at = time.monotonic() + self.retry_interval
+        logger.warning(f"⚠️ {len(self._failed)} 个文件处理失败，{self.retry_interval:.0f} 秒后重试")
+
+    def _safe_flush(self):
+        """监听循环中的处理：异常只记录日志，监听进程继续运行"""
+        try:
+            self._flush()
+        except Exception as e:
+            logger.error(f"❌ 知识库扫描失败: {str(e)}")
+
+    def run(self):
+        """阻塞运行，直到stop()被调用"""
+        if self.use_polling:
+            logger.info(f"👀 开始监听知识库（轮询模式，间隔 {self.poll_interval} 秒）: {self.knowledge_path}")
+            self._run_polling()
+        else:
+            logger.info(f"👀 开始监听知识库（inotify模式）: {self.knowledge_path}")
+            self._run_observer()
+
+    def _run_polling(self):
+        pending_snapshot = None
+        last_change = 0.0
+        while not self._stop.wait(self.poll_interval if pending_snapshot is None else 0.5):
+            try:
+                current = scan_knowledge_files(self.knowledge_path)
+            except Exception as e:
+                logger.error(f"❌ 知识库扫描失败: {str(e)}")
+                continue
+            if current == self._snapshot:
+                pending_snapshot = None
+                continue
+            # 文件仍在写入时签名会持续变化，等待其稳定后再处理
+            if current != pending_snapshot:
+                pending_snapshot = current
+                last_change = time.monotonic()
+                continue
+            if time.monotonic() - last_change >= self.debounce_seconds:
+                pending_snapshot = None
+                self._safe_flush()
+
+    def _run_observer(self):
+        handler = _PendingEvents()
+        observer = Observer()
+        observer.schedule(handler, str(self.knowledge_path), recursive=True)
+        observer.start()
+        try:
+            while not self._stop.wait(0.5):
+                with handler.lock:
+                    ready = handler.paths and time.monotonic() - handler.last_event >= self.debounce_seconds
+                    if ready:
+                        handler.paths.clear()
+                # 上次处理失败的文件到期重试（不会再产生新的文件事件）
+                retry = self._failed and time.monotonic() >= self._retry_at
+                if ready or retry:
+                    self._safe_flush()
+        finally:
+            observer.stop()
+            observer.join()
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Prometheus格式指标模块
+进程内线程安全的计数器、仪表和直方图，以Prometheus文本格式输出（无需prometheus_client依赖）；
+Flask应用通过/metrics路由输出，常驻worker通过内置的HTTP端口输出
+"""
+
+import time
+import asyncio
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 默认直方图桶（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _label_key(labelnames: Tuple[str, ...], labels: Dict[str, str]) -> Tuple[str, ...]:
+    if set(labels) != set(labelnames):
+        raise ValueError(f"标签不匹配: 需要 {labelnames}，实际 {tuple(labels)}")
+    return tuple(str(labels[name]) for name in labelnames)
+
+
+def _format_labels(labelnames: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    pairs = [
+        '%s="%s"' % (name, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in zip(labelnames, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{%s}" % ",".join(pairs) if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    """单调递增计数器"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(_label_key(self.labelnames, labels), 0.0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return self._header() + [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in items
+        ]
+
+
+class Gauge(_Metric):
+    """可增可减的仪表"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = float(value)
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return self._header() + [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in items
+        ]
+
+
+class Histogram(_Metric):
+    """累积直方图（桶计数 + 总和 + 次数）"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        # 每组标签: [各桶计数..., 总和, 次数]
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0.0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """计时上下文：退出时记录耗时（异常时同样记录）"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted((key, list(state)) for key, state in self._values.items())
+        lines = self._header()
+        for key, state in items:
+            for bound, count in zip(self.buckets, state):
+                le = 'le="%s"' % _format_value(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {_format_value(count)}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(state[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {_format_value(state[-1])}")
+        return lines
+
+
+class Registry:
+    """指标注册表，同名指标只创建一次"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name: str, documentation: str, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, **kwargs)
+            return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self._get_or_create(Counter, name, documentation, labelnames=labelnames)
+
+    def gauge(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Gauge:
+        return self._get_or_create(Gauge, name, documentation, labelnames=labelnames)
+
+    def histogram(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                  buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, documentation, labelnames=labelnames, buckets=buckets)
+
+    def render(self) -> str:
+        """Prometheus文本格式"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# === RAG与报告服务的公共指标 ===
+STAGE_SECONDS = REGISTRY.histogram(
+    "rag_stage_seconds", "RAG各阶段耗时（embedding、retrieval、diversity）", ["stage"]
+)
+REPORT_GENERATION_SECONDS = REGISTRY.histogram(
+    "report_generation_seconds", "LLM报告生成耗时", buckets=(0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+)
+REQUESTS_TOTAL = REGISTRY.counter(
+    "rag_requests_total", "处理的请求数", ["service", "status"]
+)
+CACHE_HITS_TOTAL = REGISTRY.counter("rag_cache_hits_total", "缓存命中次数", ["cache"])
+CACHE_MISSES_TOTAL = REGISTRY.counter("rag_cache_misses_total", "缓存未命中次数", ["cache"])
+UPSTREAM_ERRORS_TOTAL = REGISTRY.counter(
+    "openai_upstream_error_responses_total",
+    "OpenAI接口返回的限流/超时/服务端错误响应数（408/409/429/5xx，按上游响应计，不代表客户端实际重试）",
+    ["status"]
+)
+HEDGED_REQUESTS_TOTAL = REGISTRY.counter("embedding_hedged_requests_total", "embedding对冲请求次数")
+FALLBACKS_TOTAL = REGISTRY.counter("rag_fallbacks_total", "降级或备用结果次数", ["reason"])
+INDEX_VERSION = REGISTRY.gauge("rag_index_version", "当前加载的索引版本号")
+INDEX_RELOADS_TOTAL = REGISTRY.counter("rag_index_reloads_total", "检测到新版本后重新加载索引的次数")
+JOBS_TOTAL = REGISTRY.counter("report_jobs_total", "报告任务数（submitted/rejected/completed/failed/lease_lost）", ["status"])
+JOBS_PENDING = REGISTRY.gauge("report_jobs_pending", "排队和执行中的报告任务数", ["state"])
+COALESCED_REQUESTS_TOTAL = REGISTRY.counter(
+    "rag_coalesced_requests_total", "合并到进行中的相同请求、共享其结果的次数", ["flight"]
+)
+PROMPT_TOKENS = REGISTRY.histogram(
+    "report_prompt_tokens", "报告提示词各部分按预算裁剪后的token数（section=total为整个提示词）", ["section"],
+    buckets=(64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+)
+PROMPT_TRIMMED_TOTAL = REGISTRY.counter("report_prompt_trimmed_total", "超出预算被裁剪的提示词部分", ["section"])
+REPORT_TOKENS_TOTAL = REGISTRY.counter("report_tokens_total", "报告生成消耗的token数（in=提示词，out=输出）", ["direction"])
+
+
+def render_metrics() -> str:
+    return REGISTRY.render()
+
+
+async def start_metrics_server(port: int, host: str = "0.0.0.0"):
+    """
+    启动只提供GET /metrics的最小HTTP服务（供常驻worker使用，运行在worker的事件循环中）
+
+    Returns:
+        asyncio.Server
+    """
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            # 读完请求头
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body, content_type = "200 OK", render_metrics().encode("utf-8"), CONTENT_TYPE
+            else:
+                status, body, content_type = "404 Not Found", b"not found\n", "text/plain"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+            )
+            await writer.drain()
+        except Exception as e:
+            logger.warning("⚠️ metrics请求处理失败: %s", e)
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logger.info("📈 metrics端点已启动: http://%s:%d/metrics", host, port)
+    return server
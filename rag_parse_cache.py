@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+文档解析缓存模块
+缓存PDF/DOCX等文件提取出的纯文本和页面元数据，以文件内容哈希+解析器版本为键，
+调整chunk_size/chunk_overlap等参数重新构建时无需再次解析文档
+"""
+
+import json
+import hashlib
+import logging
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from rag_index_version import atomic_write_json
+
+logger = logging.getLogger(__name__)
+
+# 解析逻辑或读取器配置变化时递增，使旧缓存失效
+PARSER_VERSION = "2"
+
+# 缓存目录名（位于索引存储目录下）
+PARSE_CACHE_DIR_NAME = ".parse_cache"
+
+# 随文件位置变化、不应从缓存中恢复的元数据字段
+PATH_METADATA_KEYS = ("file_path", "file_name")
+
+# 随文件属性变化（touch、复制）的元数据字段，命中缓存时按文件当前状态重新生成
+STAT_METADATA_KEYS = ("file_size", "creation_date", "last_modified_date", "last_accessed_date")
+
+# 与文本一起缓存的Document属性（读取器设置的、不参与embedding/LLM输入的元数据字段）
+EXCLUDED_KEY_FIELDS = ("excluded_embed_metadata_keys", "excluded_llm_metadata_keys")
+
+
+def file_sha256(file_path: str) -> str:
+    """计算文件内容的SHA256"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _reader_version() -> str:
+    """LlamaIndex读取器版本，升级后解析结果可能不同"""
+    try:
+        from importlib.metadata import version
+        return version("llama-index-core")
+    except Exception:
+        return "unknown"
+
+
+class ParsedDocumentCache:
+    """解析结果缓存 - 每个文件一条记录，内容为该文件解析出的所有文档片段"""
+
+    def __init__(self, storage_path: str):
+        """
+        Args:
+            storage_path: 索引存储路径，缓存保存在其子目录中
+        """
+        self.cache_dir = Path(storage_path) / PARSE_CACHE_DIR_NAME
+        self.parser_version = f"{PARSER_VERSION}-{_reader_version()}"
+        self.hits = 0
+        self.misses = 0
+
+    def _entry_path(self, file_hash: str) -> Path:
+        version_tag = hashlib.sha256(self.parser_version.encode("utf-8")).hexdigest()[:12]
+        return self.cache_dir / f"{file_hash}-{version_tag}.json"
+
+    def get(self, file_hash: str, file_path: str) -> Optional[List[Dict[str, Any]]]:
+        """
+        读取缓存的解析结果
+
+        Args:
+            file_hash: 文件内容哈希
+            file_path: 文件当前路径（用于刷新路径相关元数据）
+
+        Returns:
+            [{"text": 文本, "metadata": 元数据, "excluded_embed_metadata_keys": [...],
+              "excluded_llm_metadata_keys": [...]}, ...]，未命中时返回None；
+            文件属性相关的元数据（STAT_METADATA_KEYS）由调用方按文件当前状态补充
+        """
+        entry_path = self._entry_path(file_hash)
+        try:
+            with open(entry_path, "r", encoding="utf-8") as f:
+                records = json.load(f)["documents"]
+        except (OSError, ValueError, KeyError):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        for record in records:
+            record["metadata"]["file_path"] = file_path
+            record["metadata"]["file_name"] = Path(file_path).name
+        return records
+
+    def put(self, file_hash: str, records: List[Dict[str, Any]]):
+        """保存解析结果"""
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        stored = []
+        for record in records:
+            metadata = {k: v for k, v in record["metadata"].items()
+                        if k not in PATH_METADATA_KEYS and k not in STAT_METADATA_KEYS}
+            stored.append({
+                "text": record["text"],
+                "metadata": metadata,
+                **{field: list(record.get(field, [])) for field in EXCLUDED_KEY_FIELDS}
+            })
+        atomic_write_json(self._entry_path(file_hash), {
+            "parser_version": self.parser_version,
+            "documents": stored
+        })
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Python服务与server.js之间的输出协议
+    - 紧凑JSON（无缩进、不转义中文）
+    - 长度前缀帧：每帧为一行帧头 "@<类型> <字节数>" 加上对应字节数的JSON和一个换行，
+      结果分阶段输出（先检索结果，再报告），调用方收到检索帧即可开始后续处理
+    - 字段掩码：回显的user_info、文本片段等大字段仅在请求的fields中列出时才输出
+"""
+
+import sys
+import json
+from typing import Any, Iterable, Optional
+
+# 请求中选择帧协议的取值（"output": "frames"）
+OUTPUT_FRAMES = "frames"
+
+# 帧类型
+FRAME_RETRIEVAL = "retrieval"
+FRAME_REPORT = "report"
+FRAME_ERROR = "error"
+FRAME_END = "end"
+
+# 可通过字段掩码选择的大字段
+FIELD_USER_INFO = "user_info"
+FIELD_SNIPPETS = "snippets"
+
+
+def dumps_compact(payload: Any) -> str:
+    """紧凑JSON序列化"""
+    return json.dumps(payload, ensure_ascii=False, separators=(',', ':'))
+
+
+def wants_field(fields: Optional[Iterable[str]], name: str) -> bool:
+    """字段掩码：未提供fields时输出全部字段（兼容旧调用方）"""
+    return fields is None or name in fields
+
+
+def request_fields(data: dict) -> Optional[set]:
+    """从请求中读取字段掩码"""
+    fields = data.get('fields')
+    return None if fields is None else set(fields)
+
+
+def wants_frames(data: dict) -> bool:
+    return data.get('output') == OUTPUT_FRAMES
+
+
+class FrameWriter:
+    """长度前缀帧写入器，每帧写完立即flush"""
+
+    def __init__(self, stream=None):
+        """
+        Args:
+            stream: 二进制输出流，默认为原始stdout（不受stdout重定向影响）
+        """
+        self.stream = stream if stream is not None else sys.__stdout__.buffer
+
+    def write(self, frame_type: str, payload: Any):
+        body = dumps_compact(payload).encode('utf-8')
+        self.stream.write(b'@%s %d\n' % (frame_type.encode('ascii'), len(body)) + body + b'\n')
+        self.stream.flush()
+
+    def end(self):
+        self.write(FRAME_END, {})
@@ -12,9 +12,10 @@ load_dotenv()
 import os
 import sys
 import json
+import time
 import logging
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 
 # 完全禁用所有可能的输出到stdout
 import warnings
@@ -42,12 +43,22 @@ try:
         load_index_from_storage,
         Settings
     )
-    from llama_index.embeddings.openai import OpenAIEmbedding
-    from llama_index.core.llms import MockLLM
+    from openai_clients import PooledOpenAIEmbedding
 finally:
     # 恢复stdout
     sys.stdout = original_stdout
 
+from context_packer import ContextPacker, REPORT_PROMPT_TEMPLATE
+from token_counter import truncate_to_tokens
+from query_windows import split_into_windows, retrieve_with_embeddings
+from rag_deadline import Deadline, DeadlineExceeded
+from rag_diagnostics import create_diagnostics, source_distribution
+from rag_index_version import index_persist_dir
+from rag_protocol import (
+    FIELD_SNIPPETS, FIELD_USER_INFO, FRAME_ERROR, FRAME_REPORT, FRAME_RETRIEVAL,
+    request_fields, wants_field, wants_frames, dumps_compact, FrameWriter
+)
+
 # 配置日志，重定向到stderr避免污染stdout
 logging.basicConfig(
     level=logging.CRITICAL,  # 只输出严重错误
@@ -56,6 +67,17 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# 是否启用embedding对冲请求
+EMBEDDING_HEDGE = os.getenv("RAG_EMBEDDING_HEDGE", "1") == "1"
+
+# 检索候选片段数量（打包器会在token预算内从中挑选）
+CANDIDATE_TOP_K = 10
+
+# 报告阶段的token预算
+RAG_CONTEXT_WINDOW = int(os.getenv("RAG_CONTEXT_WINDOW", "4096"))
+RAG_NUM_OUTPUT = int(os.getenv("RAG_NUM_OUTPUT", "1024"))
+RAG_MAX_QUERY_TOKENS = int(os.getenv("RAG_MAX_QUERY_TOKENS", "512"))
+
 class RAGQueryService:
     """RAG查询服务类 - OpenAI版本"""
     
@@ -68,7 +90,13 @@ class RAGQueryService:
         """
         self.storage_path = Path(storage_path)
         self.index = None
-        self.query_engine = None
+        self.retriever = None
+        self.packer = ContextPacker(
+            context_window=RAG_CONTEXT_WINDOW,
+            num_output=RAG_NUM_OUTPUT,
+            prompt_template=REPORT_PROMPT_TEMPLATE.format(context="", query=""),
+            max_query_tokens=RAG_MAX_QUERY_TOKENS
+        )
         
         # 初始化状态
         self.is_initialized = False
@@ -99,27 +127,21 @@ class RAGQueryService:
         # 获取OpenAI API基础URL
         openai_api_base = os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1")
         
-        # 使用OpenAI embedding
-        Settings.embed_model = OpenAIEmbedding(
+        # 使用OpenAI embedding（共享连接池，交互式查询启用对冲请求降低尾延迟）
+        Settings.embed_model = PooledOpenAIEmbedding(
             model="text-embedding-3-small",
             api_key=openai_api_key,
-            api_base=openai_api_base
+            api_base=openai_api_base,
+            hedge=EMBEDDING_HEDGE
         )
         
-        # 使用MockLLM避免LLM调用，同时设置极其保守的参数
-        Settings.llm = MockLLM(max_tokens=128)
-        
-        # 设置极其保守的上下文参数避免超出限制
-        Settings.chunk_size = 128    # 极小的chunk size
-        Settings.chunk_overlap = 20   # 极小的overlap
-        Settings.context_window = 512 # 极小的上下文窗口
-        Settings.num_output = 64      # 极小的输出长度
-        
+        # 只做检索，不创建查询引擎也不调用LLM；上下文大小由ContextPacker按token预算控制
         logger.debug("LlamaIndex配置完成 (OpenAI Embedding)")
     
     def load_index(self):
         """加载已存在的索引"""
-        if not (self.storage_path / "index_store.json").exists():
+        persist_dir = index_persist_dir(self.storage_path)
+        if not (persist_dir / "index_store.json").exists():
             return False
         
         try:
@@ -129,17 +151,11 @@ class RAGQueryService:
             
             try:
                 # 从存储中加载索引
-                storage_context = StorageContext.from_defaults(persist_dir=str(self.storage_path))
+                storage_context = StorageContext.from_defaults(persist_dir=str(persist_dir))
                 self.index = load_index_from_storage(storage_context)
                 
-                # 创建查询引擎 - 使用最最保守的设置避免上下文问题
-                self.query_engine = self.index.as_query_engine(
-                    similarity_top_k=5,         # 优化：取5个最相关的文档片段，提升知识库覆盖度
-                    response_mode="compact",    # 使用compact模式
-                    text_qa_template=None,      # 不使用模板
-                    streaming=False,
-                    verbose=False               # 禁用verbose输出
-                )
+                # 创建检索器 - 多取一些候选，由打包器按token预算挑选
+                self.retriever = self.index.as_retriever(similarity_top_k=CANDIDATE_TOP_K)
             finally:
                 # 恢复stdout
                 sys.stdout = original_stdout
@@ -150,14 +166,17 @@ class RAGQueryService:
             logger.error(f"加载索引失败: {str(e)}")
             return False
     
-    def query(self, question: str, context: str = "", diagnostic_mode: bool = False) -> Dict[str, Any]:
+    def query(self, question: str, context: str = "", diagnostic_mode: bool = False,
+              windows: Optional[List[str]] = None, deadline: Optional[Deadline] = None) -> Dict[str, Any]:
         """
         执行RAG查询
         
         Args:
             question: 查询问题
             context: 额外上下文
-            diagnostic_mode: 是否启用诊断模式，输出详细检索信息到stderr
+            diagnostic_mode: 是否启用诊断模式，结构化诊断信息随结果返回（"diagnostics"字段）
+            windows: 聊天记录切分出的查询窗口；提供时逐窗口检索并融合结果
+            deadline: 请求截止时间；时间不足时跳过诊断，超时返回降级结果
             
         Returns:
             查询结果字典
@@ -172,126 +191,77 @@ class RAGQueryService:
                 "sources_count": 0
             }
         
+        deadline = deadline or Deadline()
+        
         try:
-            # 构建查询 - 截断过长的内容避免上下文超限
-            if len(question) > 100:
-                question = question[:100] + "..."
-            
-            if context and len(context) > 50:
-                context = context[:50] + "..."
-            
+            # 构建查询 - 按token预算限制查询长度
             full_query = f"{question}\n{context}" if context else question
+            full_query = truncate_to_tokens(full_query, self.packer.max_query_tokens)
+            
+            # 有查询窗口时每个窗口附带资料摘要，批量embedding后逐窗口检索并融合
+            queries = [f"{full_query}\n{window}" for window in windows] if windows else [full_query]
             
             # 临时重定向stdout，防止查询过程的输出
             original_stdout = sys.stdout
             sys.stdout = DevNull()
             
             try:
-                # 执行查询
-                response = self.query_engine.query(full_query)
+                candidate_nodes = self._retrieve_within_deadline(queries, deadline)
             finally:
                 # 恢复stdout
                 sys.stdout = original_stdout
             
+            # 诊断是可选阶段，剩余时间不足时跳过
+            if diagnostic_mode and not deadline.allows("diagnostics"):
+                deadline.skip("diagnostics")
+                diagnostic_mode = False
+            diagnostics = create_diagnostics(diagnostic_mode)
+            
+            # 在token预算内挑选价值最高的片段
+            plan = self.packer.pack(full_query, [
+                {"text": node.text, "score": node.score, "node": node}
+                for node in candidate_nodes
+            ])
+            source_nodes = [candidate["node"] for candidate in plan["selected"]]
+            
             # 提取源信息
             sources = []
-            if hasattr(response, 'source_nodes'):
-                # 🔍 诊断模式：详细输出检索信息到stderr
-                if diagnostic_mode:
-                    print("\n" + "="*80, file=sys.stderr)
-                    print("🔬 RAG系统检索诊断报告", file=sys.stderr)
-                    print("="*80, file=sys.stderr)
-                    print(f"📝 查询问题: {question}", file=sys.stderr)
-                    if context.strip():
-                        print(f"📄 上下文: {context}", file=sys.stderr)
-                    print(f"🔍 完整查询: {full_query}", file=sys.stderr)
-                    print(f"📊 检索到 {len(response.source_nodes)} 个相关文档片段\n", file=sys.stderr)
+            for node in source_nodes:
+                source_info = {
+                    "content": node.text[:100] + "..." if len(node.text) > 100 else node.text,
+                    "score": float(node.score) if hasattr(node, 'score') else 0.0
+                }
                 
-                for i, node in enumerate(response.source_nodes, 1):
-                    source_info = {
-                        "content": node.text[:100] + "..." if len(node.text) > 100 else node.text,
-                        "score": float(node.score) if hasattr(node, 'score') else 0.0
-                    }
-                    
-                    # 添加文件路径信息
-                    if hasattr(node, 'metadata') and 'file_path' in node.metadata:
-                        source_info['file_path'] = node.metadata['file_path']
-                    
-                    # 🔍 诊断模式：详细输出每个检索片段
-                    if diagnostic_mode:
-                        print(f"📄 片段 {i}", file=sys.stderr)
-                        print("-" * 60, file=sys.stderr)
-                        
-                        # 相关性得分
-                        score = float(node.score) if hasattr(node, 'score') else 0.0
-                        print(f"🎯 相关性得分: {score:.4f}", file=sys.stderr)
-                        
-                        # 来源元数据
-                        metadata = getattr(node, 'metadata', {})
-                        if 'file_path' in metadata:
-                            file_name = os.path.basename(metadata['file_path'])
-                            print(f"📁 来源文件: {file_name}", file=sys.stderr)
-                            print(f"📂 完整路径: {metadata['file_path']}", file=sys.stderr)
-                        
-                        # 其他元数据信息
-                        if metadata:
-                            for key, value in metadata.items():
-                                if key != 'file_path':
-                                    print(f"📋 {key}: {value}", file=sys.stderr)
-                        
-                        # 原始文本块（截断显示，避免过长）
-                        display_text = node.text[:500] + "..." if len(node.text) > 500 else node.text
-                        print(f"📝 原始文本块 (长度: {len(node.text)} 字符):", file=sys.stderr)
-                        print("-" * 40, file=sys.stderr)
-                        print(display_text, file=sys.stderr)
-                        print("-" * 40, file=sys.stderr)
-                        
-                        # 文本块ID（如果有）
-                        if hasattr(node, 'node_id'):
-                            print(f"🆔 节点ID: {node.node_id}", file=sys.stderr)
-                        
-                        print(file=sys.stderr)  # 空行分隔
-                    
-                    sources.append(source_info)
+                # 添加文件路径信息
+                if hasattr(node, 'metadata') and 'file_path' in node.metadata:
+                    source_info['file_path'] = node.metadata['file_path']
                 
-                # 🔍 诊断模式：输出文档来源统计
-                if diagnostic_mode:
-                    print("📊 文档来源统计:", file=sys.stderr)
-                    print("-" * 40, file=sys.stderr)
-                    file_count = {}
-                    for source in sources:
-                        if 'file_path' in source:
-                            file_name = os.path.basename(source['file_path'])
-                            file_count[file_name] = file_count.get(file_name, 0) + 1
-                    
-                    for file_name, count in sorted(file_count.items(), key=lambda x: x[1], reverse=True):
-                        print(f"📂 {file_name}: {count} 个片段", file=sys.stderr)
-                    
-                    print("\n💡 检索偏见分析:", file=sys.stderr)
-                    print("-" * 40, file=sys.stderr)
-                    total_sources = len(sources)
-                    if total_sources > 0:
-                        most_cited = max(file_count.items(), key=lambda x: x[1])
-                        bias_ratio = most_cited[1] / total_sources
-                        print(f"🔍 最常引用文档: {most_cited[0]} ({most_cited[1]}/{total_sources} = {bias_ratio:.1%})", file=sys.stderr)
-                        if bias_ratio > 0.6:
-                            print("⚠️  警告: 存在明显的检索偏见！单一文档占比过高", file=sys.stderr)
-                        elif bias_ratio > 0.4:
-                            print("🟡 注意: 存在轻微的检索偏见", file=sys.stderr)
-                        else:
-                            print("✅ 检索结果相对均衡", file=sys.stderr)
-                    
-                    print("="*80, file=sys.stderr)
-                    print("🔬 诊断报告结束", file=sys.stderr)
-                    print("="*80 + "\n", file=sys.stderr)
+                sources.append(source_info)
+            
+            # 🔍 诊断模式：结构化记录检索过程，随结果返回
+            if diagnostics.enabled:
+                diagnostics.set("query", question)
+                diagnostics.set("full_query", full_query)
+                diagnostics.set("windows", len(windows) if windows else 0)
+                diagnostics.record_nodes("candidates", candidate_nodes)
+                diagnostics.record_nodes("selected", source_nodes)
+                diagnostics.set("source_distribution", source_distribution(
+                    source['file_path'] for source in sources if 'file_path' in source
+                ))
             
             result = {
-                "answer": str(response)[:200] + "..." if len(str(response)) > 200 else str(response),
+                "answer": REPORT_PROMPT_TEMPLATE.format(context=plan["context"], query=plan["query"]),
                 "sources": sources,
                 "query": question,
                 "context": context,
-                "sources_count": len(sources)
+                "sources_count": len(sources),
+                "token_plan": plan["tokens"],
+                "degraded": deadline.degraded
             }
+            if deadline.bounded:
+                result["deadline"] = deadline.to_dict()
+            if diagnostics.enabled:
+                result["diagnostics"] = diagnostics.to_dict()
             
             return result
             
@@ -306,6 +276,29 @@ class RAGQueryService:
                 "sources_count": 0
             }
 
+    def _retrieve_within_deadline(self, queries: List[str], deadline: Deadline) -> list:
+        """在截止时间内完成embedding和检索，embedding超时返回空结果并标记降级"""
+        from openai_clients import is_timeout_error
+        
+        started = time.monotonic()
+        try:
+            deadline.require("embedding")
+            embeddings = Settings.embed_model.client.embed(queries, timeout=deadline.timeout_for("embedding"))
+        except Exception as e:
+            if not isinstance(e, DeadlineExceeded) and not (deadline.bounded and is_timeout_error(e)):
+                raise
+            deadline.skip("embedding")
+            return []
+        deadline.record("embedding", time.monotonic() - started)
+        
+        if not deadline.allows("retrieval"):
+            deadline.skip("retrieval")
+            return []
+        started = time.monotonic()
+        candidate_nodes = retrieve_with_embeddings(self.index, queries, embeddings, CANDIDATE_TOP_K, deadline=deadline)
+        deadline.record("retrieval", time.monotonic() - started)
+        return candidate_nodes
+
 def create_rag_query(user_input: dict, image_analysis: list) -> str:
     """
     根据用户输入和图片分析，构造专业的RAG查询问题
@@ -317,17 +310,24 @@ def create_rag_query(user_input: dict, image_analysis: list) -> str:
     Returns:
         构造的查询问题
     """
-    # 简化查询，避免过长
-    bio = user_input.get('bio', user_input.get('bioOrChatHistory', ''))
-    
-    # 截断过长的内容
-    if len(bio) > 100:
-        bio = bio[:100] + "..."
-    
-    base_query = f"""分析约会对象：昵称{user_input.get('nickname', '未知')}，职业{user_input.get('profession', '未知')}，年龄{user_input.get('age', '未知')}。个人简介：{bio}。请识别PUA行为模式和情感操控迹象。"""
+    # 个人简介/聊天记录不再截断，由create_rag_query_windows切分为查询窗口
+    base_query = f"""分析约会对象：昵称{user_input.get('nickname', '未知')}，职业{user_input.get('profession', '未知')}，年龄{user_input.get('age', '未知')}。请识别PUA行为模式和情感操控迹象。"""
     
     return base_query
 
+def create_rag_query_windows(user_input: dict) -> List[str]:
+    """
+    把个人简介/聊天记录切分为查询窗口
+    
+    Args:
+        user_input: 用户输入信息
+        
+    Returns:
+        查询窗口列表（短文本只有一个窗口，无内容时为空）
+    """
+    bio = user_input.get('bio', user_input.get('bioOrChatHistory', ''))
+    return split_into_windows(bio)
+
 def generate_final_report(rag_result: dict, user_input: dict, image_analysis: list) -> dict:
     """
     生成最终的结构化分析报告
@@ -356,7 +356,8 @@ def generate_final_report(rag_result: dict, user_input: dict, image_analysis: li
             "query_summary": "基于专业知识库的智能分析",
             "knowledge_answer": rag_result.get('answer', ''),
             "sources_count": rag_result.get('sources_count', 0),
-            "knowledge_references": rag_result.get('sources', [])
+            "knowledge_references": rag_result.get('sources', []),
+            "degraded": rag_result.get('degraded', False)
         },
         "risk_assessment": {
             "overall_risk": "需要进一步专业评估",
@@ -376,6 +377,10 @@ def generate_final_report(rag_result: dict, user_input: dict, image_analysis: li
         }
     }
     
+    # 诊断模式：附带结构化诊断信息
+    if rag_result.get('diagnostics'):
+        report["rag_analysis"]["diagnostics"] = rag_result['diagnostics']
+    
     # 如果有RAG错误，记录错误信息
     if rag_result.get('error'):
         report["rag_error"] = rag_result['error']
@@ -383,10 +388,23 @@ def generate_final_report(rag_result: dict, user_input: dict, image_analysis: li
     
     return report
 
+def output_result(result: dict, writer: Optional[FrameWriter] = None):
+    """输出最终结果：帧协议下输出报告帧（失败时为错误帧）和结束帧，否则输出一行紧凑JSON"""
+    if writer is None:
+        print(dumps_compact(result))
+        return
+    if result.get("success"):
+        writer.write(FRAME_REPORT, result["data"])
+    else:
+        writer.write(FRAME_ERROR, result)
+    writer.end()
+
 # 命令行调用支持
 def main():
     """主函数 - 支持命令行调用"""
     
+    writer = None
+    
     # 确保stdout只用于JSON输出
     try:
         if len(sys.argv) < 2:
@@ -397,8 +415,13 @@ def main():
             print(json.dumps(result, ensure_ascii=False))
             sys.exit(1)
         
-        # 解析命令行参数
+        # 解析命令行参数；"output": "frames"时先输出检索帧再输出报告帧，"fields"为大字段掩码
         input_data = json.loads(sys.argv[1])
+        fields = request_fields(input_data)
+        writer = FrameWriter() if wants_frames(input_data) else None
+        
+        # 请求截止时间（deadline_at为绝对时间，包含索引加载耗时）
+        deadline = Deadline.from_request(input_data)
         
         # 初始化RAG服务
         rag_service = RAGQueryService()
@@ -413,24 +436,41 @@ def main():
                     input_data.get('image_analysis', input_data.get('image_infos', []))
                 )
             }
-            print(json.dumps(result, ensure_ascii=False))
+            output_result(result, writer)
             sys.exit(0)
         
         # 提取用户输入和图片分析
         user_input = input_data.get('user_input', input_data.get('user_info', {}))
         image_analysis = input_data.get('image_analysis', input_data.get('image_infos', []))
         
-        # 构造RAG查询
+        # 构造RAG查询：资料摘要 + 聊天记录查询窗口
         rag_query = create_rag_query(user_input, image_analysis)
+        query_windows = create_rag_query_windows(user_input)
         
         # 检查是否启用诊断模式
         diagnostic_mode = input_data.get('diagnostic_mode', False)
         
         # 执行查询
-        rag_result = rag_service.query(rag_query, diagnostic_mode=diagnostic_mode)
+        rag_result = rag_service.query(rag_query, diagnostic_mode=diagnostic_mode, windows=query_windows,
+                                       deadline=deadline)
+        
+        # 字段掩码：未请求时不输出片段文本
+        if not wants_field(fields, FIELD_SNIPPETS):
+            for source in rag_result.get('sources', []):
+                source.pop('content', None)
+        
+        # 检索结果先行输出，server.js收到后即可准备后续阶段
+        if writer:
+            writer.write(FRAME_RETRIEVAL, {"rag_analysis": {
+                "knowledge_references": rag_result.get('sources', []),
+                "sources_count": rag_result.get('sources_count', 0),
+                "degraded": rag_result.get('degraded', False)
+            }})
         
         # 生成最终报告
         final_report = generate_final_report(rag_result, user_input, image_analysis)
+        if not wants_field(fields, FIELD_USER_INFO):
+            final_report.pop("user_data", None)
         
         # 构建成功响应格式，匹配server.js期望的格式
         result = {
@@ -439,21 +479,21 @@ def main():
         }
         
         # 输出JSON结果到stdout（确保这是唯一的stdout输出）
-        print(json.dumps(result, ensure_ascii=False))
+        output_result(result, writer)
         
     except json.JSONDecodeError:
         result = {
             "success": False,
             "error": "无效的JSON输入格式"
         }
-        print(json.dumps(result, ensure_ascii=False))
+        output_result(result, writer)
         sys.exit(1)
     except Exception as e:
         result = {
             "success": False,
             "error": f"处理失败: {str(e)}"
         }
-        print(json.dumps(result, ensure_ascii=False))
+        output_result(result, writer)
         sys.exit(1)
 
 if __name__ == "__main__":
@@ -8,7 +8,9 @@
 import os
 import sys
 import json
+import time
 import logging
+import threading
 from pathlib import Path
 from dotenv import load_dotenv
 from datetime import datetime
@@ -16,6 +18,17 @@ from collections import Counter, defaultdict
 import re
 from contextlib import redirect_stdout
 
+from rag_index_version import current_version_number, index_persist_dir, read_index_version
+from rag_metrics import REQUESTS_TOTAL, FALLBACKS_TOTAL, INDEX_VERSION, INDEX_RELOADS_TOTAL
+from query_windows import split_into_windows, retrieve_with_embeddings
+from rag_deadline import Deadline, DeadlineExceeded
+from rag_diagnostics import NULL_DIAGNOSTICS, create_diagnostics, source_distribution
+from rag_diversity import KNOWLEDGE_SOURCES, identify_source, select_diverse, build_knowledge_answer
+from rag_protocol import (
+    FIELD_SNIPPETS, FIELD_USER_INFO, FRAME_ERROR, FRAME_REPORT, FRAME_RETRIEVAL,
+    request_fields, wants_field, wants_frames, dumps_compact, FrameWriter
+)
+
 # 全局重定向stdout到stderr，防止污染JSON输出
 class StdoutRedirector:
     def __init__(self):
@@ -33,7 +46,7 @@ load_dotenv()
 
 # 设置日志格式
 logging.basicConfig(
-    level=logging.DEBUG,
+    level=os.getenv("RAG_LOG_LEVEL", "INFO").upper(),
     format='%(asctime)s - %(levelname)s - %(message)s',
     stream=sys.stderr
 )
@@ -48,17 +61,21 @@ with StdoutRedirector():
 class EnhancedRAGService:
     """增强版RAG服务 - 多样性强制检索"""
     
+    # 新版本加载失败后，等待多久再重试同一版本（秒）
+    RELOAD_RETRY_SECONDS = 30.0
+    
     def __init__(self, storage_path: str = "storage"):
         self.storage_path = Path(storage_path)
         self.index = None
         self.query_engine = None
-        self.knowledge_sources = {
-            'jordan_peterson': ['12-Rules-for-Life.pdf', 'jordan peterson2.pdf', 'Jordan_Peterson_Toxic_Masculinity_FINAL'],
-            'sadia_khan': ['Sadia Khan', 'sadia khan'],
-            'red_pill': ['红药丸', '紅藥丸', 'Week'],
-            'mystery_method': ['谜男方法.pdf'],
-            'abovelight': ['AB的異想世界']
-        }
+        self.embed_model = None
+        self.index_version = 0
+        self.knowledge_sources = dict(KNOWLEDGE_SOURCES)
+        # 并发请求同时发现新版本时只重新加载一次
+        self._reload_lock = threading.Lock()
+        # 加载失败的版本及下次允许重试的时间，避免每个请求都重新加载坏版本
+        self._failed_version = None
+        self._reload_retry_at = 0.0
         self.initialize_rag_system()
     
     def initialize_rag_system(self):
@@ -82,26 +99,62 @@ class EnhancedRAGService:
                     load_index_from_storage,
                     Settings
                 )
-                from llama_index.embeddings.openai import OpenAIEmbedding
+                from openai_clients import PooledOpenAIEmbedding, resolve_api_base
                 
-                # 配置embedding模型
-                Settings.embed_model = OpenAIEmbedding(
+                # 配置embedding模型（共享连接池，交互式查询启用对冲请求降低尾延迟）
+                Settings.embed_model = PooledOpenAIEmbedding(
                     model="text-embedding-3-small",
                     api_key=api_key,
-                    api_base="https://api.gptsapi.net/v1"
+                    api_base=resolve_api_base(),  # 可通过OPENAI_API_BASE指向本地替身（压测）
+                    hedge=os.getenv("RAG_EMBEDDING_HEDGE", "1") == "1"
                 )
+                self.embed_model = Settings.embed_model
                 
-                # 加载索引
-                storage_context = StorageContext.from_defaults(persist_dir=str(self.storage_path))
-                self.index = load_index_from_storage(storage_context)
-            
-            logger.info("✅ 增强版RAG系统初始化成功")
+                # 加载索引（记录加载时的版本号，构建器发布新版本后自动重新加载）
+                version_info = read_index_version(self.storage_path)
+                index_version = int(version_info.get("version", 0)) if version_info else 0
+                persist_dir = index_persist_dir(self.storage_path, version_info)
+                storage_context = StorageContext.from_defaults(persist_dir=str(persist_dir))
+                index = load_index_from_storage(storage_context)
+                # 加载完成后再替换，正在查询的请求继续使用旧索引
+                self.index = index
+                self.index_version = index_version
+                INDEX_VERSION.set(index_version)
+            
+            logger.info(f"✅ 增强版RAG系统初始化成功 (索引版本: {self.index_version})")
             return True
             
         except Exception as e:
             logger.error(f"❌ RAG系统初始化失败: {str(e)}")
             return False
     
+    def reload_if_stale(self) -> bool:
+        """索引发布了新版本时重新加载，返回是否发生了重新加载"""
+        latest_version = current_version_number(self.storage_path)
+        if latest_version == self.index_version or self._backing_off(latest_version):
+            return False
+        
+        with self._reload_lock:
+            # 等待锁期间其他线程可能已完成重新加载（或刚刚加载失败）
+            latest_version = current_version_number(self.storage_path)
+            if latest_version == self.index_version or self._backing_off(latest_version):
+                return False
+            
+            logger.info(f"🔄 检测到新索引版本 {latest_version}（当前 {self.index_version}），重新加载...")
+            INDEX_RELOADS_TOTAL.inc()
+            if self.initialize_rag_system():
+                self._failed_version = None
+                return True
+            
+            self._failed_version = latest_version
+            self._reload_retry_at = time.monotonic() + self.RELOAD_RETRY_SECONDS
+            logger.warning(f"⚠️ 索引版本 {latest_version} 加载失败，{self.RELOAD_RETRY_SECONDS:.0f}秒内不再重试")
+            return False
+    
+    def _backing_off(self, version) -> bool:
+        """该版本最近加载失败且仍在退避期内"""
+        return version == self._failed_version and time.monotonic() < self._reload_retry_at
+    
     def classify_query_intent(self, query: str) -> dict:
         """分析查询意图，识别用户想要的知识源"""
         intent_mapping = {
@@ -125,263 +178,261 @@ class EnhancedRAGService:
         
         return dict(intent_scores)
     
-    def diversified_retrieval(self, query: str, top_k: int = 5) -> list:
-        """多样性强制均衡检索 - 强硬方案解决检索偏见"""
+    def diversified_retrieval(self, query: str, top_k: int = 5,
+                              all_candidates: list = None, diagnostics=NULL_DIAGNOSTICS) -> list:
+        """多样性强制均衡检索 - 强硬方案解决检索偏见
+        
+        all_candidates: 已检索好的候选片段（已按窗口完成embedding和检索），提供时跳过检索，
+            多样性筛选失败时直接取其前top_k个，不再重新检索
+        diagnostics: 诊断收集器（rag_diagnostics），关闭时为空实现
+        """
         try:
-            logger.info(f"🔍 开始多样性强制均衡检索: {query[:100]}...")
-            
             # === 第一步：扩大初始检索范围 ===
-            logger.info("📈 第一步：扩大检索范围到20个候选片段...")
-            
             # 重定向输出避免污染JSON
             import sys
             from contextlib import redirect_stdout
             
             with redirect_stdout(sys.stderr):
-                retriever = self.index.as_retriever(similarity_top_k=20)  # 获取前20个候选
-                all_candidates = retriever.retrieve(query)
-            
-            logger.info(f"✅ 检索到 {len(all_candidates)} 个候选片段")
-            
-            # === 第二步：多样性筛选后处理 ===
-            logger.info("🎯 第二步：执行多样性强制筛选...")
-            
-            # 创建空的"最终知识列表"
-            final_knowledge_list = []
-            author_count = {}  # 统计每个作者的片段数量
-            
-            # 对候选片段按相关性排序（已经是按相关性排序的）
-            logger.info("📋 候选片段列表:")
-            author_groups = {}  # 按作者分组
-            
-            for i, node in enumerate(all_candidates):
-                file_path = getattr(node, 'metadata', {}).get('file_path', 'unknown')
-                author = self.identify_source(file_path)
-                
-                if author not in author_groups:
-                    author_groups[author] = []
-                author_groups[author].append((i, node))
-                
-                logger.info(f"  {i+1}. [{author}] 评分: {node.score:.4f}, 来源: {file_path}")
-            
-            logger.info(f"🔍 发现 {len(author_groups)} 个不同作者的内容")
-            for author, nodes in author_groups.items():
-                logger.info(f"   {author}: {len(nodes)} 个候选片段")
-            
-            # === 强化多样性策略 ===
-            # 如果有多个作者，优先确保多样性
-            if len(author_groups) > 1:
-                logger.info("🌈 执行强化多样性策略（多作者模式）...")
-                
-                # 第一轮：每个作者选择最好的1个片段
-                for author, nodes in author_groups.items():
-                    if len(final_knowledge_list) < top_k:
-                        best_node = nodes[0][1]  # 选择该作者最相关的片段
-                        final_knowledge_list.append(best_node)
-                        author_count[author] = 1
-                        logger.info(f"   ✅ 选择 {author} 的最佳片段 (评分: {best_node.score:.4f})")
-                
-                # 第二轮：如果还有空位，每个作者再选择1个片段
-                for author, nodes in author_groups.items():
-                    if len(final_knowledge_list) < top_k and len(nodes) > 1:
-                        if author_count.get(author, 0) < 2:  # 确保每个作者最多2个
-                            second_best_node = nodes[1][1]  # 选择该作者第二相关的片段
-                            final_knowledge_list.append(second_best_node)
-                            author_count[author] = author_count.get(author, 0) + 1
-                            logger.info(f"   ✅ 选择 {author} 的第二个片段 (评分: {second_best_node.score:.4f})")
-                
-                # 第三轮：如果仍有空位，按相关性继续填充（仍遵守每作者最多2个限制）
-                if len(final_knowledge_list) < top_k:
-                    remaining_candidates = []
-                    for author, nodes in author_groups.items():
-                        for i, node in nodes[2:]:  # 从第3个片段开始
-                            remaining_candidates.append((i, node, author))
-                    
-                    # 按原始相关性排序
-                    remaining_candidates.sort(key=lambda x: x[0])
-                    
-                    for original_index, node, author in remaining_candidates:
-                        if len(final_knowledge_list) >= top_k:
-                            break
-                        if author_count.get(author, 0) < 2:
-                            final_knowledge_list.append(node)
-                            author_count[author] = author_count.get(author, 0) + 1
-                            logger.info(f"   ✅ 补充选择 {author} 的片段 (评分: {node.score:.4f})")
-                
-            else:
-                # 单一作者模式：直接按相关性选择，但仍限制最多2个
-                logger.info("📖 执行单一作者模式...")
-                author = list(author_groups.keys())[0]
-                nodes = author_groups[author]
-                
-                for i, (original_index, node) in enumerate(nodes):
-                    if i >= 2 or len(final_knowledge_list) >= top_k:  # 最多2个片段
-                        break
-                    final_knowledge_list.append(node)
-                    author_count[author] = author_count.get(author, 0) + 1
-                    logger.info(f"   ✅ 选择 {author} 的片段 {i+1} (评分: {node.score:.4f})")
+                if all_candidates is None:
+                    retriever = self.index.as_retriever(similarity_top_k=20)  # 获取前20个候选
+                    all_candidates = retriever.retrieve(query)
             
-            # === 多样性验证和统计 ===
-            logger.info("📊 多样性强制均衡结果:")
-            logger.info(f"   最终片段数量: {len(final_knowledge_list)}")
+            diagnostics.record_nodes("candidates", all_candidates, self.identify_source)
             
-            final_author_count = {}
-            for node in final_knowledge_list:
-                file_path = getattr(node, 'metadata', {}).get('file_path', 'unknown')
-                author = self.identify_source(file_path)
-                final_author_count[author] = final_author_count.get(author, 0) + 1
-            
-            for author, count in final_author_count.items():
-                percentage = (count / len(final_knowledge_list) * 100) if final_knowledge_list else 0
-                logger.info(f"   {author}: {count} 个片段 ({percentage:.1f}%)")
-            
-            # 验证约束条件
-            max_author_count = max(final_author_count.values()) if final_author_count else 0
-            unique_authors = len(final_author_count)
-            
-            if max_author_count <= 2:
-                logger.info("✅ 约束验证成功: 每个作者最多2个片段")
-            else:
-                logger.warning(f"⚠️ 约束验证失败: 发现作者超出限制 ({max_author_count}个片段)")
-            
-            if unique_authors >= 2:
-                logger.info(f"✅ 多样性目标达成: {unique_authors} 个不同作者")
-            else:
-                logger.info(f"⚠️ 多样性有限: 只有 {unique_authors} 个作者（可能是查询过于专一）")
-            
-            return final_knowledge_list
+            # === 第二步：多样性筛选后处理（每个作者最多2个片段） ===
+            return select_diverse(all_candidates, top_k, self.identify_source, diagnostics)
             
         except Exception as e:
             logger.error(f"❌ 多样性强制均衡检索失败: {str(e)}")
-            # 降级到基础检索
+            FALLBACKS_TOTAL.inc(reason="diversity_error")
+            diagnostics.set("diversity_error", str(e))
+            # 降级：已有候选时按原排序直接截取（不再调用embedding，也不超出截止时间）
+            if all_candidates is not None:
+                return all_candidates[:top_k]
             with redirect_stdout(sys.stderr):
                 retriever = self.index.as_retriever(similarity_top_k=top_k)
                 return retriever.retrieve(query)
     
     def identify_source(self, file_path: str) -> str:
         """识别文档来源"""
-        if not file_path:
-            return 'unknown'
-        
-        file_name = Path(file_path).name.lower()
-        
-        # 检查每个知识源的标识符
-        for source, identifiers in self.knowledge_sources.items():
-            for identifier in identifiers:
-                if identifier.lower() in file_name:
-                    return source
-        
-        return 'other'
+        return identify_source(file_path, self.knowledge_sources)
     
-    def process_query(self, query_data: str) -> dict:
-        """处理查询请求"""
+    def process_query(self, query_data, emit=None) -> dict:
+        """处理查询请求
+        
+        query_data: JSON字符串或已解析的请求
+        emit: 帧输出回调emit(帧类型, 内容)，提供时检索结果和报告分阶段输出
+        """
         try:
             logger.info("🎯 开始处理增强版RAG查询...")
             
-            # 解析输入数据
-            data = json.loads(query_data)
-            user_info = data.get('user_info', {})
-            
-            # 提取查询内容
-            query = user_info.get('bioOrChatHistory', '') or user_info.get('bio', '')
-            if not query:
-                raise ValueError("未找到有效的查询内容")
-            
-            logger.info(f"📝 查询内容: {query[:100]}...")
+            # 常驻进程中使用最新发布的索引
+            self.reload_if_stale()
             
-            # 执行多样性强制检索
-            nodes = self.diversified_retrieval(query, top_k=5)
+            # 解析输入数据
+            data = json.loads(query_data) if isinstance(query_data, str) else query_data
+            deadline = Deadline.from_request(data)
+            diagnostics = self.request_diagnostics(data, deadline)
+            user_info, query = self.extract_query(data)
             
-            # 构建知识回答
-            knowledge_answer = self.build_knowledge_answer(nodes, query)
+            # 长聊天记录按窗口检索（延迟有上限且不丢失内容），一次批量embedding
+            queries = split_into_windows(query) or [query]
+            embeddings = self.embed_queries(queries, deadline)
             
-            # 构建引用信息
-            knowledge_references = []
-            for i, node in enumerate(nodes):
-                ref = {
-                    'score': float(node.score) if hasattr(node, 'score') else 0.0,
-                    'file_path': node.metadata.get('file_path', 'unknown'),
-                    'text_snippet': node.text[:200] + '...' if len(node.text) > 200 else node.text
-                }
-                knowledge_references.append(ref)
+            # 执行多样性强制检索（时间不足时跳过多样性筛选）
+            nodes = []
+            if embeddings:
+                nodes = self.select_nodes(query, queries, embeddings, deadline, diagnostics=diagnostics)
             
-            # 构建响应
-            result = {
-                'success': True,
-                'data': {
-                    'title': 'AI情感安全分析报告 (增强多样性版本)',
-                    'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                    'user_info': user_info,
-                    'rag_analysis': {
-                        'status': 'active',
-                        'knowledge_answer': knowledge_answer,
-                        'knowledge_references': knowledge_references,
-                        'sources_count': len(nodes),
-                        'diversity_enhanced': True
-                    }
-                }
-            }
+            result = self.build_result(user_info, nodes, query, deadline, diagnostics,
+                                       fields=request_fields(data), emit=emit)
             
             logger.info("✅ 增强版RAG查询处理完成")
+            REQUESTS_TOTAL.inc(service="enhanced", status=self.result_status(result))
             return result
             
         except Exception as e:
             logger.error(f"❌ 查询处理失败: {str(e)}")
+            REQUESTS_TOTAL.inc(service="enhanced", status="error")
             return {
                 'success': False,
                 'error': str(e),
                 'data': {}
             }
     
-    def build_knowledge_answer(self, nodes: list, query: str) -> str:
-        """构建知识回答"""
-        if not nodes:
-            return "未找到相关知识内容。"
+    def embed_queries(self, queries: list, deadline: Deadline) -> list:
+        """在截止时间内批量获取查询向量，超时返回None（调用方返回降级结果）"""
+        from openai_clients import is_timeout_error
+        
+        started = time.monotonic()
+        try:
+            deadline.require("embedding")
+            with redirect_stdout(sys.stderr):
+                embeddings = self.embed_model.client.embed(queries, timeout=deadline.timeout_for("embedding"))
+        except Exception as e:
+            if not isinstance(e, DeadlineExceeded) and not (deadline.bounded and is_timeout_error(e)):
+                raise
+            logger.warning("⏰ embedding未能在截止时间内完成，返回降级结果: %s", e)
+            deadline.skip("embedding")
+            return None
+        deadline.record("embedding", time.monotonic() - started)
+        return embeddings
+    
+    def request_diagnostics(self, data: dict, deadline: Deadline):
+        """请求开启diagnostic_mode且剩余时间充足时返回诊断收集器，否则返回空实现"""
+        if not data.get('diagnostic_mode'):
+            return NULL_DIAGNOSTICS
+        if not deadline.allows("diagnostics"):
+            deadline.skip("diagnostics")
+            return NULL_DIAGNOSTICS
+        return create_diagnostics(True)
+    
+    def select_nodes(self, query: str, queries: list, embeddings: list, deadline: Deadline,
+                     top_k: int = 5, diagnostics=NULL_DIAGNOSTICS) -> list:
+        """按阶段预算执行向量检索和多样性筛选"""
+        if not deadline.allows("retrieval"):
+            deadline.skip("retrieval")
+            return []
+        
+        started = time.monotonic()
+        with redirect_stdout(sys.stderr):
+            candidates = retrieve_with_embeddings(self.index, queries, embeddings, top_k=20, deadline=deadline)
+        deadline.record("retrieval", time.monotonic() - started)
+        
+        # 多样性筛选是可选阶段：时间不足时直接返回相关性最高的片段
+        if not deadline.allows("diversity"):
+            logger.warning("⏰ 剩余时间不足，跳过多样性筛选")
+            deadline.skip("diversity")
+            return candidates[:top_k]
+        
+        started = time.monotonic()
+        nodes = self.diversified_retrieval(query, top_k=top_k, all_candidates=candidates, diagnostics=diagnostics)
+        deadline.record("diversity", time.monotonic() - started)
+        return nodes
+    
+    @staticmethod
+    def result_status(result: dict) -> str:
+        """请求结果状态（用于rag_requests_total的status标签）"""
+        if not result.get('success'):
+            return "error"
+        return "degraded" if result['data']['rag_analysis'].get('degraded') else "success"
+    
+    def extract_query(self, data: dict) -> tuple:
+        """从请求数据中提取用户信息和查询内容"""
+        user_info = data.get('user_info', {})
         
-        # 按来源组织内容
-        content_by_source = defaultdict(list)
-        for node in nodes:
-            source = self.identify_source(node.metadata.get('file_path', ''))
-            content_by_source[source].append(node.text[:300])
+        # 提取查询内容
+        query = user_info.get('bioOrChatHistory', '') or user_info.get('bio', '')
+        if not query:
+            raise ValueError("未找到有效的查询内容")
         
-        # 构建结构化回答
-        answer_parts = []
-        source_names = {
-            'jordan_peterson': 'Jordan Peterson心理学观点',
-            'sadia_khan': 'Sadia Khan关系分析',
-            'red_pill': '红药丸理论观点', 
-            'mystery_method': '谜男方法技巧',
-            'abovelight': 'AboveLight观点',
-            'other': '其他专业观点'
+        logger.debug("📝 查询内容长度: %d 字符", len(query))
+        return user_info, query
+    
+    def build_result(self, user_info: dict, nodes: list, query: str, deadline: Deadline = None,
+                     diagnostics=NULL_DIAGNOSTICS, fields=None, emit=None) -> dict:
+        """根据检索结果构建响应
+        
+        deadline记录了被跳过的阶段，开启诊断时附带诊断信息；
+        fields为字段掩码（rag_protocol），emit提供时先输出检索帧、再输出报告帧
+        """
+        # 构建引用信息
+        include_snippets = wants_field(fields, FIELD_SNIPPETS)
+        knowledge_references = []
+        for i, node in enumerate(nodes):
+            ref = {
+                'score': float(node.score) if hasattr(node, 'score') else 0.0,
+                'file_path': node.metadata.get('file_path', 'unknown')
+            }
+            if include_snippets:
+                ref['text_snippet'] = node.text[:200] + '...' if len(node.text) > 200 else node.text
+            knowledge_references.append(ref)
+        
+        degraded = deadline is not None and deadline.degraded
+        if degraded:
+            logger.warning("⚠️ 返回降级结果，跳过的阶段: %s", deadline.skipped_stages)
+        
+        rag_analysis = {
+            'knowledge_references': knowledge_references,
+            'sources_count': len(nodes),
+            'diversity_enhanced': deadline is None or 'diversity' not in deadline.skipped_stages,
+            'degraded': degraded
         }
+        if deadline is not None and deadline.bounded:
+            rag_analysis['deadline'] = deadline.to_dict()
+        if diagnostics.enabled:
+            diagnostics.set("source_distribution", source_distribution(ref['file_path'] for ref in knowledge_references))
+            rag_analysis['diagnostics'] = diagnostics.to_dict()
         
-        for source, contents in content_by_source.items():
-            if contents:
-                source_name = source_names.get(source, source)
-                combined_content = ' '.join(contents[:2])  # 每个来源最多2段内容
-                answer_parts.append(f"【{source_name}】\n{combined_content}")
+        # 检索结果先行输出，调用方无需等待报告构建
+        if emit is not None:
+            emit(FRAME_RETRIEVAL, {'rag_analysis': rag_analysis})
         
-        return '\n\n'.join(answer_parts)
+        # 构建知识回答
+        report = {
+            'title': 'AI情感安全分析报告 (增强多样性版本)',
+            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'rag_analysis': {
+                'status': 'active',
+                'knowledge_answer': self.build_knowledge_answer(nodes, query)
+            }
+        }
+        if wants_field(fields, FIELD_USER_INFO):
+            report['user_info'] = user_info
+        if emit is not None:
+            emit(FRAME_REPORT, report)
+        
+        # 构建响应
+        report['rag_analysis'].update(rag_analysis)
+        return {
+            'success': True,
+            'data': report
+        }
+    
+    def build_knowledge_answer(self, nodes: list, query: str) -> str:
+        """构建知识回答"""
+        return build_knowledge_answer(nodes, self.identify_source)
 
 def main():
     """主函数"""
+    # 常驻worker模式：python rag_query_service_enhanced.py --worker
+    if sys.argv[1:] == ['--worker']:
+        import asyncio
+        from rag_async_service import run_worker
+        
+        asyncio.run(run_worker(EnhancedRAGService()))
+        return
+    
     if len(sys.argv) != 2:
         print(json.dumps({
             'success': False,
-            'error': 'Usage: python rag_query_service_enhanced.py <json_data>'
+            'error': 'Usage: python rag_query_service_enhanced.py <json_data> | --worker'
         }))
         sys.exit(1)
     
+    try:
+        # 解析请求；请求"output": "frames"时使用长度前缀帧分阶段输出
+        query_data = json.loads(sys.argv[1])
+    except ValueError:
+        print(dumps_compact({'success': False, 'error': '无效的JSON输入格式', 'data': {}}))
+        sys.exit(1)
+    
+    writer = FrameWriter() if wants_frames(query_data) else None
+    
     try:
         # 创建增强版RAG服务
         rag_service = EnhancedRAGService()
         
         # 处理查询
-        query_data = sys.argv[1]
-        result = rag_service.process_query(query_data)
+        result = rag_service.process_query(query_data, emit=writer.write if writer else None)
         
         # 输出结果
-        print(json.dumps(result, ensure_ascii=False, indent=2))
+        if writer:
+            if not result['success']:
+                writer.write(FRAME_ERROR, result)
+            writer.end()
+        else:
+            print(dumps_compact(result))
         
     except Exception as e:
         error_result = {
@@ -389,7 +440,11 @@ def main():
             'error': str(e),
             'data': {}
         }
-        print(json.dumps(error_result, ensure_ascii=False, indent=2))
+        if writer:
+            writer.write(FRAME_ERROR, error_result)
+            writer.end()
+        else:
+            print(dumps_compact(error_result))
         sys.exit(1)
 
 if __name__ == "__main__":
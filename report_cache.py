@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+报告结果缓存
+按规范化后的扫描输入（昵称、职业、年龄、聊天记录/简介）+ 索引版本 + 提示词版本做内容寻址，
+用户刷新页面后重复提交相同内容时直接返回已生成的报告；带TTL和LRU淘汰的进程内缓存
+"""
+
+import re
+import json
+import time
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from rag_metrics import CACHE_HITS_TOTAL, CACHE_MISSES_TOTAL
+
+# 参与缓存键的输入字段（worker请求可能只带bio）
+KEY_FIELDS = ("nickname", "profession", "age", "bioOrChatHistory", "bio")
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(value: Any) -> str:
+    """NFKC规范化（全角/半角统一）并合并空白，忽略首尾空白和大小写差异"""
+    text = unicodedata.normalize("NFKC", str(value or ""))
+    return _WHITESPACE.sub(" ", text).strip().lower()
+
+
+def scan_key(user_info: Dict[str, Any], **extra: Any) -> str:
+    """规范化输入 + 附加字段（索引版本、提示词版本等）的SHA-256"""
+    material = {"input": [normalize_text(user_info.get(field)) for field in KEY_FIELDS], **extra}
+    return hashlib.sha256(json.dumps(material, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def report_cache_key(user_info: Dict[str, Any], index_version: int, prompt_version: str) -> str:
+    """规范化输入 + 索引版本 + 提示词版本"""
+    return scan_key(user_info, index_version=index_version, prompt_version=prompt_version)
+
+
+class ReportCache:
+    """线程安全的TTL + LRU缓存"""
+
+    def __init__(self, max_entries: int = 256, ttl_seconds: float = 3600, name: str = "report"):
+        """
+        Args:
+            max_entries: 最大条目数，超过时淘汰最久未使用的条目；0表示禁用缓存
+            ttl_seconds: 条目有效期（秒）
+            name: 指标中的cache标签
+        """
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.name = name
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def get(self, key: str) -> Optional[Any]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is None:
+            CACHE_MISSES_TOTAL.inc(cache=self.name)
+            return None
+        CACHE_HITS_TOTAL.inc(cache=self.name)
+        return entry[1]
+
+    def put(self, key: str, value: Any):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
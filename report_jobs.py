@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+报告生成任务队列
+提交任务后立即返回任务ID，由有界工作线程池在后台执行；任务状态、进度和结果持久化在SQLite中，
+执行中断的任务（执行进程已退出或超过租约时长）重新入队。排队 + 执行中的任务数达到上限时拒绝新任务（准入控制），
+突发流量下保持稳定的吞吐而不是让所有请求一起变慢
+"""
+
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import logging
+import threading
+from typing import Any, Callable, Dict, Optional
+
+from rag_metrics import JOBS_TOTAL, JOBS_PENDING
+
+logger = logging.getLogger(__name__)
+
+# 任务状态
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_COMPLETED = "completed"
+STATUS_FAILED = "failed"
+
+# 已结束任务的保留时间（秒）
+DEFAULT_RETENTION_SECONDS = 24 * 3600
+
+# 执行中的任务超过该时长仍未结束时视为已中断（其他主机上的进程无法检查是否存活）
+DEFAULT_LEASE_SECONDS = 600
+
+# 空闲时检查中断任务的间隔（秒）
+RECOVER_INTERVAL_SECONDS = 60
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    progress INTEGER NOT NULL DEFAULT 0,
+    stage TEXT,
+    payload TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    owner TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status_created ON jobs (status, created_at);
+"""
+
+
+def process_owner() -> str:
+    """当前进程的任务执行者标识（主机名:PID）"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _owner_exited(owner: Optional[str]) -> bool:
+    """owner是本机上已退出的进程（旧版本写入的任务没有owner，只按租约判断）"""
+    host, _, pid = (owner or "").rpartition(":")
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        # 进程存在但无权限发送信号
+        return False
+    return False
+
+
+class QueueFull(Exception):
+    """排队任务数已达上限"""
+
+    def __init__(self, pending: int, limit: int):
+        super().__init__(f"任务队列已满 ({pending}/{limit})，请稍后重试")
+        self.pending = pending
+        self.limit = limit
+
+
+class JobStore:
+    """SQLite任务表（单连接 + 锁，WAL模式）"""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+        columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        if "owner" not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+
+    def _execute(self, sql: str, params: tuple = ()) -> int:
+        with self._lock:
+            return self._conn.execute(sql, params).rowcount
+
+    def _fetchone(self, sql: str, params: tuple = ()) -> Optional[sqlite3.Row]:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchone()
+
+    def _fetchall(self, sql: str, params: tuple = ()) -> list:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def insert(self, job_id: str, payload: Dict[str, Any]):
+        self._execute(
+            "INSERT INTO jobs (id, status, payload, created_at) VALUES (?, ?, ?, ?)",
+            (job_id, STATUS_QUEUED, json.dumps(payload, ensure_ascii=False), time.time())
+        )
+
+    def claim_next(self, owner: str) -> Optional[sqlite3.Row]:
+        """取出最早的排队任务并标记为由owner执行中，返回更新后的行（owner和started_at即本次租约）"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT * FROM jobs WHERE status = ? ORDER BY created_at LIMIT 1", (STATUS_QUEUED,)
+                ).fetchone()
+                if row is not None:
+                    self._conn.execute(
+                        "UPDATE jobs SET status = ?, started_at = ?, owner = ? WHERE id = ?",
+                        (STATUS_RUNNING, time.time(), owner, row["id"])
+                    )
+                    row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone()
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return row
+
+    def update_progress(self, job_id: str, owner: str, started_at: float, progress: int, stage: str) -> bool:
+        """更新进度；租约已失效（任务被重新排队或领取）时不更新并返回False"""
+        return self._execute(
+            "UPDATE jobs SET progress = ?, stage = ? WHERE id = ? AND status = ? AND owner = ? AND started_at = ?",
+            (progress, stage, job_id, STATUS_RUNNING, owner, started_at)
+        ) > 0
+
+    def finish(self, job_id: str, owner: str, started_at: float,
+               result: Optional[Dict[str, Any]] = None, error: Optional[str] = None) -> bool:
+        """写入结果；租约已失效时丢弃结果并返回False"""
+        return self._execute(
+            "UPDATE jobs SET status = ?, progress = ?, stage = ?, result = ?, error = ?, finished_at = ? "
+            "WHERE id = ? AND status = ? AND owner = ? AND started_at = ?",
+            (
+                STATUS_FAILED if error else STATUS_COMPLETED,
+                100,
+                STATUS_FAILED if error else STATUS_COMPLETED,
+                None if result is None else json.dumps(result, ensure_ascii=False),
+                error,
+                time.time(),
+                job_id,
+                STATUS_RUNNING,
+                owner,
+                started_at,
+            )
+        ) > 0
+
+    def get(self, job_id: str) -> Optional[sqlite3.Row]:
+        return self._fetchone("SELECT * FROM jobs WHERE id = ?", (job_id,))
+
+    def count_by_status(self) -> Dict[str, int]:
+        rows = self._fetchall("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status")
+        return {row["status"]: row["n"] for row in rows}
+
+    def queued_before(self, created_at: float) -> int:
+        return self._fetchone(
+            "SELECT COUNT(*) FROM jobs WHERE status = ? AND created_at < ?", (STATUS_QUEUED, created_at)
+        )[0]
+
+    def requeue_stale(self, lease_seconds: float) -> int:
+        """
+        中断的任务重新排队：执行进程在本机且已退出，或开始执行超过lease_seconds；
+        仍在其他存活进程中执行的任务不受影响
+        """
+        expired = time.time() - lease_seconds
+        requeued = 0
+        for row in self._fetchall("SELECT id, started_at, owner FROM jobs WHERE status = ?", (STATUS_RUNNING,)):
+            if not ((row["started_at"] or 0) < expired or _owner_exited(row["owner"])):
+                continue
+            # 以开始时间为条件，避免重复排队已被重新领取的任务
+            requeued += self._execute(
+                "UPDATE jobs SET status = ?, progress = 0, stage = NULL, started_at = NULL, owner = NULL "
+                "WHERE id = ? AND status = ? AND started_at IS ?",
+                (STATUS_QUEUED, row["id"], STATUS_RUNNING, row["started_at"])
+            )
+        return requeued
+
+    def prune(self, older_than: float) -> int:
+        return self._execute(
+            "DELETE FROM jobs WHERE status IN (?, ?) AND finished_at < ?",
+            (STATUS_COMPLETED, STATUS_FAILED, older_than)
+        )
+
+
+class JobQueue:
+    """有界工作线程池 + 持久化队列"""
+
+    def __init__(self, store: JobStore, handler: Callable[[Dict[str, Any], Callable[[int, str], None]], Dict[str, Any]],
+                 max_workers: int = 4, max_pending: int = 50,
+                 retention_seconds: float = DEFAULT_RETENTION_SECONDS,
+                 lease_seconds: float = DEFAULT_LEASE_SECONDS):
+        """
+        Args:
+            store: 任务表
+            handler: handler(payload, progress) -> result，progress(百分比, 阶段名)上报进度
+            max_workers: 同时执行的任务数
+            max_pending: 排队 + 执行中的任务上限，超过时submit抛出QueueFull
+            retention_seconds: 已结束任务的保留时间
+            lease_seconds: 执行超过该时长的任务视为已中断并重新排队（应大于单个任务的最长耗时）
+        """
+        self.store = store
+        self.handler = handler
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.retention_seconds = retention_seconds
+        self.lease_seconds = lease_seconds
+        self.owner = process_owner()
+        self._last_recover = 0.0
+        self._wakeup = threading.Condition()
+        self._admission_lock = threading.Lock()
+        self._stopping = False
+        self._threads = []
+
+    def recover(self):
+        """中断的任务重新排队（启动时及空闲时定期执行）"""
+        self._last_recover = time.monotonic()
+        recovered = self.store.requeue_stale(self.lease_seconds)
+        if recovered:
+            logger.info(f"♻️ 重新排队 {recovered} 个中断的任务")
+
+    def start(self) -> "JobQueue":
+        self.recover()
+        self.store.prune(time.time() - self.retention_seconds)
+        for i in range(self.max_workers):
+            thread = threading.Thread(target=self._worker, name=f"report-job-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        self._update_gauges()
+        logger.info(f"🚀 报告任务队列已启动: {self.max_workers} 个工作线程, 最多 {self.max_pending} 个待处理任务")
+        return self
+
+    def stop(self, timeout: Optional[float] = None):
+        with self._wakeup:
+            self._stopping = True
+            self._wakeup.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def pending(self) -> int:
+        counts = self.store.count_by_status()
+        return counts.get(STATUS_QUEUED, 0) + counts.get(STATUS_RUNNING, 0)
+
+    def submit(self, payload: Dict[str, Any], job_id: Optional[str] = None) -> str:
+        """提交任务，返回任务ID（未指定时生成UUID）；队列已满时抛出QueueFull"""
+        with self._admission_lock:
+            pending = self.pending()
+            if pending >= self.max_pending:
+                JOBS_TOTAL.inc(status="rejected")
+                raise QueueFull(pending, self.max_pending)
+            job_id = job_id or str(uuid.uuid4())
+            self.store.insert(job_id, payload)
+        JOBS_TOTAL.inc(status="submitted")
+        self._update_gauges()
+        with self._wakeup:
+            self._wakeup.notify()
+        return job_id
+
+    def status(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """任务状态和进度（不含结果），不存在时返回None"""
+        row = self.store.get(job_id)
+        if row is None:
+            return None
+        status = {
+            "job_id": row["id"],
+            "status": row["status"],
+            "progress": row["progress"],
+            "stage": row["stage"],
+            "created_at": row["created_at"],
+            "started_at": row["started_at"],
+            "finished_at": row["finished_at"],
+            "error": row["error"],
+        }
+        if row["status"] == STATUS_QUEUED:
+            # 排在该任务之前的任务数
+            status["queue_position"] = self.store.queued_before(row["created_at"])
+        return status
+
+    def result(self, job_id: str) -> Optional[Dict[str, Any]]:
+        row = self.store.get(job_id)
+        if row is None or row["result"] is None:
+            return None
+        return json.loads(row["result"])
+
+    def _update_gauges(self):
+        counts = self.store.count_by_status()
+        JOBS_PENDING.set(counts.get(STATUS_QUEUED, 0), state=STATUS_QUEUED)
+        JOBS_PENDING.set(counts.get(STATUS_RUNNING, 0), state=STATUS_RUNNING)
+
+    def _worker(self):
+        while True:
+            with self._wakeup:
+                if self._stopping:
+                    return
+            row = self.store.claim_next(self.owner)
+            if row is None:
+                if time.monotonic() - self._last_recover >= RECOVER_INTERVAL_SECONDS:
+                    self.recover()
+                # 没有排队任务时等待唤醒（定期轮询，兼容其他进程写入的任务）
+                with self._wakeup:
+                    if not self._stopping:
+                        self._wakeup.wait(timeout=1.0)
+                continue
+            self._update_gauges()
+            self._run(row)
+            self._update_gauges()
+
+    def _run(self, row: sqlite3.Row):
+        job_id = row["id"]
+        # 本次租约：任务被重新排队后，进度和结果都不能覆盖新执行者的记录
+        lease = (row["owner"], row["started_at"])
+
+        def progress(percent: int, stage: str):
+            self.store.update_progress(job_id, *lease, int(percent), stage)
+
+        started = time.monotonic()
+        try:
+            result = self.handler(json.loads(row["payload"]), progress)
+        except Exception as e:
+            logger.error(f"❌ 任务 {job_id} 执行失败: {str(e)}")
+            if self.store.finish(job_id, *lease, error=str(e)):
+                JOBS_TOTAL.inc(status="failed")
+            else:
+                self._lease_lost(job_id)
+            return
+        if not self.store.finish(job_id, *lease, result=result):
+            self._lease_lost(job_id)
+            return
+        JOBS_TOTAL.inc(status="completed")
+        logger.info(f"✅ 任务 {job_id} 完成，耗时 {time.monotonic() - started:.1f}s")
+
+    def _lease_lost(self, job_id: str):
+        JOBS_TOTAL.inc(status="lease_lost")
+        logger.warning(f"⚠️ 任务 {job_id} 的租约已失效（已被重新排队），丢弃本次执行结果")
@@ -15,6 +15,54 @@ const { enhancedAnalyzeImageWithGPT4o } = require('./enhanced_image_analysis');
 const app = express();
 const PORT = process.env.PORT || 3001;
 
+// RAG查询截止时间：Python服务在截止时间前返回（时间不足时返回degraded部分结果），
+// 超过截止时间加宽限期仍未结束时才强制终止进程
+const RAG_DEADLINE_MS = parseInt(process.env.RAG_DEADLINE_MS || '60000', 10);
+const RAG_KILL_GRACE_MS = 10000;
+
+// RAG服务输出协议（见rag_protocol.py）：请求"output": "frames"时，Python按阶段输出长度前缀帧
+// 每帧为 "@<类型> <字节数>\n<紧凑JSON>\n"，类型依次为 retrieval → report（失败时为error）→ end
+// "fields"为大字段掩码，留空表示不回显user_info、不输出片段文本
+const RAG_OUTPUT_FIELDS = [];
+
+class RagFrameParser {
+  constructor(onFrame) {
+    this.buffer = Buffer.alloc(0);
+    this.onFrame = onFrame;
+  }
+
+  push(chunk) {
+    this.buffer = this.buffer.length ? Buffer.concat([this.buffer, chunk]) : chunk;
+    while (true) {
+      const headerEnd = this.buffer.indexOf(0x0a);
+      if (headerEnd === -1) return;
+
+      const match = /^@(\w+) (\d+)$/.exec(this.buffer.subarray(0, headerEnd).toString('utf8'));
+      if (!match) {
+        // 跳过第三方库误写到stdout的非帧内容
+        this.buffer = this.buffer.subarray(headerEnd + 1);
+        continue;
+      }
+
+      const frameEnd = headerEnd + 1 + parseInt(match[2], 10);
+      if (this.buffer.length < frameEnd + 1) return;
+
+      const payload = JSON.parse(this.buffer.subarray(headerEnd + 1, frameEnd).toString('utf8'));
+      this.buffer = this.buffer.subarray(frameEnd + 1);
+      this.onFrame(match[1], payload);
+    }
+  }
+}
+
+// 合并检索帧和报告帧为完整的RAG结果数据
+const mergeRagFrames = (retrievalFrame, reportFrame) => ({
+  ...reportFrame,
+  rag_analysis: {
+    ...((retrievalFrame && retrievalFrame.rag_analysis) || {}),
+    ...((reportFrame && reportFrame.rag_analysis) || {})
+  }
+});
+
 // 检查环境配置
 console.log('🔍 检查系统配置...');
 
@@ -852,7 +900,10 @@ const callRAGSystem = async (userInfo, imageInfos, enhancedQuery = null) => {
         },
         image_analysis: [], // 图片分析结果，如果有的话
         image_infos: imageInfos || [],
-        diagnostic_mode: process.env.RAG_DIAGNOSTIC_MODE === 'true' || false  // 支持诊断模式
+        diagnostic_mode: process.env.RAG_DIAGNOSTIC_MODE === 'true' || false,  // 支持诊断模式
+        deadline_at: Date.now() + RAG_DEADLINE_MS,  // 截止时间（毫秒时间戳）
+        output: 'frames',  // 长度前缀帧，检索结果先行输出
+        fields: RAG_OUTPUT_FIELDS  // 不回显大字段
       };
       
       const inputJson = JSON.stringify(inputData);
@@ -880,12 +931,95 @@ const callRAGSystem = async (userInfo, imageInfos, enhancedQuery = null) => {
         encoding: 'utf8'
       });
       
-      let outputData = '';
       let errorData = '';
+      let retrievalFrame = null;
+      let settled = false;
+      
+      // 处理RAG结果（报告帧或错误帧到达即处理，不必等待进程退出）
+      const handleRagResult = (result) => {
+        if (settled) return;
+        settled = true;
+        
+        if (result.success) {
+          console.log('✅ 增强版RAG系统分析完成（多样性强制均衡）');
+          
+          // 详细日志
+          const ragData = result.data;
+          if (ragData && ragData.rag_analysis) {
+            console.log('📊 多样性强制均衡RAG分析详情:');
+            console.log('   状态:', ragData.rag_analysis.status || '未知');
+            console.log('   检索到文档数:', ragData.rag_analysis.sources_count || 0);
+            console.log('   知识回答长度:', (ragData.rag_analysis.knowledge_answer || '').length, '字符');
+            console.log('   多样性增强:', ragData.rag_analysis.diversity_enhanced ? '✅ 已启用' : '❌ 未启用');
+            if (ragData.rag_analysis.degraded) {
+              console.warn('   ⚠️ 降级结果（截止时间内未完成的阶段）:', (ragData.rag_analysis.deadline?.skipped_stages || []).join(', '));
+            }
+            
+            if (ragData.rag_analysis.knowledge_references && ragData.rag_analysis.knowledge_references.length > 0) {
+              console.log('   📚 引用文档（多样性均衡后）:');
+              
+              // 统计作者分布
+              const authorCount = {};
+              ragData.rag_analysis.knowledge_references.forEach((ref, idx) => {
+                const filePath = ref.file_path || 'unknown';
+                const fileName = filePath.split('/').pop().toLowerCase();
+                
+                // 识别作者
+                let author = 'other';
+                if (fileName.includes('jordan') || fileName.includes('peterson')) author = 'jordan_peterson';
+                else if (fileName.includes('sadia') || fileName.includes('khan')) author = 'sadia_khan';
+                else if (fileName.includes('红药丸') || fileName.includes('red')) author = 'red_pill';
+                else if (fileName.includes('谜男') || fileName.includes('mystery')) author = 'mystery_method';
+                
+                authorCount[author] = (authorCount[author] || 0) + 1;
+                
+                console.log(`     ${idx + 1}. [${author}] 评分: ${ref.score?.toFixed(3) || 'N/A'}, 来源: ${filePath}`);
+              });
+              
+              console.log('   🎯 作者分布统计:');
+              Object.entries(authorCount).forEach(([author, count]) => {
+                const percentage = (count / ragData.rag_analysis.knowledge_references.length * 100).toFixed(1);
+                console.log(`      ${author}: ${count} 个片段 (${percentage}%)`);
+              });
+              
+              // 验证多样性
+              const maxAuthorCount = Math.max(...Object.values(authorCount));
+              if (maxAuthorCount <= 2) {
+                console.log('   ✅ 多样性验证: 成功！每个作者最多2个片段');
+              } else {
+                console.log(`   ⚠️ 多样性验证: 某作者超出限制 (${maxAuthorCount}个片段)`);
+              }
+            }
+          }
+          
+          resolve(result.data);
+        } else {
+          console.warn('⚠️ 增强版RAG系统返回错误:', result.error);
+          // 如果有fallback_report，使用它；否则生成备用报告
+          resolve(result.fallback_report || generateFallbackReport());
+        }
+      };
+      
+      // 按帧解析标准输出：检索帧先到达，报告帧到达后立即进入下一阶段
+      const frameParser = new RagFrameParser((type, payload) => {
+        if (type === 'retrieval') {
+          retrievalFrame = payload;
+          console.log('📥 增强版RAG检索结果已到达，引用文档数:', payload.rag_analysis?.sources_count || 0);
+        } else if (type === 'report') {
+          handleRagResult({ success: true, data: mergeRagFrames(retrievalFrame, payload) });
+        } else if (type === 'error') {
+          handleRagResult(payload);
+        }
+      });
       
-      // 收集标准输出
       pythonProcess.stdout.on('data', (data) => {
-        outputData += data.toString('utf8');
+        try {
+          frameParser.push(data);
+        } catch (parseError) {
+          console.error('❌ 解析增强版RAG输出帧失败:', parseError.message);
+          settled = true;
+          resolve(generateFallbackReport());
+        }
       });
       
       // 收集错误输出
@@ -896,85 +1030,14 @@ const callRAGSystem = async (userInfo, imageInfos, enhancedQuery = null) => {
       // 处理进程结束
       pythonProcess.on('close', (code) => {
         console.log(`🐍 增强版RAG进程结束，退出码: ${code}`);
+        if (settled) return;
+        settled = true;
         
-        if (code === 0) {
-          try {
-            // 清理输出数据（增强版RAG系统已经处理了输出重定向）
-            let cleanOutput = outputData.trim();
-            
-            // 调试：显示原始输出
-            console.log('📥 增强版RAG原始输出 (前100字符):', cleanOutput.substring(0, 100));
-            
-            // 解析Python返回的JSON
-            const result = JSON.parse(cleanOutput);
-            
-            if (result.success) {
-              console.log('✅ 增强版RAG系统分析完成（多样性强制均衡）');
-              
-              // 详细日志
-              const ragData = result.data;
-              if (ragData && ragData.rag_analysis) {
-                console.log('📊 多样性强制均衡RAG分析详情:');
-                console.log('   状态:', ragData.rag_analysis.status || '未知');
-                console.log('   检索到文档数:', ragData.rag_analysis.sources_count || 0);
-                console.log('   知识回答长度:', (ragData.rag_analysis.knowledge_answer || '').length, '字符');
-                console.log('   多样性增强:', ragData.rag_analysis.diversity_enhanced ? '✅ 已启用' : '❌ 未启用');
-                
-                if (ragData.rag_analysis.knowledge_references && ragData.rag_analysis.knowledge_references.length > 0) {
-                  console.log('   📚 引用文档（多样性均衡后）:');
-                  
-                  // 统计作者分布
-                  const authorCount = {};
-                  ragData.rag_analysis.knowledge_references.forEach((ref, idx) => {
-                    const filePath = ref.file_path || 'unknown';
-                    const fileName = filePath.split('/').pop().toLowerCase();
-                    
-                    // 识别作者
-                    let author = 'other';
-                    if (fileName.includes('jordan') || fileName.includes('peterson')) author = 'jordan_peterson';
-                    else if (fileName.includes('sadia') || fileName.includes('khan')) author = 'sadia_khan';
-                    else if (fileName.includes('红药丸') || fileName.includes('red')) author = 'red_pill';
-                    else if (fileName.includes('谜男') || fileName.includes('mystery')) author = 'mystery_method';
-                    
-                    authorCount[author] = (authorCount[author] || 0) + 1;
-                    
-                    console.log(`     ${idx + 1}. [${author}] 评分: ${ref.score?.toFixed(3) || 'N/A'}, 来源: ${filePath}`);
-                  });
-                  
-                  console.log('   🎯 作者分布统计:');
-                  Object.entries(authorCount).forEach(([author, count]) => {
-                    const percentage = (count / ragData.rag_analysis.knowledge_references.length * 100).toFixed(1);
-                    console.log(`      ${author}: ${count} 个片段 (${percentage}%)`);
-                  });
-                  
-                  // 验证多样性
-                  const maxAuthorCount = Math.max(...Object.values(authorCount));
-                  if (maxAuthorCount <= 2) {
-                    console.log('   ✅ 多样性验证: 成功！每个作者最多2个片段');
-                  } else {
-                    console.log(`   ⚠️ 多样性验证: 某作者超出限制 (${maxAuthorCount}个片段)`);
-                  }
-                }
-              }
-              
-              resolve(result.data);
-            } else {
-              console.warn('⚠️ 增强版RAG系统返回错误:', result.error);
-              // 如果有fallback_report，使用它；否则生成备用报告
-              resolve(result.fallback_report || generateFallbackReport());
-            }
-          } catch (parseError) {
-            console.error('❌ 解析增强版RAG响应失败:', parseError.message);
-            console.error('原始输出 (前500字符):', outputData.substring(0, 500));
-            resolve(generateFallbackReport());
-          }
-        } else {
-          console.error('❌ 增强版RAG进程执行失败，退出码:', code);
-          if (errorData) {
-            console.error('错误输出:', errorData);
-          }
-          resolve(generateFallbackReport());
+        console.error('❌ 增强版RAG进程未返回结果，退出码:', code);
+        if (errorData) {
+          console.error('错误输出:', errorData);
         }
+        resolve(generateFallbackReport());
       });
       
       // 处理进程错误
@@ -983,12 +1046,15 @@ const callRAGSystem = async (userInfo, imageInfos, enhancedQuery = null) => {
         resolve(generateFallbackReport());
       });
       
-      // 设置超时处理
-      setTimeout(() => {
-        console.warn('⏰ 增强版RAG查询超时，终止进程');
+      // 设置超时处理：Python服务会在截止时间前返回降级结果，这里只兜底处理卡死的进程
+      const killTimer = setTimeout(() => {
+        if (settled) return;
+        settled = true;
+        console.warn('⏰ 增强版RAG查询超过截止时间仍未返回，终止进程');
         pythonProcess.kill();
         resolve(generateFallbackReport());
-      }, 300000); // 300秒超时（5分钟），为复杂RAG检索提供充足时间
+      }, RAG_DEADLINE_MS + RAG_KILL_GRACE_MS);
+      pythonProcess.on('exit', () => clearTimeout(killTimer));
       
     } catch (error) {
       console.error('❌ 调用增强版RAG系统时发生错误:', error.message);
@@ -2050,8 +2116,8 @@ console.log('⏰ 服务器超时配置已更新:');
 console.log('   Request Timeout: 300秒 (5分钟)');
 console.log('   Keep-Alive Timeout: 300秒 (5分钟)');  
 console.log('   Headers Timeout: 300秒 (5分钟)');
-console.log('   RAG查询超时: 300秒 (5分钟)');
-console.log('   情感教练RAG超时: 300秒 (5分钟)');
+console.log(`   RAG查询截止时间: ${RAG_DEADLINE_MS / 1000}秒 (超时返回降级结果)`);
+console.log(`   RAG进程强制终止: ${(RAG_DEADLINE_MS + RAG_KILL_GRACE_MS) / 1000}秒`);
 console.log('✅ 所有超时配置已延长至5分钟，支持复杂AI分析任务');
 
 // ===== 约会后复盘功能模块 =====
@@ -2242,7 +2308,9 @@ const callPostDateRAGSystem = async (userQuestion, conversationHistory = []) =>
         bioOrChatHistory: userQuestion
       },
       image_infos: [],
-      diagnostic_mode: process.env.RAG_DIAGNOSTIC_MODE === 'true' || false  // 支持诊断模式
+      diagnostic_mode: process.env.RAG_DIAGNOSTIC_MODE === 'true' || false,  // 支持诊断模式
+      deadline_at: Date.now() + RAG_DEADLINE_MS,  // 截止时间（毫秒时间戳）
+      fields: RAG_OUTPUT_FIELDS  // 不回显大字段
     };
     
     console.log('📤 发送给RAG系统的查询:');
@@ -2258,8 +2326,8 @@ const callPostDateRAGSystem = async (userQuestion, conversationHistory = []) =>
     // 设置超时
     const timeout = setTimeout(() => {
       ragProcess.kill();
-      console.error('⏰ 情感教练RAG查询超时（300秒）');
-    }, 300000); // 300秒超时（5分钟）
+      console.error('⏰ 情感教练RAG查询超过截止时间仍未返回，终止进程');
+    }, RAG_DEADLINE_MS + RAG_KILL_GRACE_MS);
     
     return new Promise((resolve, reject) => {
       let stdout = '';
@@ -2352,7 +2420,9 @@ const callPostDateRAGSystemWithEnhancedQuery = async (enhancedQuery, originalUse
         bioOrChatHistory: enhancedQuery
       },
       image_infos: [],
-      diagnostic_mode: process.env.RAG_DIAGNOSTIC_MODE === 'true' || false  // 支持诊断模式
+      diagnostic_mode: process.env.RAG_DIAGNOSTIC_MODE === 'true' || false,  // 支持诊断模式
+      deadline_at: Date.now() + RAG_DEADLINE_MS,  // 截止时间（毫秒时间戳）
+      fields: RAG_OUTPUT_FIELDS  // 不回显大字段
     };
     
     console.log('📤 发送给RAG系统的优化查询:');
@@ -2370,8 +2440,8 @@ const callPostDateRAGSystemWithEnhancedQuery = async (enhancedQuery, originalUse
     // 设置超时
     const timeout = setTimeout(() => {
       ragProcess.kill();
-      console.error('⏰ 情感教练RAG查询超时（300秒）');
-    }, 300000); // 300秒超时（5分钟）
+      console.error('⏰ 情感教练RAG查询超过截止时间仍未返回，终止进程');
+    }, RAG_DEADLINE_MS + RAG_KILL_GRACE_MS);
     
     return new Promise((resolve, reject) => {
       let stdout = '';
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+相同请求合并 (single-flight)
+用户双击或前端重试时，相同的扫描请求会同时到达；同一个键同一时刻只执行一次计算，
+其余并发请求等待进行中的计算并共享其结果（计算失败时同样共享异常）
+
+    SingleFlight       线程版（Flask报告函数、任务队列工作线程）
+    AsyncSingleFlight  asyncio版（常驻RAG worker）
+
+计算完成后立即释放键，之后到达的请求重新计算（结果复用由report_cache负责）
+"""
+
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+from rag_metrics import COALESCED_REQUESTS_TOTAL
+
+
+class _Call:
+    """进行中的一次计算"""
+
+    __slots__ = ("done", "value", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    """线程版single-flight"""
+
+    def __init__(self, name: str):
+        """
+        Args:
+            name: 指标中的flight标签
+        """
+        self.name = name
+        self._calls: Dict[Hashable, _Call] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        执行fn，或等待相同键的进行中计算
+
+        Returns:
+            (结果, 是否共享了其他请求的结果)
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            COALESCED_REQUESTS_TOTAL.inc(flight=self.name)
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value, True
+
+        try:
+            call.value = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.value, False
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
+
+
+def _consume_exception(future: asyncio.Future):
+    # 没有等待者时也不输出"Future exception was never retrieved"
+    if not future.cancelled():
+        future.exception()
+
+
+class AsyncSingleFlight:
+    """asyncio版single-flight（只在一个事件循环内使用）"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._futures: Dict[Hashable, asyncio.Future] = {}
+
+    async def do(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        await factory()，或等待相同键的进行中计算
+
+        Returns:
+            (结果, 是否共享了其他请求的结果)
+        """
+        future = self._futures.get(key)
+        if future is not None:
+            COALESCED_REQUESTS_TOTAL.inc(flight=self.name)
+            # shield：等待者被取消时不影响进行中的计算
+            return await asyncio.shield(future), True
+
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_consume_exception)
+        self._futures[key] = future
+        try:
+            value = await factory()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(value)
+        finally:
+            self._futures.pop(key, None)
+        return value, False
+
+    def in_flight(self) -> int:
+        return len(self._futures)
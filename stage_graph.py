@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+依赖图阶段执行器
+按声明的依赖关系并发执行请求处理中的各个阶段：互不依赖的阶段同时运行，
+端到端耗时接近最长的依赖链而不是所有阶段之和
+
+    graph = StageGraph()
+    graph.add("index", load_index)
+    graph.add("embedding", embed_queries)
+    graph.add("retrieval", search, deps=("index", "embedding"))   # search(index, embeddings)
+    results = graph.run()
+
+阶段函数以依赖阶段的结果（按deps顺序）作为位置参数；任一阶段失败时run()抛出该异常，
+尚未开始的阶段不再执行
+"""
+
+import os
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 所有阶段图共用的线程池
+STAGE_GRAPH_WORKERS = int(os.getenv("STAGE_GRAPH_WORKERS", "16"))
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _shared_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=STAGE_GRAPH_WORKERS, thread_name_prefix="stage")
+    return _executor
+
+
+class StageGraph:
+    """一次请求的阶段依赖图（每个实例只运行一次）"""
+
+    def __init__(self, executor: Optional[ThreadPoolExecutor] = None):
+        self._executor = executor
+        self._stages: Dict[str, Tuple[Callable[..., Any], Tuple[str, ...]]] = {}
+        self.timings: Dict[str, float] = {}
+
+    def add(self, name: str, fn: Callable[..., Any], deps: Iterable[str] = ()) -> "StageGraph":
+        """添加阶段；依赖必须是已添加的阶段（因此图中不会出现环）"""
+        deps = tuple(deps)
+        if name in self._stages:
+            raise ValueError(f"阶段重复定义: {name}")
+        missing = [dep for dep in deps if dep not in self._stages]
+        if missing:
+            raise ValueError(f"阶段 {name} 依赖未定义的阶段: {', '.join(missing)}")
+        self._stages[name] = (fn, deps)
+        return self
+
+    def _call(self, name: str, args: tuple) -> Any:
+        started = time.monotonic()
+        try:
+            return self._stages[name][0](*args)
+        finally:
+            self.timings[name] = time.monotonic() - started
+
+    def run(self) -> Dict[str, Any]:
+        """执行所有阶段，返回 {阶段名: 结果}"""
+        executor = self._executor or _shared_executor()
+        results: Dict[str, Any] = {}
+        pending = dict(self._stages)
+        running: Dict[Any, Tuple[str, tuple]] = {}
+
+        try:
+            while pending or running:
+                for future in [future for future in running if future.done()]:
+                    name, _ = running.pop(future)
+                    results[name] = future.result()
+
+                ready = [name for name, (_, deps) in pending.items() if all(dep in results for dep in deps)]
+                if not ready:
+                    # 已提交的阶段仍在排队（线程池已满）时改在当前线程执行，嵌套的阶段图不会互相等待
+                    for future, (name, args) in list(running.items()):
+                        if future.cancel():
+                            del running[future]
+                            results[name] = self._call(name, args)
+                            break
+                    else:
+                        wait(list(running), return_when=FIRST_COMPLETED)
+                    continue
+
+                calls = []
+                for name in ready:
+                    _, deps = pending.pop(name)
+                    calls.append((name, tuple(results[dep] for dep in deps)))
+                # 其余就绪阶段交给线程池，第一个在当前线程执行
+                for name, args in calls[1:]:
+                    running[executor.submit(self._call, name, args)] = (name, args)
+                name, args = calls[0]
+                results[name] = self._call(name, args)
+        except BaseException:
+            for future in running:
+                future.cancel()
+            raise
+
+        return results
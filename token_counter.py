@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Token计数模块
+优先使用tiktoken精确计数，未安装或分词表无法加载（首次使用需联网下载）时使用按字符类型估算的近似值
+"""
+
+import re
+import logging
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+# tiktoken为可选依赖
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# 中日韩字符：每个字符约占1个token
+_CJK_PATTERN = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af]')
+
+
+# 分词表加载失败的模型（只在首次失败时记录日志）
+_encoding_failures = []
+
+
+@lru_cache(maxsize=8)
+def _get_encoding(model: str):
+    """模型对应的分词器；加载失败时返回None（结果被缓存，不会每次请求都重新下载）"""
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        if not _encoding_failures:
+            logger.warning(f"⚠️ tiktoken分词表加载失败，改用近似token计数: {str(e)}")
+        _encoding_failures.append(model)
+        return None
+
+
+def count_tokens(text: str, model: str = "gpt-4o") -> int:
+    """
+    计算文本的token数量
+
+    Args:
+        text: 待计数文本
+        model: 模型名称，决定使用的分词器
+
+    Returns:
+        token数量
+    """
+    if not text:
+        return 0
+
+    encoding = _get_encoding(model)
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+
+    # 近似估算：CJK字符按1个token，其余字符按4个字符1个token
+    cjk_count = len(_CJK_PATTERN.findall(text))
+    other_count = len(text) - cjk_count
+    return cjk_count + (other_count + 3) // 4
+
+
+def truncate_to_tokens(text: str, max_tokens: int, model: str = "gpt-4o") -> str:
+    """把文本截断到不超过max_tokens个token"""
+    if max_tokens <= 0:
+        return ""
+    if count_tokens(text, model) <= max_tokens:
+        return text
+
+    encoding = _get_encoding(model)
+    if encoding is not None:
+        return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+
+    # 近似估算模式下二分查找最长前缀
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if count_tokens(text[:mid], model) <= max_tokens:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low]